@@ -0,0 +1,459 @@
+# ragAnnIndex.py
+'''
+근사 최근접 이웃(ANN) 인덱스 - IVF (inverted file)
+vector_store.as_retriever()의 전체 탐색(brute-force)은 청크 수에 비례해서 느려진다
+도시 계획 문서를 계속 추가해 수십만 청크가 되면 질의마다 전체 벡터를 훑을 수 없다
+
+IVF 방식
+- 인덱스를 만들 때(build): k-means로 벡터를 nlist개 묶음(클러스터)으로 나눈다
+- 검색할 때(search): 질의와 가까운 nprobe개 묶음 안의 벡터만 비교한다
+  => 비교 횟수 ≈ 전체 * nprobe / nlist (청크 수가 늘어도 거의 늘지 않음)
+- nlist(빌드 파라미터), nprobe(검색 파라미터)로 속도와 recall을 조절한다
+- 새 벡터는 가장 가까운 묶음에 바로 추가(incremental insert),
+  처음 학습할 때보다 4배 이상 커지면 rebuild()로 다시 묶는 것이 좋다
+
+인덱스는 chroma_store 옆(./ann_index)에 저장하고 벡터/ID/source만 가진다
+청크 텍스트/메타데이터는 chroma_store에서 ID로 가져온다 (AnnVectorStore)
+build/rebuild는 새 버전 디렉터리에 쓰고 CURRENT를 바꾼다 (ragIndexDir)
+add는 지금 버전 파일 끝에 이어 쓰고 meta.json의 행 수를 마지막에 바꾼다
+=> 다른 프로세스가 mmap으로 읽는 중이어도 이미 커밋된 행은 바뀌지 않는다
+'''
+import json
+import os
+
+import numpy as np
+from langchain_core.vectorstores import VectorStore
+
+from ragIndexDir import abort_version, begin_version, current_dir, publish_version
+from ragLoader import _write_json
+from ragRouter import filter_sources
+
+ANN_VERSION = 3
+# CURRENT 포인터 이전 형식에서 path에 바로 쓰던 파일들 (새 버전을 만들면 지운다)
+LEGACY_FILES = ('meta.json', 'centroids.npy', 'vectors.f32', 'assign.i32', 'ids.txt',
+                'sources.txt', 'deleted.txt')
+# k-means 학습 표본 최대 행 수 (3072차원이면 약 400MB)
+MAX_TRAIN_ROWS = 32768
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=20, seed=0):
+    '''코사인 유사도 기준 k-means => (n_clusters, d) 정규화된 중심 벡터'''
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~np.bincount(assign, minlength=n_clusters).astype(bool)
+        if empty.any():
+            # 빈 묶음은 아무 벡터나 다시 골라서 채운다
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class AnnIndex:
+    '''
+    IVF 근사 최근접 이웃 인덱스 (추가/삭제 가능)
+    디렉터리 구조 (path/CURRENT가 가리키는 버전 디렉터리 안)
+    - meta.json      : 차원, nlist, 학습 당시 개수, 커밋된 행 수와 텍스트 파일 길이
+    - centroids.npy  : 묶음 중심 벡터
+    - vectors.f32    : 정규화된 벡터 (행 단위로 이어 붙이는 raw float32 파일, mmap)
+    - assign.i32     : 행별 묶음 번호
+    - ids.txt        : 행별 청크 ID (한 줄에 하나)
+    - sources.txt    : 행별 청크 source (파티션 검색용)
+    - deleted.txt    : 삭제된 청크 ID (rebuild 때 정리)
+    데이터 파일은 meta.json의 count행(텍스트 파일은 *_bytes 바이트)까지만 읽는다
+    => add가 중간에 실패해서 뒤에 남은 찌꺼기는 보이지 않고 다음 add가 잘라낸다
+    쓰는 쪽(add/delete/rebuild)은 한 프로세스만 있다고 가정한다 (ragTest.py)
+    '''
+
+    def __init__(self, path, nprobe=8):
+        self.path = path
+        self.nprobe = nprobe
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_lines(self, name, size):
+        with open(self._file(name), 'rb') as f:
+            return f.read(size).decode('utf-8').splitlines()
+
+    def _load(self):
+        self.directory = current_dir(self.path)
+        if self.directory is None:
+            raise FileNotFoundError(f'no ANN index in {self.path}')
+        with open(self._file('meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.centroids = np.load(self._file('centroids.npy'))
+        # 예전 형식(행 수가 meta에 없음)은 파일 전체를 읽는다 (read(-1))
+        self.ids = self._read_lines('ids.txt', self.meta.get('ids_bytes', -1))
+        n = len(self.ids)
+        sources = self._read_lines('sources.txt', self.meta.get('sources_bytes', -1))
+        # source는 종류가 적으므로 코드 배열로 바꿔둔다 (파티션 마스크를 빠르게 만들기 위해)
+        self.source_values = sorted(set(sources))
+        code_of = {source: code for code, source in enumerate(self.source_values)}
+        self.source_codes = np.fromiter((code_of[source] for source in sources),
+                                        dtype=np.int32, count=n)
+        self.vectors = (np.memmap(self._file('vectors.f32'), dtype=np.float32, mode='r',
+                                  shape=(n, self.dim)) if n else np.zeros((0, self.dim), np.float32))
+        assign = np.fromfile(self._file('assign.i32'), dtype=np.int32, count=n)
+        self.deleted = set()
+        if os.path.exists(self._file('deleted.txt')):
+            with open(self._file('deleted.txt'), 'r', encoding='utf-8') as f:
+                self.deleted = set(f.read().splitlines())
+        # 같은 ID가 다시 추가되면 마지막 행만 살아 있다
+        self._row_of = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._alive = np.zeros(n, dtype=bool)
+        self._alive[[row for chunk_id, row in self._row_of.items()
+                     if chunk_id not in self.deleted]] = True
+        # 묶음별 행 번호 목록 (inverted lists)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def close(self):
+        '''mmap 해제'''
+        self.vectors = np.zeros((0, self.dim), np.float32)
+
+    def __len__(self):
+        return int(self._alive.sum())
+
+    @classmethod
+    def build(cls, path, ids, vectors, sources=None, nlist=None, iterations=20, nprobe=8):
+        '''
+        인덱스를 새로 만든다
+        - sources: 행별 청크 source (None이면 모두 '')
+        - nlist: 묶음 수 (None이면 4 * sqrt(n), 많을수록 검색이 빠르지만 recall을 위해 nprobe도 키워야 함)
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ids = list(ids)
+        return cls.build_from_batches(path, [(ids, vectors, sources or [''] * len(ids))],
+                                      nlist=nlist, iterations=iterations, nprobe=nprobe,
+                                      dim=vectors.shape[-1])
+
+    @classmethod
+    def build_from_batches(cls, path, batches, nlist=None, iterations=20, nprobe=8, dim=None,
+                           block_rows=16384):
+        '''
+        (ids, vectors, sources) 배치를 차례로 받아 인덱스를 새로 만든다
+        전체 벡터를 한 번에 메모리에 올리지 않는다 (배치 하나 + 학습 표본 + block_rows 행)
+        1) 배치를 정규화해서 새 버전 디렉터리의 vectors.f32/ids.txt/sources.txt 끝에 이어 쓰고
+        2) 다 쓴 vectors.f32를 mmap으로 열어 표본으로 묶음을 학습한 다음
+        3) block_rows 행씩 읽으며 가장 가까운 묶음을 배정한다
+        - dim: 배치가 하나도 없을 때의 차원 (없으면 ValueError)
+        '''
+        # 지금 버전의 vectors.f32를 다른 프로세스가 mmap으로 읽고 있을 수 있다
+        # => 제자리에서 다시 쓰지 않고 새 버전 디렉터리에 쓴 다음 CURRENT를 바꾼다
+        tmp_dir = begin_version(path)
+        try:
+            n, ids_bytes, sources_bytes = 0, 0, 0
+            vectors_path = os.path.join(tmp_dir, 'vectors.f32')
+            with open(vectors_path, 'wb') as vectors_file, \
+                    open(os.path.join(tmp_dir, 'ids.txt'), 'wb') as ids_file, \
+                    open(os.path.join(tmp_dir, 'sources.txt'), 'wb') as sources_file:
+                for ids, vectors, sources in batches:
+                    ids = list(ids)
+                    if not ids:
+                        continue
+                    vectors = _normalize(vectors).reshape(len(ids), -1)
+                    if dim is None or n == 0:
+                        dim = vectors.shape[1]
+                    vectors_file.write(vectors.tobytes())
+                    data = _encode_lines(ids)
+                    ids_file.write(data)
+                    ids_bytes += len(data)
+                    data = _encode_lines(sources or [''] * len(ids))
+                    sources_file.write(data)
+                    sources_bytes += len(data)
+                    n += len(ids)
+            if dim is None:
+                raise ValueError('no vectors to index; ingest documents before building the ANN index')
+
+            nlist = nlist or max(1, int(4 * np.sqrt(n)))
+            vectors = (np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(n, dim))
+                       if n else np.zeros((0, dim), np.float32))
+            # 학습은 표본으로만 해도 충분하다 (묶음당 256개, 최대 MAX_TRAIN_ROWS개)
+            rng = np.random.default_rng(0)
+            size = min(nlist * 256, MAX_TRAIN_ROWS)
+            sample = (np.array(vectors) if n <= size
+                      else np.array(vectors[np.sort(rng.choice(n, size, replace=False))]))
+            centroids = spherical_kmeans(sample, nlist, iterations) if n else np.zeros((1, dim), np.float32)
+            del sample
+            with open(os.path.join(tmp_dir, 'assign.i32'), 'wb') as f:
+                for start in range(0, n, block_rows):
+                    block = np.asarray(vectors[start:start + block_rows])
+                    np.argmax(block @ centroids.T, axis=1).astype(np.int32).tofile(f)
+            del vectors
+
+            np.save(os.path.join(tmp_dir, 'centroids.npy'), centroids)
+            _write_json(os.path.join(tmp_dir, 'meta.json'), {
+                'version': ANN_VERSION, 'dim': dim, 'nlist': len(centroids),
+                'trained_count': n, 'iterations': iterations,
+                'count': n, 'ids_bytes': ids_bytes, 'sources_bytes': sources_bytes,
+            })
+        except BaseException:
+            abort_version(tmp_dir)
+            raise
+        publish_version(path, tmp_dir, legacy=LEGACY_FILES)
+        return cls(path, nprobe=nprobe)
+
+    def add(self, ids, vectors, sources=None):
+        '''새 벡터를 가장 가까운 묶음에 추가한다 (이미 있는 ID는 새 벡터로 바뀐다)'''
+        ids = list(ids)
+        if not ids:
+            return
+        vectors = _normalize(vectors).reshape(len(ids), self.dim)
+        assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        ids_bytes = _encode_lines(ids)
+        sources_bytes = _encode_lines(sources or [''] * len(ids))
+        n = len(self.ids)
+        # 커밋된 길이 (예전 형식은 파일 크기 그대로)
+        committed = {
+            'vectors.f32': n * self.dim * 4, 'assign.i32': n * 4,
+            'ids.txt': self.meta.get('ids_bytes', os.path.getsize(self._file('ids.txt'))),
+            'sources.txt': self.meta.get('sources_bytes',
+                                         os.path.getsize(self._file('sources.txt'))),
+        }
+        self.close()  # 윈도우에서는 mmap이 열린 파일을 늘릴 수 없다
+        for name, data in (('vectors.f32', vectors.tobytes()), ('assign.i32', assign.tobytes()),
+                           ('ids.txt', ids_bytes), ('sources.txt', sources_bytes)):
+            with open(self._file(name), 'r+b') as f:
+                # 이전 add가 커밋 전에 실패해서 남긴 꼬리를 잘라내고 이어 쓴다
+                # (커밋된 길이 뒤쪽만 자르므로 읽는 쪽 mmap 범위에는 닿지 않는다)
+                size = committed[name]
+                f.truncate(size)
+                f.seek(size)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        # 데이터를 다 쓴 다음 행 수를 바꾼다 = 커밋 (_write_json은 임시 파일 + os.replace)
+        _write_json(self._file('meta.json'), dict(
+            self.meta, count=n + len(ids),
+            ids_bytes=committed['ids.txt'] + len(ids_bytes),
+            sources_bytes=committed['sources.txt'] + len(sources_bytes)))
+        # 커밋 뒤에 실패하면 다시 추가한 ID가 삭제로 보일 뿐이고 다음 sync_from_chroma가 다시 넣는다
+        if self.deleted & set(ids):
+            self.deleted -= set(ids)
+            self._write_deleted()
+        self._load()
+
+    def delete(self, ids):
+        '''ID를 삭제 표시한다 (검색에서 제외, rebuild 때 실제로 지워진다)'''
+        ids = [chunk_id for chunk_id in ids if chunk_id in self._row_of]
+        if not ids:
+            return
+        self.deleted |= set(ids)
+        self._write_deleted()
+        self._alive[[self._row_of[chunk_id] for chunk_id in ids]] = False
+
+    def _write_deleted(self):
+        tmp = self._file(f'deleted.txt.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(_encode_lines(sorted(self.deleted)))
+        os.replace(tmp, self._file('deleted.txt'))
+
+    def needs_rebuild(self, growth=4.0):
+        '''학습 이후 크게 늘었거나 죽은 행(삭제/덮어쓰기)이 많으면 True'''
+        trained = max(1, self.meta['trained_count'])
+        dead = len(self.ids) - len(self)
+        return len(self.ids) > growth * trained or dead > 0.2 * max(1, len(self.ids))
+
+    def rebuild(self, nlist=None):
+        '''살아 있는 벡터만으로 묶음을 다시 학습한다'''
+        rows = np.nonzero(self._alive)[0]
+
+        def batches(block_rows=16384):
+            for start in range(0, len(rows), block_rows):
+                part = rows[start:start + block_rows]
+                yield ([self.ids[row] for row in part], np.array(self.vectors[part]),
+                       [self.source_values[self.source_codes[row]] for row in part])
+
+        index = AnnIndex.build_from_batches(self.path, batches(), nlist=nlist,
+                                            iterations=self.meta['iterations'],
+                                            nprobe=self.nprobe, dim=self.dim)
+        self.close()
+        return index
+
+    def search(self, query_vector, k=4, nprobe=None, sources=None):
+        '''
+        질의와 가까운 nprobe개 묶음만 훑어서 top-k => [(청크 ID, 코사인 유사도), ...]
+        - sources: 이 source의 청크만 검색 (결과가 k개보다 적으면 묶음을 더 훑는다)
+        '''
+        if not self.ids:
+            return []
+        query = _normalize(query_vector).reshape(-1)
+        mask = self._alive
+        if sources is not None:
+            codes = [code for code, source in enumerate(self.source_values) if source in sources]
+            mask = mask & np.isin(self.source_codes, codes)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        order = np.argsort(-(self.centroids @ query))
+        while True:
+            rows = np.concatenate([self.lists[i] for i in order[:nprobe]])
+            rows = np.sort(rows[mask[rows]])  # mmap을 순서대로 읽도록 정렬
+            if len(rows) >= k or nprobe >= len(order):
+                break
+            nprobe = min(nprobe * 2, len(order))
+        if not len(rows):
+            return []
+        scores = np.asarray(self.vectors[rows]) @ query
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+    def sync_from_chroma(self, vector_store, page_size=5000):
+        '''
+        chroma_store와 ID 기준으로 맞춘다 (증분)
+        - chroma에만 있는 ID => 벡터를 가져와 add
+        - 인덱스에만 있는 ID => delete
+        '''
+        chroma_ids = []
+        offset = 0
+        while True:
+            result = vector_store.get(include=[], limit=page_size, offset=offset)
+            chroma_ids.extend(result['ids'])
+            if len(result['ids']) < page_size:
+                break
+            offset += page_size
+        alive = {self.ids[row] for row in np.nonzero(self._alive)[0]}
+        missing = [chunk_id for chunk_id in chroma_ids if chunk_id not in alive]
+        stale = alive - set(chroma_ids)
+        for i in range(0, len(missing), page_size):
+            part = missing[i:i + page_size]
+            result = vector_store.get(ids=part, include=['embeddings', 'metadatas'])
+            self.add(result['ids'], np.asarray(result['embeddings'], dtype=np.float32),
+                     _sources(result['metadatas']))
+        if stale:
+            self.delete(list(stale))
+        return {'added': len(missing), 'deleted': len(stale)}
+
+
+def _encode_lines(values):
+    return ''.join(f'{value}\n' for value in values).encode('utf-8')
+
+
+def _sources(metadatas):
+    return [(metadata or {}).get('source', '') for metadata in metadatas]
+
+
+def _index_version(path):
+    directory = current_dir(path)
+    if directory is None:
+        return None
+    meta_path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('version')
+
+
+def open_or_build_ann(path, vector_store, nprobe=8, page_size=5000):
+    '''인덱스가 있으면 열어서 chroma와 증분 동기화, 없으면(또는 형식이 예전 버전이면) 새로 만든다'''
+    if _index_version(path) == ANN_VERSION:
+        index = AnnIndex(path, nprobe=nprobe)
+        index.sync_from_chroma(vector_store, page_size=page_size)
+        if index.needs_rebuild():
+            index = index.rebuild()
+        return index
+    # 전체를 한 번에 get하면 청크 수만큼 벡터가 메모리에 올라간다 => page_size개씩 나눠 만든다
+    return AnnIndex.build_from_batches(path, _chroma_batches(vector_store, page_size), nprobe=nprobe)
+
+
+def _chroma_batches(vector_store, page_size=5000):
+    '''chroma의 (ids, vectors, sources)를 page_size개씩'''
+    offset = 0
+    while True:
+        result = vector_store.get(include=['embeddings', 'metadatas'], limit=page_size, offset=offset)
+        if result['ids']:
+            yield (result['ids'], np.asarray(result['embeddings'], dtype=np.float32),
+                   _sources(result['metadatas']))
+        if len(result['ids']) < page_size:
+            return
+        offset += page_size
+
+
+class AnnVectorStore(VectorStore):
+    '''
+    AnnIndex로 검색하고 청크 내용은 docstore(chroma)에서 ID로 가져오는 VectorStore
+    - nprobe: 검색할 묶음 수 (클수록 정확, 느림)
+    '''
+
+    def __init__(self, index, docstore, embedding_function, nprobe=None):
+        self.index = index
+        self.docstore = docstore
+        self.embedding_function = embedding_function
+        self.nprobe = nprobe
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1.0) / 2.0
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, nprobe=None, filter=None,
+                                               **kwargs):
+        hits = self.index.search(embedding, k, nprobe=nprobe or self.nprobe,
+                                 sources=filter_sources(filter))
+        docs = {doc.id: doc for doc in self.docstore.get_by_ids([chunk_id for chunk_id, _ in hits])}
+        return [(docs[chunk_id], score) for chunk_id, score in hits if chunk_id in docs]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(
+            self.embedding_function.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        relevance = self._select_relevance_score_fn()
+        return [(doc, relevance(score))
+                for doc, score in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def get_by_ids(self, ids):
+        return self.docstore.get_by_ids(ids)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path='./ann_index',
+                   nlist=None, nprobe=8, **kwargs):
+        '''
+        텍스트를 임베딩해서 path에 인덱스를 만들고 연다
+        청크 내용은 메모리 docstore에 둔다 (프로세스가 끝나면 사라짐)
+        => 다시 열어 쓸 인덱스는 chroma_store에서 open_or_build_ann으로 만든다
+        '''
+        import uuid
+        from langchain_core.documents import Document
+
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        docs = [Document(id=chunk_id, page_content=text, metadata=metadata)
+                for chunk_id, text, metadata in zip(ids, texts, metadatas)]
+        vectors = np.asarray(embedding.embed_documents(texts), dtype=np.float32)
+        index = AnnIndex.build(path, ids, vectors, _sources(metadatas), nlist=nlist, nprobe=nprobe)
+        return cls(index, _MemoryDocStore(docs), embedding)
+
+
+class _MemoryDocStore:
+    '''ID => Document (AnnVectorStore.from_texts용 docstore)'''
+
+    def __init__(self, docs):
+        self._docs = {doc.id: doc for doc in docs}
+
+    def get_by_ids(self, ids):
+        return [self._docs[chunk_id] for chunk_id in ids if chunk_id in self._docs]
@@ -0,0 +1,108 @@
+# ragAugment.py
+'''
+질문 보정(query_augument_chain) 생략 판단
+ragChat.py는 모든 질문마다 gpt-4o-mini로 질문을 보정한다
+"서울의 녹지 공간 확대 계획은 무엇인가요?"처럼 그 자체로 완전한 질문은 보정할 필요가 없다
+
+needs_augmentation: 규칙 기반 로컬 분류기 (LLM 호출 없음, 수 마이크로초)
+- 지시어/대명사 (이것, 그 계획, 거기, 그럼 ...)      => 보정 필요
+- 짧은 후속 질문 ("뉴욕은?", "예산도?")              => 보정 필요
+- 대상 도시가 없는 질문 (생략된 주어)                => 보정 필요
+- 그 외 (도시가 있고 충분히 긴 질문)                 => 보정 생략
+AdaptiveAugmenter: 판단 결과와 보정에 걸린 시간/토큰을 로그로 남겨서
+생략으로 줄어든 지연 시간과 토큰을 추정할 수 있게 한다
+'''
+import json
+import logging
+import re
+import time
+
+from langchain_core.messages import AIMessage
+
+from ragRouter import DEFAULT_PARTITIONS
+
+logger = logging.getLogger(__name__)
+
+# 앞 대화를 가리키는 말 (단어 경계 기준)
+_REFERENCE = re.compile(
+    r'(?:^|\s)(?:이|그|저)(?:것|거|건|게|곳|때|런|러한|렇게|와|\s)'
+    r'|(?:^|\s)(?:여기|거기|저기|그럼|그러면|그래서|그리고|그건|이건|저건|아까|위에서|앞에서)'
+    r'|\b(?:it|its|they|them|their|this|that|those|these|there)\b')
+# "뉴욕은?", "예산도?" 처럼 명사 하나 + 조사로 끝나는 후속 질문
+_FOLLOW_UP = re.compile(r'^\S{1,10}(?:은|는|도|의|이랑|하고|랑)\s*[?？]?$')
+MIN_SELF_CONTAINED_CHARS = 10
+
+
+def needs_augmentation(query, partitions=None):
+    '''질문 보정이 필요한지 => (True/False, 이유)'''
+    text = query.strip().lower()
+    if _FOLLOW_UP.match(text):
+        return True, 'follow_up'
+    if _REFERENCE.search(text):
+        return True, 'reference'
+    if len(text) < MIN_SELF_CONTAINED_CHARS:
+        return True, 'too_short'
+    partitions = partitions or DEFAULT_PARTITIONS
+    if not any(keyword in text for keywords in partitions.values() for keyword in keywords):
+        return True, 'no_target_city'
+    return False, 'self_contained'
+
+
+def depends_on_history(query, messages, partitions=None):
+    '''
+    앞 대화에 따라 답이 달라지는 질문이면 True (의미 기반 답변 캐시를 건너뛴다)
+    - messages: 이번 질문까지 포함한 대화 (답변이 하나도 없으면 첫 질문)
+    보정 체인은 대화 기록을 보지 않으므로 "그럼 뉴욕은?"을 보정한 질문에는 앞 대화가 남지 않는다
+    => 보정된 질문만 키로 쓰면 다른 대화의 답변이 나올 수 있다
+    '''
+    if not any(isinstance(message, AIMessage) for message in messages):
+        return False
+    return needs_augmentation(query, partitions)[0]
+
+
+class AdaptiveAugmenter:
+    '''
+    필요할 때만 query_augument_chain을 부르는 보정 단계
+    - chain: query_augumentation_prompt | llm
+    - enabled: False면 항상 보정 (분류기 끄기)
+    invoke(query) => AIMessage (생략하면 원래 질문을 그대로 담은 AIMessage)
+    '''
+
+    def __init__(self, chain, partitions=None, enabled=True):
+        self.chain = chain
+        self.partitions = partitions
+        self.enabled = enabled
+        self.calls = 0
+        self.skipped = 0
+        self.llm_seconds = 0.0
+        self.llm_tokens = 0
+
+    def invoke(self, query):
+        needed, reason = needs_augmentation(query, self.partitions)
+        if self.enabled and not needed:
+            self.skipped += 1
+            self._log(query, 'skip', reason)
+            return AIMessage(query)
+
+        start = time.perf_counter()
+        message = self.chain.invoke({'query': query})
+        seconds = time.perf_counter() - start
+        self.calls += 1
+        self.llm_seconds += seconds
+        usage = getattr(message, 'usage_metadata', None) or {}
+        self.llm_tokens += usage.get('total_tokens', 0)
+        self._log(query, 'augment', reason, seconds=round(seconds, 3),
+                  tokens=usage.get('total_tokens'))
+        return message
+
+    def _log(self, query, decision, reason, **extra):
+        logger.info(json.dumps({'decision': decision, 'reason': reason, 'query': query,
+                                **extra, **self.stats()}, ensure_ascii=False))
+
+    def stats(self):
+        '''생략 횟수와 (보정 1회 평균으로 추정한) 절약된 시간/토큰'''
+        avg_seconds = self.llm_seconds / self.calls if self.calls else 0.0
+        avg_tokens = self.llm_tokens / self.calls if self.calls else 0.0
+        return {'augment_calls': self.calls, 'augment_skipped': self.skipped,
+                'saved_seconds_est': round(self.skipped * avg_seconds, 3),
+                'saved_tokens_est': round(self.skipped * avg_tokens)}
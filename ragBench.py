@@ -0,0 +1,251 @@
+# ragBench.py
+'''
+인제스트 파이프라인 벤치마크 (오프라인)
+ragTest.py 파이프라인의 단계별 처리 속도를 측정해서 JSON으로 출력한다
+- load   : pages/sec  (pdf 텍스트 추출, 캐시 없음 / 캐시 적중 각각)
+- split  : chunks/sec (청킹)
+- embed  : embeddings/sec (고정 가짜 임베딩 또는 로컬 스텁 서버)
+- upsert : upserts/sec (Chroma 저장, 임베딩 시간 제외)
+- query  : queries/sec (Chroma vs NumpyVectorStore vs IVF 근사 검색, 질의 임베딩 제외)
+
+합성 pdf와 가짜 임베딩을 쓰므로 API 키, 네트워크 없이 항상 같은 입력으로 실행된다
+결과 JSON을 저장해두면 청킹/캐시/배치 설정을 바꿨을 때 성능 회귀를 비교할 수 있다
+
+실행: python ragBench.py --files 2 --pages 100 --output bench.json
+      python ragBench.py --stub   (AsyncBatchEmbeddings + ragStubServer로 임베딩 측정)
+'''
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from langchain_core.embeddings import Embeddings
+
+WORDS = ('seoul new york carbon emission green space housing transit climate '
+         'resilience policy plan district energy water waste budget citizen').split()
+
+
+def _pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_synthetic_pdf(path, n_pages, lines_per_page=40, seed=0):
+    '''
+    reportlab 없이 텍스트만 있는 간단한 pdf를 만든다 (Helvetica, ASCII)
+    seed가 같으면 항상 같은 내용 => 벤치마크 입력이 고정된다
+    '''
+    rng = random.Random(seed)
+    objects = []  # 객체 번호는 1부터
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font_id = add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    pages_id = add(None)  # 페이지를 다 만든 뒤 채운다
+    page_ids = []
+    for page in range(n_pages):
+        lines = [' '.join(rng.choice(WORDS) for _ in range(12)) + f' ({page}-{i}).'
+                 for i in range(lines_per_page)]
+        stream = 'BT /F1 10 Tf 14 TL 40 800 Td ' + ' '.join(
+            f'({_pdf_escape(line)}) Tj T*' for line in lines) + ' ET'
+        stream = stream.encode('latin-1')
+        content_id = add(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+        page_ids.append(add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] '
+            b'/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>'
+            % (pages_id, font_id, content_id)))
+    kids = b' '.join(b'%d 0 R' % page_id for page_id in page_ids)
+    objects[pages_id - 1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, n_pages)
+    catalog_id = add(b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % i + body + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, catalog_id, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+class FakeEmbeddings(Embeddings):
+    '''텍스트 해시로 만드는 고정 임베딩 (네트워크 없음, 같은 텍스트 => 같은 벡터)'''
+
+    def __init__(self, dim=256):
+        self.dim = dim
+        self.model = f'fake-{dim}'
+
+    def _embed(self, text):
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        rng = random.Random(digest)
+        return [rng.uniform(-1, 1) for _ in range(self.dim)]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class PrecomputedEmbeddings(Embeddings):
+    '''미리 계산한 벡터를 돌려주기만 하는 임베딩 => upsert 시간만 측정할 때 사용'''
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 2) if seconds > 0 else None
+
+
+def run_benchmark(n_files=2, n_pages=100, chunk_size=1000, chunk_overlap=100,
+                  dim=256, batch_size=256, use_stub=False, stub_latency=0.05,
+                  with_chroma=True, n_queries=200, workdir=None):
+    '''벤치마크를 실행하고 결과 dict를 돌려준다'''
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from ragLoader import load_pdf_cached
+
+    workdir = workdir or tempfile.mkdtemp(prefix='ragbench-')
+    cache_dir = os.path.join(workdir, 'cache')
+    pdf_paths = []
+    for i in range(n_files):
+        path = os.path.join(workdir, f'synthetic_{i}.pdf')
+        write_synthetic_pdf(path, n_pages, seed=i)
+        pdf_paths.append(path)
+    total_pages = n_files * n_pages
+    results = {}
+
+    # 1. 로드: 캐시 없음(실제 파싱) => 캐시 적중
+    pages, seconds = _timed(lambda: [doc for path in pdf_paths
+                                     for doc in load_pdf_cached(path, cache_dir=cache_dir,
+                                                                verbose=False)])
+    results['load_cold'] = {'pages': total_pages, 'seconds': round(seconds, 4),
+                            'pages_per_sec': _rate(total_pages, seconds)}
+    _, seconds = _timed(lambda: [load_pdf_cached(path, cache_dir=cache_dir, verbose=False)
+                                 for path in pdf_paths])
+    results['load_cached'] = {'pages': total_pages, 'seconds': round(seconds, 4),
+                              'pages_per_sec': _rate(total_pages, seconds)}
+
+    # 2. 청킹
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size,
+                                                   chunk_overlap=chunk_overlap)
+    splits, seconds = _timed(lambda: text_splitter.split_documents(pages))
+    results['split'] = {'chunks': len(splits), 'seconds': round(seconds, 4),
+                        'chunks_per_sec': _rate(len(splits), seconds)}
+    texts = [split.page_content for split in splits]
+
+    # 3. 임베딩
+    server = None
+    if use_stub:
+        from ragEmbeddings import AsyncBatchEmbeddings
+        from ragStubServer import start_in_thread
+        server, base_url = start_in_thread(dim=dim, latency=stub_latency)
+        embeddings = AsyncBatchEmbeddings(model='stub', dimensions=dim, api_key='stub',
+                                          base_url=base_url, requests_per_minute=None,
+                                          tokens_per_minute=None)
+    else:
+        embeddings = FakeEmbeddings(dim)
+    vectors, seconds = _timed(lambda: [vector for i in range(0, len(texts), batch_size)
+                                       for vector in embeddings.embed_documents(
+                                           texts[i:i + batch_size])])
+    results['embed'] = {'embeddings': len(vectors), 'seconds': round(seconds, 4),
+                        'embeddings_per_sec': _rate(len(vectors), seconds),
+                        'embedder': type(embeddings).__name__}
+    if server is not None:
+        server.shutdown()
+
+    # 4. Chroma 저장 (임베딩은 미리 계산한 벡터를 돌려주기만 한다)
+    if with_chroma:
+        from langchain_chroma import Chroma
+        vector_store = Chroma(collection_name='bench',
+                              persist_directory=os.path.join(workdir, 'chroma'),
+                              embedding_function=PrecomputedEmbeddings(dict(zip(texts, vectors))))
+
+        def upsert():
+            for i in range(0, len(splits), batch_size):
+                batch = splits[i:i + batch_size]
+                vector_store.add_documents(batch, ids=[str(j) for j in range(i, i + len(batch))])
+
+        _, seconds = _timed(upsert)
+        results['upsert'] = {'chunks': len(splits), 'seconds': round(seconds, 4),
+                             'upserts_per_sec': _rate(len(splits), seconds)}
+
+        # 5. 검색: 같은 벡터로 Chroma와 numpy 인덱스의 top-k 검색 속도 비교
+        from ragVectorIndex import NumpyVectorStore
+        numpy_store = NumpyVectorStore.from_chroma(vector_store,
+                                                   os.path.join(workdir, 'vector_index'))
+        from ragAnnIndex import AnnVectorStore, open_or_build_ann
+        ann_store = AnnVectorStore(open_or_build_ann(os.path.join(workdir, 'ann_index'), vector_store),
+                                   vector_store, vector_store.embeddings)
+        queries = vectors[:n_queries]
+        for name, store in (('query_chroma', vector_store), ('query_numpy', numpy_store),
+                            ('query_ann', ann_store)):
+            _, seconds = _timed(lambda: [store.similarity_search_by_vector(query, k=4)
+                                         for query in queries])
+            results[name] = {'queries': len(queries), 'seconds': round(seconds, 4),
+                             'queries_per_sec': _rate(len(queries), seconds)}
+
+    return {
+        'benchmark': 'rag_ingest',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'params': {'files': n_files, 'pages_per_file': n_pages, 'chunk_size': chunk_size,
+                   'chunk_overlap': chunk_overlap, 'dim': dim, 'batch_size': batch_size,
+                   'stub': use_stub, 'queries': n_queries},
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RAG 인제스트 벤치마크')
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--pages', type=int, default=100, help='파일당 페이지 수')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--chunk-overlap', type=int, default=100)
+    parser.add_argument('--dim', type=int, default=256, help='가짜 임베딩 차원')
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--stub', action='store_true', help='로컬 스텁 서버로 임베딩 측정')
+    parser.add_argument('--no-chroma', action='store_true', help='Chroma 저장/검색 측정 생략')
+    parser.add_argument('--queries', type=int, default=200, help='검색 측정 질의 수')
+    parser.add_argument('--output', help='결과 JSON 저장 경로 (없으면 화면 출력만)')
+    parser.add_argument('--keep', action='store_true', help='작업 디렉터리 남기기')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ragbench-')
+    try:
+        report = run_benchmark(args.files, args.pages, args.chunk_size, args.chunk_overlap,
+                               args.dim, args.batch_size, use_stub=args.stub,
+                               with_chroma=not args.no_chroma, n_queries=args.queries,
+                               workdir=workdir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
@@ -0,0 +1,332 @@
+# ragCache.py
+'''
+검색 결과 캐시
+ragChat.py는 같은 인기 질문이 반복돼도 매번 질의 임베딩 + 벡터 검색을 다시 한다
+CachedRetriever: (정규화한 질문, 인덱스 버전) => 검색된 청크 목록을 메모리에 저장한다
+- LRU: 최대 개수를 넘으면 가장 오래 안 쓴 질문부터 버린다
+- TTL: 저장한 지 ttl초가 지나면 다시 검색한다
+- 인덱스 버전: ragTest.py가 인제스트와 인덱스 빌드를 끝낸 뒤 ./index_version에 기록한다
+  (크로마 청크 ID 집합 + 각 인덱스의 CURRENT 버전) => 다시 인제스트해서 내용이 바뀌면 캐시가 비워진다
+  크로마는 스토어를 열 때와 첫 질의 때 sqlite/세그먼트 파일을 다시 쓰므로
+  파일 크기/수정 시각으로 버전을 만들면 프로세스가 뜰 때마다 캐시가 비워진다
+
+의미 기반 답변 캐시 (SemanticAnswerCache)
+"서울시 온실가스 정책" / "서울의 탄소 감축 계획"처럼 표현만 다른 질문이 많다
+보정된 질문을 임베딩해서, 같은 인덱스 버전에서 코사인 유사도가 threshold 이상인
+이전 질문이 있으면 그 답변을 그대로 스트리밍한다 => LLM 답변 생성을 건너뛴다
+'''
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict, PrivateAttr
+
+from ragIndexDir import current_version
+from ragLoader import _write_json
+
+# ragChat.py가 검색에 쓰는 (크로마 외) 인덱스 디렉터리들
+DEFAULT_INDEX_PATHS = ('./vector_index', './ann_index', './bm25_index')
+DEFAULT_VERSION_FILE = './index_version'
+DEFAULT_ANSWER_CACHE = './data/cache/answers.sqlite3'
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(text):
+    '''캐시 키용 질문 정규화: 유니코드 NFKC, 소문자, 공백 하나로, 끝의 문장부호 제거'''
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip(' ?!.。？！')
+
+
+_versions = {}  # 버전 파일 => (읽은 시각, 버전)
+_versions_lock = threading.Lock()
+
+
+def index_version(path=DEFAULT_VERSION_FILE, max_age=1.0):
+    '''
+    ragTest.py가 기록한 인덱스 버전 (write_index_version, 파일이 없으면 '')
+    질문 하나에 여러 번(리트리버 캐시, 답변 캐시, 리소스 레지스트리) 불리므로
+    max_age초 동안은 읽어둔 값을 돌려준다 (0이면 매번 읽는다)
+    '''
+    now = time.monotonic()
+    with _versions_lock:
+        cached = _versions.get(path)
+    if cached is not None and now - cached[0] < max_age:
+        return cached[1]
+    version = _read_version(path)
+    with _versions_lock:
+        _versions[path] = (now, version)
+    return version
+
+
+def _read_version(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('version', '')
+    except (FileNotFoundError, ValueError):
+        return ''
+
+
+def write_index_version(vector_store, index_paths=DEFAULT_INDEX_PATHS, path=DEFAULT_VERSION_FILE,
+                        page_size=5000):
+    '''
+    인제스트와 인덱스 빌드가 끝난 뒤(ragTest.py) 인덱스 버전을 기록한다 => 버전
+    버전 = 크로마 청크 ID 집합(ID는 내용 해시) + 각 인덱스 디렉터리의 CURRENT
+    내용이 그대로면 파일을 다시 쓰지 않는다 => 바뀐 것이 없으면 캐시/리소스도 그대로
+    '''
+    ids = []
+    offset = 0
+    while True:
+        result = vector_store.get(include=[], limit=page_size, offset=offset)
+        ids.extend(result['ids'])
+        if len(result['ids']) < page_size:
+            break
+        offset += page_size
+    digest = hashlib.sha256()
+    for chunk_id in sorted(ids):
+        digest.update(chunk_id.encode('utf-8') + b'\n')
+    indexes = {index_path: current_version(index_path) for index_path in index_paths}
+    for index_path, version in indexes.items():
+        digest.update(f'{index_path}:{version}\n'.encode('utf-8'))
+    version = digest.hexdigest()
+    if _read_version(path) != version:
+        _write_json(path, {'version': version, 'chunks': len(ids), 'indexes': indexes})
+        logger.info('index version updated: %s (%d chunks)', version[:12], len(ids))
+    with _versions_lock:
+        _versions.pop(path, None)
+    return version
+
+
+class LRUCache:
+    '''
+    LRU + TTL 메모리 캐시 (스레드 안전)
+    - max_items: 최대 항목 수
+    - ttl: 항목 유효 시간(초), None이면 만료 없음
+    '''
+
+    def __init__(self, max_items=256, ttl=600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()  # key => (저장 시각, 값)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (self.ttl is None or time.monotonic() - item[0] < self.ttl):
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._items[key]  # 만료
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class CachedRetriever(BaseRetriever):
+    '''
+    검색 결과를 캐시하는 리트리버
+    - retriever: 실제 리트리버 (RoutedRetriever, HybridRetriever 등)
+    - cache: LRUCache
+    - version_file: ragTest.py가 기록하는 인덱스 버전 파일 (버전이 바뀌면 캐시를 비운다)
+    invoke의 추가 인자(route_text 등)도 키에 포함된다
+    '''
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retriever: BaseRetriever
+    cache: LRUCache = None
+    version_file: str = DEFAULT_VERSION_FILE
+    _version: str = PrivateAttr(default=None)
+
+    def model_post_init(self, context):
+        if self.cache is None:
+            self.cache = LRUCache()
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        version = index_version(self.version_file)
+        if version != self._version:
+            self.cache.clear()
+            self._version = version
+        key = (normalize_query(query),
+               tuple(sorted((k, normalize_query(v) if isinstance(v, str) else repr(v))
+                            for k, v in kwargs.items())))
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = self.retriever.invoke(query, **kwargs)
+            self.cache.put(key, docs)
+        # 호출한 쪽에서 metadata 등을 고쳐도 캐시가 바뀌지 않도록 복사해서 돌려준다
+        return [doc.model_copy(deep=True) for doc in docs]
+
+
+class SemanticAnswerCache:
+    '''
+    보정된 질문의 임베딩으로 이전 답변을 찾는 캐시 (sqlite에 저장, 검색은 메모리 행렬)
+    - embeddings: 질문 임베딩 모델 (CachedEmbeddings면 같은 질문은 API 호출도 없다)
+    - threshold: 이 코사인 유사도 이상이면 같은 질문으로 본다 (높을수록 보수적)
+    - max_items: 인덱스 버전별 최대 저장 개수 (오래된 답변부터 지운다)
+    - version_file: 인덱스 버전 파일 (버전이 바뀌면 이전 답변은 쓰지 않는다)
+    답변은 버전별로 sqlite에 남아서 다시 시작해도, 다른 프로세스에서도 그대로 쓴다
+    예전 버전 답변은 다시 인제스트할 때만 지운다 (ragTest.py => prune_answer_cache)
+    threshold 조정: best_scores에 질문마다 가장 가까운 이전 질문의 유사도가 남으므로
+    hit_rate_at(0.9)처럼 다른 threshold였다면 적중률이 얼마였을지 바로 볼 수 있다
+    키는 질문 하나뿐이고 대화 기록은 들어가지 않는다 => 앞 대화에 따라 답이 달라지는 질문은
+    호출하는 쪽에서 lookup/store를 건너뛴다 (ragAugment.depends_on_history)
+    여러 세션 스레드가 같이 쓴다: 임베딩(네트워크)만 잠금 밖에서 하고
+    버전 확인/다시 읽기/검색/메모리 갱신은 self._lock 안에서 한다
+    '''
+
+    def __init__(self, embeddings, path=DEFAULT_ANSWER_CACHE, threshold=0.92, max_items=2000,
+                 version_file=DEFAULT_VERSION_FILE):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_items = max_items
+        self.version_file = version_file
+        self.hits = 0
+        self.misses = 0
+        self.best_scores = deque(maxlen=1000)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'version TEXT NOT NULL, query TEXT NOT NULL, vector BLOB NOT NULL, '
+            'answer TEXT NOT NULL, created REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS answers_version ON answers (version)')
+        self._conn.commit()
+        self._version = None
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._answers = []
+
+    def _load(self, version):
+        '''
+        버전이 바뀌면 현재 버전 답변만 메모리로 읽는다 (예전 버전 답변은 지우지 않고 읽지만 않는다)
+        self._lock을 잡은 채로 부른다
+        '''
+        if version == self._version:
+            return
+        rows = self._conn.execute(
+            'SELECT vector, answer FROM answers WHERE version = ? ORDER BY id DESC LIMIT ?',
+            (version, self.max_items)).fetchall()
+        self._version = version
+        self._answers = [answer for _, answer in rows]
+        self._vectors = (np.stack([np.frombuffer(blob, dtype=np.float32) for blob, _ in rows])
+                         if rows else np.zeros((0, 0), dtype=np.float32))
+
+    def _embed(self, query):
+        vector = np.asarray(self.embeddings.embed_query(normalize_query(query)), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, query):
+        '''비슷한 이전 질문의 답변 => (답변, 유사도), 없으면 None'''
+        vector = self._embed(query)  # 놓쳐도 store에서 같은 임베딩을 쓴다 (CachedEmbeddings)
+        version = index_version(self.version_file)
+        best = None
+        with self._lock:
+            self._load(version)
+            if len(self._answers):
+                scores = self._vectors @ vector
+                i = int(np.argmax(scores))
+                best = (self._answers[i], float(scores[i]))
+            self.best_scores.append(best[1] if best else -1.0)
+            if best and best[1] >= self.threshold:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if best and best[1] >= self.threshold:
+            logger.info('answer cache hit (score=%.3f): %s', best[1], query)
+            return best
+        logger.info('answer cache miss (best=%.3f): %s', best[1] if best else -1.0, query)
+        return None
+
+    def store(self, query, answer):
+        '''질문과 답변 저장 (같은 인덱스 버전에서만 다시 쓰인다)'''
+        vector = self._embed(query)
+        version = index_version(self.version_file)
+        with self._lock:
+            self._load(version)
+            self._conn.execute(
+                'INSERT INTO answers (version, query, vector, answer, created) VALUES (?, ?, ?, ?, ?)',
+                (version, query, vector.tobytes(), answer, time.time()))
+            # 버전별 max_items개만 남긴다
+            self._conn.execute(
+                'DELETE FROM answers WHERE version = ? AND id NOT IN '
+                '(SELECT id FROM answers WHERE version = ? ORDER BY id DESC LIMIT ?)',
+                (version, version, self.max_items))
+            self._conn.commit()
+            self._answers.insert(0, answer)
+            self._vectors = (np.vstack([vector[None, :], self._vectors])
+                             if len(self._vectors) else vector[None, :])[:self.max_items]
+            del self._answers[self.max_items:]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def hit_rate_at(self, threshold):
+        '''최근 질문들에 threshold를 적용했다면 적중률이 얼마였을지'''
+        if not self.best_scores:
+            return 0.0
+        return sum(score >= threshold for score in self.best_scores) / len(self.best_scores)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 3),
+                'threshold': self.threshold, 'cached_answers': len(self._answers)}
+
+
+def prune_answer_cache(version, path=DEFAULT_ANSWER_CACHE):
+    '''다시 인제스트한 뒤(ragTest.py) version이 아닌 답변을 지운다 => 지운 개수'''
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        deleted = conn.execute('DELETE FROM answers WHERE version != ?', (version,)).rowcount
+        conn.commit()
+    except sqlite3.OperationalError:  # 아직 답변을 하나도 저장하지 않아서 테이블이 없다
+        deleted = 0
+    finally:
+        conn.close()
+    return deleted
+
+
+def stream_text(text, chunk_chars=8, delay=0.0):
+    '''캐시된 답변을 LLM 스트리밍처럼 조금씩 내보낸다 (st.write_stream용)'''
+    for i in range(0, len(text), chunk_chars):
+        yield text[i:i + chunk_chars]
+        if delay:
+            time.sleep(delay)
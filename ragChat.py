@@ -1,5 +1,4 @@
 # ragChat.py
-from langchain_openai import OpenAIEmbeddings
 import os
 from dotenv import load_dotenv
 
@@ -10,72 +9,58 @@ if not api_key:
     raise ValueError('api key 없음') #예외 발생
 
 
-embedding = OpenAIEmbeddings(api_key=api_key,
-                            model='text-embedding-3-large')
-# print('embedding: ',embedding)\
-
-# 크로마 디비
-from langchain_chroma import Chroma
-persist_directory = './chroma_store'
-#처음 만들 때는 Chroma.from_documents(...,embedding,....)
-#기존 만들어진 크로마 로딩시에는 Chroma(...,embedding_function,...)
-vector_store = Chroma(
-    persist_directory = persist_directory,
-    embedding_function = embedding
-)
-print('# 벡터 스토아 로딩 성공###')
-
-# llm 언어 모델
-from langchain_openai import ChatOpenAI
-llm = ChatOpenAI(model = "gpt-4o-mini", api_key = api_key)
-
-# 도큐먼트 체인 생성
-from langchain_classic.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts.chat import SystemMessagePromptTemplate, HumanMessagePromptTemplate
-
-template="사용자 질문에 대해 context에 기반해서 답변하세요\n\n{context}"
-qna_prompt = ChatPromptTemplate([
-    SystemMessagePromptTemplate.from_template(template),
-    MessagesPlaceholder(variable_name = "messages") #대화 히스토리 포함
-])
-
-document_chain = create_stuff_documents_chain(llm,qna_prompt)
-#문서 조각을 하나로 합쳐서 llm의 context에 집어넣고(채우고) 결과를 생성=>문서체인을 만든다
-
-query_augumentation_prompt = ChatPromptTemplate.from_messages([
-    SystemMessagePromptTemplate.from_template("""
-        너는 질문 보정 전문 AI야.
-        이전 대화를 참고해 모호한 질문을 명확히 바꾸는 게 목적이야.
-        대명사나 이, 저, 그와 같은 표현을 명확한 명사로 표현해
-        이전 대화 맥락과 상관없이, 새로운 질문에 대한 대상 도시나 주제를 명확하게 파악하고 보정해. 
-        보정된 질문이 원래 질문의 의도와 다르게 해석되지 않도록 주의해
-                                            
-        **절대로 질문에 대한 답변을 하지 말고, 보정된 질문 문장 하나만 출력해.** 
-        예시: 서울의 녹지 공간 확대 계획은 무엇인가요?                                              
-        """),    
-    #MessagesPlaceholder(variable_name="messages"),
-    # 과거 대화 삽입 (이전 대화가 messages변수에 들어가서 대화의 맥락을 구성)
-
-    HumanMessagePromptTemplate.from_template("{query}")
-    # 새로운 질문 (마지막으로 {query}에 새로운 질문으로 들어감)
-])
-
-
-query_augument_chain = query_augumentation_prompt|llm
-#llm이 모호한 질문을 명확하게 바꿔준다
-
-#리트리버 (검색)
-retriever = vector_store.as_retriever(k=3)
-#k=3: 코사인 유사도를 이용해서 유사한 문서 조각 3개를 가져오도록 설정
+# Streamlit은 메시지를 보낼 때마다 이 스크립트를 처음부터 다시 실행한다
+# 임베딩, 크로마, llm, 문서 체인, 보정 체인, 리트리버는 프로세스에 한 번만 만들어서
+# 모든 세션이 공유한다 (ragResources.py, 주기적으로 상태 확인 + 다시 인제스트하면 새로 연다)
+import logging
+import streamlit as st
+from ragResources import rag_resources
+logging.basicConfig(level = logging.INFO)
+
+# 레지스트리(검색 결과 LRU 캐시가 든 CachedRetriever 포함)는 재실행마다 만들지 않고
+# st.cache_resource로 프로세스에 하나만 둔다
+@st.cache_resource
+def shared_resources(api_key):
+    return rag_resources(api_key)
+
+resources = shared_resources(api_key)
+
+embedding = resources.get('embedding')
+vector_store = resources.get('vector_store')
+document_chain = resources.get('document_chain')
+query_augument_chain = resources.get('query_augument_chain')
+augmenter = resources.get('augmenter')
+retriever = resources.get('retriever')
+answer_cache = resources.get('answer_cache')
+
+# 미리 검색/대화 요약을 돌릴 스레드 풀도 재실행마다 새로 만들지 않고 프로세스에 하나만 둔다
+# (재실행마다 만들면 닫히지 않은 풀과 스레드가 계속 쌓인다)
+from concurrent.futures import ThreadPoolExecutor
+
+@st.cache_resource
+def shared_executor():
+    return ThreadPoolExecutor(max_workers = 4, thread_name_prefix = 'ragChat')
+
+executor = shared_executor()
+
+from ragCache import stream_text
+from ragAugment import depends_on_history
+
+# 파이프라인 모드: 질문 보정(LLM 호출)을 기다리는 동안 원래 질문으로 먼저 검색해두고,
+# 보정된 질문으로 한 번 더 검색해서 두 결과를 RRF로 합친다 (RAG_PIPELINE=0 이면 순차 실행)
+from ragHybrid import fuse_documents
+pipeline_mode = os.getenv('RAG_PIPELINE', '1') == '1'
+
+# document_chain에 넣기 전에 context를 압축한다 (겹친 청크 합치기 + 토큰 예산)
+from ragContext import pack_context
+from ragHistory import HistoryManager
+context_tokens = int(os.getenv('RAG_CONTEXT_TOKENS', 2000))
 
 # retriever: 임베딩 기반으로 관련 문서 k개 찾기               
 # query_augument_chain : 모호한 질문을 명확하고 검색에 적합한 형태로 보정(증강)
 # document_chain: 검색된 문서를 context로 활용해 LLM이 최종 답변 생성 
 
 # 채팅 UI 구현
-import streamlit as st
 from langchain_core.messages import SystemMessage,HumanMessage,AIMessage
 
 st.header("::🐕LangChain Chatbot with RAG::")
@@ -85,6 +70,13 @@ if "messages" not in st.session_state:
         SystemMessage("너는 문서에 기반하여 답변하는 도시정책 전문가야")
     ]
 
+# 대화 히스토리는 토큰 예산 안에서만 넘기고, 밀려난 대화는 요약으로 대신한다
+if "history" not in st.session_state:
+    st.session_state['history'] = HistoryManager(
+        max_tokens = int(os.getenv('RAG_HISTORY_TOKENS', 1500)),
+        # 레지스트리가 llm을 다시 만들면 요약 체인도 바뀌므로 요약할 때마다 가져온다
+        summarizer = lambda: resources.get('history_summarizer'))
+
 # 화면에 메시지 출력
 for msg in st.session_state.messages:
     if isinstance(msg, SystemMessage):
@@ -114,19 +106,43 @@ if prompt := st.chat_input():
     st.session_state.messages.append(HumanMessage(prompt))
     print("User: ", prompt)
 
+    #보정을 기다리는 동안 원래 질문으로 검색을 시작한다 (둘 다 네트워크 대기라 동시에 가능)
+    raw_docs_future = executor.submit(retriever.invoke, prompt) if pipeline_mode else None
+
     #사용자 입력한 질문을 이용해 확장된 질의를 만들자
-    augmented_query = query_augument_chain.invoke({
-        #"messages": st.session_state["messages"],
-        "query":prompt
-    })
+    augmented_query = augmenter.invoke(prompt)
+    #보정이 필요 없는 질문이면 원래 질문이 그대로 돌아온다 (AIMessage)
     print("augmented_query: ",augmented_query)
     st.info(f"검색용 질의문 : {augmented_query}", icon="💡")
 
+    #비슷한 질문에 대한 답변이 캐시에 있으면 그대로 보여주고 끝낸다
+    #앞 대화에 따라 답이 달라지는 질문("그럼 뉴욕은?")은 캐시 키에 대화가 없으므로 쓰지 않는다
+    use_answer_cache = not depends_on_history(prompt, st.session_state.messages)
+    if use_answer_cache and (cached := answer_cache.lookup(augmented_query.content)):
+        answer, score = cached
+        st.caption(f"비슷한 질문의 답변 재사용 (유사도 {score:.3f}, 적중률 {answer_cache.hit_rate:.0%})")
+        result = st.chat_message('assistant').write_stream(stream_text(answer))
+        st.session_state['messages'].append(AIMessage(result))
+        print("answer cache: ", answer_cache.stats())
+        st.stop()
+
     print("="*70)
     print("관련 문서 검색")
     print("="*70)
-    docs = retriever.invoke(f"{prompt}\n{augmented_query}")
+    if augmented_query.content == prompt and raw_docs_future is not None:
+        #보정을 건너뛰었으면 먼저 시작한 검색 결과가 곧 최종 결과
+        docs = raw_docs_future.result()
+        raw_docs_future = None
+    else:
+        #보정을 건너뛰었으면(원래 질문 그대로) 같은 질문을 두 번 붙이지 않는다
+        query = augmented_query.content
+        docs = retriever.invoke(prompt if query == prompt else f"{prompt}\n{query}",
+                                route_text = query)
     #벡터 디비에서 관련 문서 가져옴
+    #augmented_query는 AIMessage => 메타데이터(실행 id 등)가 섞이지 않도록 content만 쓴다
+    if raw_docs_future is not None:
+        #보정된 질문의 결과를 우선하고(가중치 1.0), 원래 질문의 결과(0.5)로 보충한다
+        docs = fuse_documents([docs, raw_docs_future.result()], weights = [1.0, 0.5])
 
     for doc in docs:
         print(doc)
@@ -137,9 +153,19 @@ if prompt := st.chat_input():
             st.write(doc.page_content)
     print("="*70)
 
+    #겹치는 이웃 청크는 하나로 합치고 중복 문장을 빼서 토큰 예산 안으로 줄인다
+    context_docs = pack_context(docs, max_tokens = context_tokens)
+    print(f"context: {sum(len(d.page_content) for d in docs)}자 -> "
+          f"{sum(len(d.page_content) for d in context_docs)}자")
+
     #AI 답변 출력
     with st.spinner(f"AI가 답변을 준비 중입니다...{augmented_query}"):
-        response = get_ai_response(st.session_state.messages, docs)
+        history = st.session_state['history']
+        response = get_ai_response(history.messages_for(st.session_state.messages), context_docs)
         result = st.chat_message('assistant').write_stream(response)
                 #응답을 스트리밍 방식으로 출력
-        st.session_state['messages'].append(AIMessage(result))
\ No newline at end of file
+        st.session_state['messages'].append(AIMessage(result))
+        # 예산 밖으로 밀려난 대화 요약은 답변이 끝난 뒤 백그라운드에서 만든다
+        history.update_summary(st.session_state.messages, executor)
+        if use_answer_cache:
+            answer_cache.store(augmented_query.content, result)
\ No newline at end of file
@@ -0,0 +1,111 @@
+# ragContext.py
+'''
+context 압축 (document_chain에 넣기 전)
+ragTest.py는 청크마다 다음 청크 앞 100자를 붙여서 저장하고, splitter 오버랩도 있어서
+이웃한 청크가 같이 검색되면 같은 문장이 context에 두세 번 들어간다
+create_stuff_documents_chain은 받은 청크를 그대로 이어 붙이므로 프롬프트 토큰만 늘어난다
+
+pack_context
+1) 같은 문서(source)의 청크 중 겹치는 것은 하나로 합친다 (겹친 부분은 한 번만)
+2) 다른 청크에 완전히 들어 있는 청크는 버린다
+3) 검색 순위가 높은 묶음부터 토큰 예산(max_tokens) 안에 들어가는 만큼만 넣는다
+'''
+from langchain_core.documents import Document
+
+from ragEmbeddings import _token_counter
+
+DEFAULT_CONTEXT_TOKENS = 2000
+
+
+def merge_overlapping(a, b, min_overlap=20):
+    '''
+    a 뒤에 b를 이어 붙일 수 있으면 합친 텍스트, 아니면 None
+    b의 앞부분이 a 안에서 시작되고, 그 뒤의 a 내용이 모두 b에 들어 있으면
+    (splitter 오버랩 + 붙여둔 다음 청크 100자) a를 그 위치에서 자르고 b를 잇는다
+    '''
+    if b in a:
+        return a
+    if a in b:
+        return b
+    head = b[:min_overlap]
+    if len(head) < min_overlap:
+        return None
+    pos = a.find(head)
+    while pos != -1:
+        rest = a[pos:]
+        if all(part in b for part in rest.split('\n') if part.strip()):
+            return a[:pos] + b
+        pos = a.find(head, pos + 1)
+    return None
+
+
+class _Block:
+    '''합쳐진 청크 묶음: 텍스트, 대표 metadata, 가장 높은 검색 순위, 포함된 페이지'''
+
+    def __init__(self, doc, rank):
+        self.text = doc.page_content
+        self.metadata = dict(doc.metadata)
+        self.rank = rank
+        self.pages = {doc.metadata.get('page')}
+
+    def absorb(self, other, text):
+        self.text = text
+        self.rank = min(self.rank, other.rank)
+        self.pages |= other.pages
+
+
+def _truncate(text, max_tokens, count_tokens):
+    '''토큰 수가 max_tokens 이하가 되는 가장 긴 앞부분 (글자 위치 이분 탐색)'''
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def pack_context(docs, max_tokens=DEFAULT_CONTEXT_TOKENS, model='gpt-4o-mini', min_overlap=20,
+                 count_tokens=None):
+    '''
+    검색된 청크(순위 순) => 중복을 없애고 합친 Document 리스트 (토큰 예산 이하)
+    - max_tokens: context 전체 토큰 예산
+    - min_overlap: 이 글자 수 이상 겹쳐야 이웃 청크로 보고 합친다
+    - count_tokens: 토큰 카운터 (None이면 model의 tiktoken 인코딩)
+    '''
+    count_tokens = count_tokens or _token_counter(model)
+    blocks = []
+    for rank, doc in enumerate(docs):
+        block = _Block(doc, rank)
+        # 새 청크가 두 묶음을 이어줄 수도 있으므로 더 합칠 게 없을 때까지 반복한다
+        merged = True
+        while merged:
+            merged = False
+            for other in blocks:
+                if other.metadata.get('source') != block.metadata.get('source'):
+                    continue
+                text = (merge_overlapping(other.text, block.text, min_overlap)
+                        or merge_overlapping(block.text, other.text, min_overlap))
+                if text is not None:
+                    blocks.remove(other)
+                    block.absorb(other, text)
+                    merged = True
+                    break
+        blocks.append(block)
+
+    packed = []
+    remaining = max_tokens
+    for block in sorted(blocks, key=lambda block: block.rank):
+        tokens = count_tokens(block.text)
+        text = block.text
+        if tokens > remaining:
+            if remaining < 50:
+                break  # 남은 예산이 너무 작으면 잘린 조각은 넣지 않는다
+            text = _truncate(text, remaining, count_tokens)
+            tokens = remaining
+        remaining -= tokens
+        pages = sorted(page for page in block.pages if page is not None)
+        metadata = dict(block.metadata, **({'page': pages[0], 'pages': pages} if pages else {}))
+        packed.append(Document(page_content=text, metadata=metadata))
+    return packed
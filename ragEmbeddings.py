@@ -0,0 +1,469 @@
+# ragEmbeddings.py
+'''
+임베딩 관련 유틸
+ragTest.py는 다시 빌드할 때마다, ragChat.py는 질문할 때마다 OpenAIEmbeddings를 새로 호출한다
+같은 텍스트라도 매번 네트워크 왕복 + API 비용이 든다
+
+CachedEmbeddings: 디스크(sqlite) 임베딩 캐시
+- 키: (모델명, 차원 수, 텍스트 해시)
+- Chroma.from_documents / add_documents의 embed_documents와
+  retriever.invoke의 embed_query 둘 다 캐시를 거친다
+- 캐시 적중이면 네트워크 없이 로컬에서 바로 벡터를 돌려준다
+'''
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_EMBEDDING_CACHE = './data/cache/embeddings.sqlite3'
+
+logger = logging.getLogger(__name__)
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    다른 임베딩 모델을 감싸서 결과를 sqlite에 저장해두는 임베딩 클래스
+    - embeddings: 실제 임베딩 모델 (OpenAIEmbeddings 등)
+    - path: 캐시 파일 경로
+    - namespace: 캐시 구분자 (기본값: "모델명:차원 수")
+    쿼리와 문서를 같은 방식으로 임베딩하는 모델(OpenAI 등)을 전제로
+    embed_query와 embed_documents가 같은 캐시를 공유한다
+    '''
+
+    def __init__(self, embeddings, path=DEFAULT_EMBEDDING_CACHE, namespace=None):
+        self.embeddings = embeddings
+        if namespace is None:
+            model = getattr(embeddings, 'model', type(embeddings).__name__)
+            namespace = f'{model}:{getattr(embeddings, "dimensions", None)}'
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Streamlit은 여러 스레드에서 호출하므로 연결 하나를 락으로 보호해서 공유한다
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')  # 여러 프로세스가 동시에 읽기/쓰기
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+        self._conn.commit()
+
+    def _key(self, text):
+        h = hashlib.sha256(self.namespace.encode('utf-8'))
+        h.update(b'\0')
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def _get_many(self, keys):
+        found = {}
+        with self._lock:
+            # sqlite 변수 개수 제한 때문에 나눠서 조회한다
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(part))})',
+                    part).fetchall()
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+        return found
+
+    def _put_many(self, items):
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)',
+                [(key, array('f', vector).tobytes()) for key, vector in items])
+            self._conn.commit()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._get_many(list(set(keys)))
+
+        # 캐시에 없는 텍스트만 (중복 제거해서) 실제 모델로 임베딩한다
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._put_many(new_items)
+            found.update(new_items)
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        return [list(found[key]) for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        found = self._get_many([key])
+        if key in found:
+            self.hits += 1
+            return found[key]
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self._put_many([(key, vector)])
+        return vector
+
+    def close(self):
+        '''감싼 모델(close()가 있으면)과 캐시 연결을 닫는다'''
+        if callable(getattr(self.embeddings, 'close', None)):
+            self.embeddings.close()
+        with self._lock:
+            self._conn.close()
+
+
+def cached_openai_embeddings(model='text-embedding-3-large', api_key=None, dimensions=None,
+                             cache_path=DEFAULT_EMBEDDING_CACHE, **kwargs):
+    '''OpenAIEmbeddings를 디스크 캐시로 감싸서 돌려준다'''
+    from langchain_openai import OpenAIEmbeddings
+
+    embeddings = OpenAIEmbeddings(model=model, api_key=api_key, dimensions=dimensions, **kwargs)
+    return CachedEmbeddings(embeddings, path=cache_path)
+
+
+# =========================================================================
+# 동시(비동기) 배치 임베딩
+# Chroma.from_documents / add_documents는 embed_documents를 순차적으로 호출하므로
+# 인제스트 속도가 "요청 1번의 지연 시간"에 묶인다
+# AsyncBatchEmbeddings는
+# 1) 청크를 토큰 수 기준으로 배치에 채워 넣고
+# 2) asyncio로 여러 배치를 동시에 요청하되 토큰 버킷으로 분당 요청수/토큰수를 지키고
+# 3) 실패한 배치만 다시 시도한다
+# =========================================================================
+class TokenBucket:
+    '''
+    분당 허용량(rate_per_minute)을 지키는 토큰 버킷
+    acquire(n)은 먼저 n을 예약(잔량이 음수가 될 수 있음)하고, 모자란 만큼 비동기로 기다린다
+    => 요청 순서대로 공평하게 기다리고, 여러 번의 embed_documents 호출에 걸쳐 한도가 유지된다
+    '''
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        '''n만큼 예약하고 기다려야 할 시간(초)을 돌려준다'''
+        # 한 번에 capacity보다 많이 요청해도 언젠가는 통과하도록 capacity로 자른다
+        n = min(n, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    async def acquire(self, n=1):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_token_fallback_warned = False
+
+
+def _token_counter(model):
+    '''모델에 맞는 토큰 카운터 (tiktoken이 없으면 글자 수로 넉넉하게 잡는다)'''
+    global _token_fallback_warned
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as ex:
+        # 글자 수는 토큰 수보다 크게 잡히므로 배치가 작아지고 TPM 한도도 일찍 찬다 => 한 번은 알린다
+        if not _token_fallback_warned:
+            _token_fallback_warned = True
+            logger.warning('tiktoken unavailable for %s (%s); counting characters instead of tokens',
+                           model, ex)
+        return len
+
+
+class AsyncBatchEmbeddings(Embeddings):
+    '''
+    OpenAI 임베딩 API를 토큰 기준 배치 + 동시 요청 + 속도 제한으로 호출하는 임베딩 클래스
+    - model, dimensions, api_key, base_url: OpenAI 클라이언트 설정
+      (base_url을 로컬 스텁 서버로 주면 오프라인으로 테스트할 수 있다 => ragStubServer.py)
+    - max_batch_tokens, max_batch_size: 요청 하나에 넣을 최대 토큰 수 / 텍스트 수
+    - max_concurrency: 동시에 보낼 최대 요청 수
+    - requests_per_minute, tokens_per_minute: 계정의 속도 제한 (None이면 제한 없음)
+    - max_retries: 배치 하나당 최대 재시도 횟수 (지수 백오프)
+    '''
+
+    def __init__(self, model='text-embedding-3-large', dimensions=None, api_key=None,
+                 base_url=None, max_batch_tokens=50_000, max_batch_size=512,
+                 max_concurrency=8, requests_per_minute=3_000,
+                 tokens_per_minute=1_000_000, max_retries=6, timeout=60):
+        self.model = model
+        self.dimensions = dimensions
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.count_tokens = _token_counter(model)
+        self.stats = {'requests': 0, 'retries': 0, 'tokens': 0}
+        # 버킷은 인스턴스에 두어서 add_documents 배치가 여러 번 호출되어도 한도를 공유한다
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def make_batches(self, texts):
+        '''텍스트 인덱스를 토큰 수 기준으로 배치에 채운다 => [(인덱스 리스트, 토큰 수), ...]'''
+        batches = []
+        indices, tokens = [], 0
+        for i, text in enumerate(texts):
+            n = self.count_tokens(text)
+            if indices and (tokens + n > self.max_batch_tokens
+                            or len(indices) >= self.max_batch_size):
+                batches.append((indices, tokens))
+                indices, tokens = [], 0
+            indices.append(i)
+            tokens += n
+        if indices:
+            batches.append((indices, tokens))
+        return batches
+
+    async def _embed_batch(self, client, texts, tokens, semaphore):
+        import openai
+
+        kwargs = {'model': self.model, 'input': texts, 'encoding_format': 'float'}
+        if self.dimensions is not None:
+            kwargs['dimensions'] = self.dimensions
+        for attempt in range(self.max_retries + 1):
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(tokens)
+            try:
+                async with semaphore:
+                    self.stats['requests'] += 1
+                    response = await client.embeddings.create(**kwargs)
+                self.stats['tokens'] += tokens
+                return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+            except (openai.RateLimitError, openai.APIConnectionError,
+                    openai.APITimeoutError, openai.InternalServerError) as ex:
+                if attempt == self.max_retries:
+                    raise
+                # 실패한 배치만 기다렸다가 다시 보낸다 (다른 배치는 계속 진행)
+                self.stats['retries'] += 1
+                delay = min(60, 0.5 * 2 ** attempt) * (0.5 + random.random())
+                logger.warning('embedding batch failed (%s), retry in %.1fs', ex, delay)
+                await asyncio.sleep(delay)
+
+    async def aembed_documents(self, texts):
+        import openai
+
+        if not texts:
+            return []
+        # 클라이언트 자체 재시도는 끄고 배치 단위 재시도만 사용한다
+        client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                    max_retries=0, timeout=self.timeout)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        batches = self.make_batches(texts)
+        tasks = [asyncio.ensure_future(
+                     self._embed_batch(client, [texts[i] for i in indices], tokens, semaphore))
+                 for indices, tokens in batches]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # 배치 하나가 재시도를 다 쓰고 실패하면 나머지 배치도 취소한다
+            # (닫히는 클라이언트로 요청을 계속 보내지 않도록 클라이언트를 닫기 전에 끝낸다)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            await client.close()
+
+        vectors = [None] * len(texts)
+        for (indices, _), batch_vectors in zip(batches, results):
+            for i, vector in zip(indices, batch_vectors):
+                vectors[i] = vector
+        return vectors
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+    def embed_documents(self, texts):
+        return _run_sync(self.aembed_documents(texts))
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _run_sync(coro):
+    '''동기 코드에서 코루틴 실행 (이미 이벤트 루프가 돌고 있으면 별도 스레드에서 실행)'''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    result = {}
+
+    def run():
+        try:
+            result['value'] = asyncio.run(coro)
+        except BaseException as ex:
+            result['error'] = ex
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+# =========================================================================
+# 질문 임베딩 마이크로 배치
+# 동시 사용자가 많으면 retriever.invoke마다 텍스트 1개짜리 embed_query 요청이 따로 나간다
+# => 요청 수만큼 네트워크 왕복 + 분당 요청 수(RPM) 제한에 먼저 걸린다
+# MicroBatchEmbeddings는 짧은 시간(window, 기본 5ms) 안에 들어온 질문을 모아
+# embed_documents 한 번으로 보내고 결과를 각 호출자에게 나눠준다
+# 추가 지연 시간은 최대 window (배치가 max_batch개로 차면 바로 보낸다)
+# =========================================================================
+class _PendingQuery:
+    __slots__ = ('text', 'done', 'vector', 'error', 'queued')
+
+    def __init__(self, text):
+        self.text = text
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+        self.queued = time.perf_counter()
+
+
+def _fail(batch, error):
+    for pending in batch:
+        pending.error = error
+        pending.done.set()
+
+
+class MicroBatchEmbeddings(Embeddings):
+    '''
+    embed_query를 여러 스레드에서 동시에 부르면 모아서 한 번에 임베딩하는 임베딩 클래스
+    - embeddings: 실제 임베딩 모델 (쿼리와 문서를 같은 방식으로 임베딩하는 모델, OpenAI 등)
+    - window: 첫 질문이 들어온 뒤 다른 질문을 기다리는 최대 시간(초)
+    - max_batch: 배치 최대 크기
+    - max_inflight: 동시에 보내는 배치 수 (앞 배치를 기다리는 동안 다음 배치를 모은다)
+    - timeout: embed_query가 결과를 기다리는 최대 시간(초), 넘으면 TimeoutError
+    embed_documents(인제스트)는 이미 배치이므로 그대로 넘긴다
+    다 쓰면 close()로 모으기 스레드와 전송 스레드 풀을 멈춘다 (ragResources 레지스트리가 다시 만들 때 부른다)
+    '''
+
+    def __init__(self, embeddings, window=0.005, max_batch=64, max_inflight=4, timeout=60.0):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.embeddings = embeddings
+        # CachedEmbeddings로 감쌀 때 캐시 namespace가 바뀌지 않도록 모델 정보를 그대로 노출한다
+        self.model = getattr(embeddings, 'model', type(embeddings).__name__)
+        self.dimensions = getattr(embeddings, 'dimensions', None)
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._queue = []
+        self._worker = None
+        self._closed = False
+        self._senders = ThreadPoolExecutor(max_workers=max_inflight)
+        self.queries = 0
+        self.batches = 0
+        self.wait_seconds = 0.0
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        pending = _PendingQuery(text)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('MicroBatchEmbeddings is closed')
+            self._queue.append(pending)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._collect, daemon=True)
+                self._worker.start()
+            self._cond.notify()
+        if not pending.done.wait(self.timeout):
+            raise TimeoutError(f'query embedding did not finish in {self.timeout}s')
+        if pending.error is not None:
+            raise pending.error
+        return list(pending.vector)
+
+    def _collect(self):
+        '''배치 모으기 스레드: 첫 질문이 오면 window 동안(또는 max_batch개가 찰 때까지) 기다렸다가 보낸다'''
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                deadline = time.monotonic() + self.window
+                while len(self._queue) < self.max_batch and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+            try:
+                self._senders.submit(self._send, batch)
+            except RuntimeError as e:  # close()가 전송 스레드 풀을 먼저 닫았다
+                _fail(batch, e)
+                return
+
+    def _send(self, batch):
+        vectors = {}
+        error = None
+        try:
+            texts = list(dict.fromkeys(pending.text for pending in batch))  # 같은 질문은 한 번만
+            result = self.embeddings.embed_documents(texts)
+            if len(result) != len(texts):
+                raise ValueError(f'expected {len(texts)} embeddings, got {len(result)}')
+            vectors = dict(zip(texts, result))
+            now = time.perf_counter()
+            with self._cond:
+                self.queries += len(batch)
+                self.batches += 1
+                self.wait_seconds += sum(now - pending.queued for pending in batch)
+            logger.debug('embedded %d queries in one request', len(texts))
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 무슨 일이 있어도 기다리는 호출자를 모두 깨운다 (안 깨우면 embed_query가 멈춘다)
+            for pending in batch:
+                pending.vector = vectors.get(pending.text)
+                if pending.vector is None:
+                    pending.error = error or RuntimeError('query embedding was not produced')
+                pending.done.set()
+
+    def close(self):
+        '''모으기 스레드와 전송 스레드 풀을 멈춘다 (아직 보내지 않은 질문은 오류로 깨운다)'''
+        with self._cond:
+            self._closed = True
+            batch, self._queue = self._queue, []
+            self._cond.notify_all()
+        _fail(batch, RuntimeError('MicroBatchEmbeddings is closed'))
+        self._senders.shutdown(wait=False)
+
+    def stats(self):
+        '''질문 수, 실제 요청(배치) 수, 평균 배치 크기, 평균 대기+요청 시간(ms)'''
+        with self._cond:
+            return {'queries': self.queries, 'requests': self.batches,
+                    'avg_batch': round(self.queries / self.batches, 2) if self.batches else 0.0,
+                    'avg_latency_ms': round(1000 * self.wait_seconds / self.queries, 1)
+                    if self.queries else 0.0}
@@ -0,0 +1,149 @@
+# ragHistory.py
+'''
+토큰 예산 대화 히스토리
+ragChat.py는 매 턴마다 st.session_state.messages 전체를 document_chain에 넘긴다
+=> 대화가 길어질수록 프롬프트 토큰, 지연 시간, 비용이 끝없이 늘어난다
+
+HistoryManager
+- 메시지마다 토큰 수를 한 번만 세서 기록해둔다 (running count)
+- 시스템 메시지 + 최근 대화를 예산(max_tokens) 안에서 최신순으로 남긴다
+- 예산 밖으로 밀려난 예전 대화는 summarizer(llm)가 있으면 요약 한 개로 대신한다
+  요약은 답변이 끝난 뒤 백그라운드에서 만들어두므로 다음 턴의 지연 시간에는 들어가지 않는다
+'''
+import logging
+import threading
+
+from langchain_core.messages import SystemMessage
+
+from ragEmbeddings import _token_counter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_TOKENS = 1500
+# 메시지 하나당 역할/구분자 등 형식에 들어가는 토큰 (OpenAI chat 형식 기준 대략 4)
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = '이전 대화 요약:\n'
+
+
+def make_summarizer(llm):
+    '''예전 대화를 요약하는 체인 (입력: previous_summary, conversation)'''
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
+    prompt = ChatPromptTemplate.from_messages([
+        ('system', '너는 대화 요약 도우미야. 이전 요약과 새 대화를 합쳐서, 이후 질문에 답할 때 '
+                   '필요한 사실(도시, 정책, 수치, 사용자의 관심사)만 5문장 이내로 요약해.'),
+        ('human', '이전 요약:\n{previous_summary}\n\n새 대화:\n{conversation}'),
+    ])
+    return prompt | llm | StrOutputParser()
+
+
+class HistoryManager:
+    '''
+    세션 하나의 대화 히스토리 관리 (st.session_state에 하나씩 둔다)
+    - max_tokens: document_chain에 넘길 히스토리 토큰 예산 (검색 context 예산과 별도)
+    - summarizer: make_summarizer(llm) 또는 그 체인을 돌려주는 함수, None이면 밀려난 대화는 그냥 버린다
+      세션보다 오래 사는 리소스(레지스트리가 llm을 다시 만들 수 있음)는 함수로 넘겨서 쓸 때마다 가져온다
+    - model: 토큰 카운터 모델
+    요약이 있으면 예산 밖으로 밀려난 대화도 요약이 따라올 때까지는 빼지 않는다
+    (요약 중이거나 이번 턴에 막 밀려난 대화가 요약에도 창에도 없이 사라지지 않도록)
+    '''
+
+    def __init__(self, max_tokens=DEFAULT_HISTORY_TOKENS, summarizer=None, model='gpt-4o-mini',
+                 count_tokens=None):
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        self.count_tokens = count_tokens or _token_counter(model)
+        self.counts = []          # messages[i]의 토큰 수
+        self.summary = ''         # messages[:summarized]의 요약
+        self.summarized = 0
+        self._lock = threading.Lock()
+        self._pending = None      # 진행 중인 요약 작업 (Future)
+        self._failed = False      # 마지막 요약이 실패했으면 예산대로 자른다 (프롬프트가 끝없이 늘지 않도록)
+
+    def _update_counts(self, messages):
+        # 메시지는 뒤에만 추가되므로 새로 들어온 메시지만 센다
+        for message in messages[len(self.counts):]:
+            self.counts.append(self.count_tokens(str(message.content)) + MESSAGE_OVERHEAD_TOKENS)
+
+    def _split(self, messages):
+        '''(시스템 메시지, 예산 안에 남는 최근 메시지 시작 위치)'''
+        self._update_counts(messages)
+        system = [m for m in messages if isinstance(m, SystemMessage)]
+        budget = self.max_tokens - sum(self.counts[i] for i, m in enumerate(messages)
+                                       if isinstance(m, SystemMessage))
+        with self._lock:
+            if self.summary:
+                budget -= self.count_tokens(SUMMARY_PREFIX + self.summary) + MESSAGE_OVERHEAD_TOKENS
+        start = len(messages)
+        # 마지막 메시지(지금 질문)는 예산을 넘어도 항상 넣는다
+        while start > 0:
+            i = start - 1
+            if isinstance(messages[i], SystemMessage):
+                start -= 1
+                continue
+            if self.counts[i] > budget and start < len(messages):
+                break
+            budget -= self.counts[i]
+            start -= 1
+        return system, start
+
+    def messages_for(self, messages):
+        '''document_chain에 넘길 메시지: 시스템 메시지 + (요약) + 예산 안의 최근 대화'''
+        system, start = self._split(messages)
+        with self._lock:
+            summary = self.summary if self.summarized > 0 else ''
+            if self.summarizer is not None and not self._failed:
+                # 요약된 대화는 다시 넣지 않고, 아직 요약되지 않은 대화는 예산을 넘어도 모두 넣는다
+                start = min(self.summarized, len(messages) - 1)
+            elif summary:
+                start = max(start, min(self.summarized, len(messages) - 1))
+        recent = [m for m in messages[start:] if not isinstance(m, SystemMessage)]
+        if summary:
+            system = system + [SystemMessage(SUMMARY_PREFIX + summary)]
+        return system + recent
+
+    def tokens(self, messages):
+        '''messages_for 결과의 대략적인 토큰 수'''
+        return sum(self.count_tokens(str(m.content)) + MESSAGE_OVERHEAD_TOKENS
+                   for m in self.messages_for(messages))
+
+    def _summarize(self, dropped, end):
+        conversation = '\n'.join(f'{type(m).__name__.replace("Message", "")}: {m.content}'
+                                 for m in dropped)
+        with self._lock:
+            previous = self.summary
+        summarizer = self.summarizer if hasattr(self.summarizer, 'invoke') else self.summarizer()
+        try:
+            summary = summarizer.invoke({'previous_summary': previous or '(없음)',
+                                         'conversation': conversation})
+        except Exception:
+            logger.exception('history summary failed; trimming to the token budget')
+            with self._lock:
+                self._failed = True
+            raise
+        with self._lock:
+            self.summary = summary
+            self.summarized = end
+            self._failed = False
+        logger.info('history summarized up to message %d (%d tokens)', end,
+                    self.count_tokens(summary))
+
+    def update_summary(self, messages, executor=None):
+        '''
+        예산 밖으로 밀려났는데 아직 요약되지 않은 대화가 있으면 요약을 갱신한다
+        executor를 주면 백그라운드에서 실행 (답변 스트리밍이 끝난 뒤 호출)
+        '''
+        if self.summarizer is None:
+            return
+        _, start = self._split(messages)
+        with self._lock:
+            if start <= self.summarized or (self._pending is not None and not self._pending.done()):
+                return
+            dropped = [m for m in messages[self.summarized:start] if not isinstance(m, SystemMessage)]
+        if not dropped:
+            return
+        if executor is None:
+            self._summarize(dropped, start)
+        else:
+            self._pending = executor.submit(self._summarize, dropped, start)
@@ -0,0 +1,252 @@
+# ragHybrid.py
+'''
+하이브리드 검색: BM25(키워드) + 벡터(의미) 검색을 RRF로 합친다
+"뉴욕의 온실가스 저감 정책"처럼 정확한 용어가 들어간 질문은
+벡터 검색만으로는 놓치는 청크가 있어서 k를 키워야 했다 => context가 길어지고 비용 증가
+키워드 검색 결과를 같이 쓰면 작은 k에서도 정확한 청크가 위로 올라온다
+
+- tokenize: 한글은 2글자 n-gram, 영문/숫자는 단어 단위
+  (조사가 붙은 "뉴욕의"도 "뉴욕" n-gram으로 찾을 수 있다)
+- BM25Index: 인제스트할 때(ragTest.py) 만들어두는 역색인 (./bm25_index)
+- HybridRetriever: 벡터 검색 순위와 BM25 순위를 reciprocal rank fusion으로 합친다
+  RRF 점수 = sum(1 / (rrf_k + 순위)) => 점수 크기가 다른 두 검색을 순위만으로 합칠 수 있다
+'''
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from pydantic import ConfigDict
+
+from ragIndexDir import abort_version, begin_version, current_dir, publish_version
+from ragLoader import _write_json
+from ragRouter import filter_sources
+
+BM25_VERSION = 2
+# CURRENT 포인터 이전 형식에서 path에 바로 쓰던 파일들 (새 버전을 만들면 지운다)
+LEGACY_FILES = ('meta.json', 'terms.json', 'ids.txt', 'offsets.npy', 'postings.npy', 'tfs.npy',
+                'lengths.npy', 'source_codes.npy', 'sources.json')
+_WORD = re.compile(r'[0-9a-z]+|[가-힣]+')
+
+
+def tokenize(text, n=2):
+    '''검색어 토큰: 한글 단어 => n글자 n-gram, 영문/숫자 => 단어 그대로 (소문자)'''
+    terms = []
+    for word in _WORD.findall(text.lower()):
+        if '가' <= word[0] <= '힣' and len(word) > n:
+            terms.extend(word[i:i + n] for i in range(len(word) - n + 1))
+        else:
+            terms.append(word)
+    return terms
+
+
+def _fingerprint(ids):
+    # 청크 ID는 내용 해시이므로 ID 집합이 같으면 색인할 내용도 같다
+    digest = hashlib.sha256()
+    for chunk_id in sorted(ids):
+        digest.update(chunk_id.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+class BM25Index:
+    '''
+    디스크에 저장되는 BM25 역색인 (path/CURRENT가 가리키는 버전 디렉터리 안, ragIndexDir 참고)
+    build는 새 버전 디렉터리에 전부 쓴 다음 CURRENT를 바꾼다
+    => 다시 만드는 중에 여는 쪽도 항상 완성된 한 버전의 파일만 읽는다
+    - terms.json   : 용어 목록 (정렬)
+    - offsets.npy  : 용어별 posting 시작 위치 (len = 용어 수 + 1)
+    - postings.npy : 청크 번호 (용어 순서로 이어 붙임)
+    - tfs.npy      : 청크 안에서 용어 빈도
+    - lengths.npy  : 청크별 토큰 수
+    - ids.txt      : 청크 번호 => 청크 ID
+    - sources.json / source_codes.npy : 청크별 source (파티션 검색용, 코드 배열)
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = directory = current_dir(path)
+        if directory is None:
+            raise FileNotFoundError(f'no BM25 index in {path}')
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, 'terms.json'), 'r', encoding='utf-8') as f:
+            self.terms = {term: i for i, term in enumerate(json.load(f))}
+        with open(os.path.join(directory, 'ids.txt'), 'r', encoding='utf-8') as f:
+            self.ids = f.read().splitlines()
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self.postings = np.load(os.path.join(directory, 'postings.npy'))
+        self.tfs = np.load(os.path.join(directory, 'tfs.npy'))
+        self.lengths = np.load(os.path.join(directory, 'lengths.npy'))
+        with open(os.path.join(directory, 'sources.json'), 'r', encoding='utf-8') as f:
+            self.source_values = json.load(f)
+        self.source_codes = np.load(os.path.join(directory, 'source_codes.npy'))
+        self.k1 = self.meta['k1']
+        self.b = self.meta['b']
+        self.ngram = self.meta['ngram']
+        self.avg_length = float(self.lengths.mean()) if len(self.lengths) else 1.0
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, path, ids, texts, sources=None, k1=1.2, b=0.75, ngram=2):
+        '''(청크 ID, 텍스트, source)로 역색인을 만든다'''
+        ids = list(ids)
+        sources = list(sources) if sources is not None else [''] * len(ids)
+        source_values = sorted(set(sources))
+        code_of = {source: code for code, source in enumerate(source_values)}
+        postings = {}
+        lengths = []
+        for row, text in enumerate(texts):
+            terms = tokenize(text, ngram)
+            lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings.setdefault(term, []).append((row, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        rows = np.fromiter((row for term in terms for row, _ in postings[term]),
+                           dtype=np.int32, count=int(offsets[-1]))
+        tfs = np.fromiter((tf for term in terms for _, tf in postings[term]),
+                          dtype=np.float32, count=int(offsets[-1]))
+
+        # ragChat.py/ragServer.py가 지금 버전을 읽고 있을 수 있으므로 제자리에서 다시 쓰지 않는다
+        tmp_dir = begin_version(path)
+        try:
+            with open(os.path.join(tmp_dir, 'terms.json'), 'w', encoding='utf-8') as f:
+                json.dump(terms, f, ensure_ascii=False)
+            with open(os.path.join(tmp_dir, 'ids.txt'), 'w', encoding='utf-8') as f:
+                f.write(''.join(f'{chunk_id}\n' for chunk_id in ids))
+            np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+            np.save(os.path.join(tmp_dir, 'postings.npy'), rows)
+            np.save(os.path.join(tmp_dir, 'tfs.npy'), tfs)
+            np.save(os.path.join(tmp_dir, 'lengths.npy'), np.asarray(lengths, dtype=np.float32))
+            np.save(os.path.join(tmp_dir, 'source_codes.npy'),
+                    np.asarray([code_of[source] for source in sources], dtype=np.int32))
+            with open(os.path.join(tmp_dir, 'sources.json'), 'w', encoding='utf-8') as f:
+                json.dump(source_values, f, ensure_ascii=False)
+            _write_json(os.path.join(tmp_dir, 'meta.json'), {
+                'version': BM25_VERSION, 'count': len(ids), 'k1': k1, 'b': b,
+                'ngram': ngram, 'fingerprint': _fingerprint(ids)})
+        except BaseException:
+            abort_version(tmp_dir)
+            raise
+        publish_version(path, tmp_dir, legacy=LEGACY_FILES)
+        return cls(path)
+
+    def search(self, query, k=20, sources=None):
+        '''
+        BM25 상위 k개 => [(청크 ID, 점수), ...] (질의 용어가 하나도 없는 청크는 제외)
+        - sources: 이 source의 청크만 검색
+        '''
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        n = len(self.ids)
+        for term in set(tokenize(query, self.ngram)):
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            rows, tf = self.postings[start:end], self.tfs[start:end]
+            idf = math.log(1 + (n - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[rows] / self.avg_length)
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm)
+        if sources is not None:
+            codes = [code for code, source in enumerate(self.source_values) if source in sources]
+            scores[~np.isin(self.source_codes, codes)] = 0
+        matched = np.nonzero(scores)[0]
+        if not len(matched):
+            return []
+        k = min(k, len(matched))
+        top = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top]
+
+
+def build_bm25_from_chroma(vector_store, path='./bm25_index', page_size=5000, **kwargs):
+    '''chroma_store의 청크로 BM25 역색인을 만든다 (청크 ID 집합이 그대로면 건너뜀)'''
+    ids, texts, sources = [], [], []
+    offset = 0
+    while True:
+        result = vector_store.get(include=['documents', 'metadatas'], limit=page_size,
+                                  offset=offset)
+        ids.extend(result['ids'])
+        texts.extend(result['documents'])
+        sources.extend((metadata or {}).get('source', '') for metadata in result['metadatas'])
+        if len(result['ids']) < page_size:
+            break
+        offset += page_size
+    directory = current_dir(path)
+    meta_path = os.path.join(directory, 'meta.json') if directory is not None else None
+    if meta_path is not None and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') == BM25_VERSION and meta.get('fingerprint') == _fingerprint(ids):
+            return BM25Index(path)
+    return BM25Index.build(path, ids, texts, sources, **kwargs)
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=60, weights=None):
+    '''여러 검색의 ID 순위 리스트 => [(ID, RRF 점수), ...] 점수 내림차순'''
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+def fuse_documents(doc_lists, k=None, rrf_k=60, weights=None):
+    '''
+    여러 검색 결과(Document 리스트)를 RRF로 합친다 (같은 청크는 하나로)
+    - k: 결과 개수 (None이면 가장 긴 리스트 길이 => 합쳐도 context 크기는 그대로)
+    '''
+    docs = {}
+    rankings = []
+    for doc_list in doc_lists:
+        ranking = []
+        for doc in doc_list:
+            key = doc.id or doc.page_content  # ID가 없는 스토어는 내용으로 같은 청크를 찾는다
+            docs.setdefault(key, doc)
+            ranking.append(key)
+        rankings.append(ranking)
+    k = k if k is not None else max((len(doc_list) for doc_list in doc_lists), default=0)
+    return [docs[key] for key, _ in reciprocal_rank_fusion(rankings, rrf_k, weights)[:k]]
+
+
+class HybridRetriever(BaseRetriever):
+    '''
+    벡터 검색 + BM25 검색 => RRF => 상위 k개 청크
+    - vector_store: 벡터 검색 및 ID로 청크를 가져올 스토어 (get_by_ids 필요)
+    - keyword_index: BM25Index
+    - fetch_k: 각 검색에서 가져올 후보 수
+    - weights: (벡터, BM25) 가중치
+    '''
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vector_store: VectorStore
+    keyword_index: BM25Index
+    k: int = 3
+    fetch_k: int = 20
+    rrf_k: int = 60
+    weights: tuple = (1.0, 1.0)
+
+    def _get_relevant_documents(self, query, *, run_manager=None, filter=None):
+        # filter: 크로마 메타데이터 필터 (RoutedRetriever가 source 파티션을 넘겨준다)
+        search_kwargs = {'filter': filter} if filter else {}
+        dense = self.vector_store.similarity_search(query, k=self.fetch_k, **search_kwargs)
+        keyword = [chunk_id for chunk_id, _ in
+                   self.keyword_index.search(query, self.fetch_k, filter_sources(filter))]
+        docs = {doc.id: doc for doc in dense if doc.id}
+        fused = reciprocal_rank_fusion([[doc.id for doc in dense], keyword],
+                                       self.rrf_k, list(self.weights))[:self.k]
+        missing = [chunk_id for chunk_id, _ in fused if chunk_id not in docs]
+        if missing:
+            # BM25로만 찾은 청크는 스토어에서 ID로 가져온다
+            docs.update((doc.id, doc) for doc in self.vector_store.get_by_ids(missing))
+        return [docs[chunk_id] for chunk_id, _ in fused if chunk_id in docs]
@@ -0,0 +1,100 @@
+# ragIndexDir.py
+'''
+인덱스 디렉터리 원자적 교체 (버전 디렉터리 + 포인터 파일)
+ragTest.py는 실행할 때마다 ./vector_index, ./ann_index를 다시 만드는데
+Streamlit/ragServer 프로세스는 같은 .npy/.f32 파일을 mmap으로 열어둔 채로 검색한다
+=> 파일을 제자리에서 잘라 다시 쓰면(np.save, tofile) 읽는 쪽이 SIGBUS로 죽거나
+   반쯤 쓴 벡터를 읽고, ids와 행이 서로 맞지 않을 수 있다
+
+디렉터리 구조
+- path/CURRENT   : 지금 쓰는 버전 디렉터리 이름 (한 줄)
+- path/v-.../    : 버전 디렉터리 (다 만든 뒤에는 고치지 않는다)
+새 인덱스는 path/.tmp-... 에 전부 쓴 다음 버전 디렉터리로 rename하고,
+마지막에 CURRENT를 os.replace로 바꾼다 => 읽는 쪽은 항상 완성된 버전 하나만 본다
+이미 열려 있는 mmap은 예전 버전 파일을 계속 가리키므로 안전하다 (리눅스/맥은 지워도 유지됨)
+ragTest.py가 기록하는 인덱스 버전(ragCache.write_index_version)에 CURRENT가 들어가므로
+새 버전을 만들면 공유 리소스(ragResources)와 캐시도 다시 연다
+'''
+import os
+import re
+import shutil
+import tempfile
+import time
+
+CURRENT_FILE = 'CURRENT'
+_VERSION_NAME = re.compile(r'^v-\d+-\d+$')
+
+
+def current_version(path):
+    '''CURRENT에 적힌 버전 이름 (없으면 None)'''
+    try:
+        with open(os.path.join(path, CURRENT_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def current_dir(path, marker='meta.json'):
+    '''
+    지금 버전 디렉터리 경로
+    CURRENT가 없고 예전 형식(path에 바로 marker 파일)이면 path 자체, 둘 다 없으면 None
+    '''
+    version = current_version(path)
+    if version is not None:
+        return os.path.join(path, version)
+    if os.path.exists(os.path.join(path, marker)):
+        return path
+    return None
+
+
+def index_exists(path, marker='meta.json'):
+    directory = current_dir(path, marker)
+    return directory is not None and os.path.exists(os.path.join(directory, marker))
+
+
+def begin_version(path):
+    '''새 버전을 쓸 임시 디렉터리 (publish_version 또는 abort_version으로 끝낸다)'''
+    os.makedirs(path, exist_ok=True)
+    return tempfile.mkdtemp(prefix='.tmp-', dir=path)
+
+
+def abort_version(tmp_dir):
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def publish_version(path, tmp_dir, keep=2, legacy=()):
+    '''
+    임시 디렉터리를 버전 디렉터리로 옮기고 CURRENT를 원자적으로 바꾼다 => 버전 디렉터리 경로
+    - keep: 남겨둘 버전 수 (방금 CURRENT를 읽은 프로세스가 예전 버전을 열 수 있도록 하나 더 남긴다)
+    - legacy: 예전 형식(path에 바로 쓰던)의 파일/디렉터리 이름 => 새 버전을 만들었으니 지운다
+      path에 있는 다른 파일(메모, 백업 등)은 건드리지 않는다
+    '''
+    version = f'v-{time.time_ns()}-{os.getpid()}'
+    os.rename(tmp_dir, os.path.join(path, version))
+    pointer_tmp = os.path.join(path, f'{CURRENT_FILE}.{os.getpid()}.tmp')
+    with open(pointer_tmp, 'w', encoding='utf-8') as f:
+        f.write(version + '\n')
+    os.replace(pointer_tmp, os.path.join(path, CURRENT_FILE))
+    _remove_old_versions(path, keep, legacy)
+    return os.path.join(path, version)
+
+
+def _remove_old_versions(path, keep, legacy):
+    # publish_version이 만든 이름(v-<ns>-<pid>)만 버전 디렉터리로 본다
+    versions = sorted((name for name in os.listdir(path) if _VERSION_NAME.match(name)),
+                      key=lambda name: int(name.split('-')[1]))
+    for name in versions[:-keep] if keep > 0 else versions:
+        # 윈도우에서는 mmap으로 열린 파일을 지울 수 없다 => 다음 번에 다시 시도한다
+        shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+    # 예전 형식(path에 바로 있던 인덱스 파일)은 새 버전을 만들면 필요 없다
+    for name in legacy:
+        full = os.path.join(path, name)
+        if not os.path.lexists(full):
+            continue
+        if os.path.isdir(full):
+            shutil.rmtree(full, ignore_errors=True)
+        else:
+            try:
+                os.remove(full)
+            except OSError:
+                pass
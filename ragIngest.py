@@ -0,0 +1,366 @@
+# ragIngest.py
+'''
+문서 인제스트(로드 => 청킹) 파이프라인
+ragTest.py는 서울, 뉴욕 pdf를 하나씩 PyPDFLoader.load()로 읽고
+split_documents도 한 번에 하나씩 실행한다 => 전체 페이지 수만큼 시간이 걸린다
+
+병렬 모드: (파일, 페이지 범위) 단위 작업을 프로세스 풀에 나눠서
+텍스트 추출 + 청킹을 동시에 실행하고, 결과는 항상 파일 순서 => 페이지 순서로 합친다
+=> 인제스트 시간이 전체 페이지 수가 아니라 CPU 코어 수에 따라 줄어든다
+
+스트리밍 모드: 페이지 로드 => 청킹 => 배치 단위 임베딩 => Chroma 저장을 제너레이터로 연결한다
+모든 페이지, 모든 청크를 리스트로 만들지 않으므로 메모리 사용량이
+문서 전체 크기가 아니라 배치 크기에 비례한다
+
+증분 동기화: 청크마다 (source, page, 내용 해시)로 고정 ID를 붙여서
+이미 벡터 스토어에 있는 청크는 건너뛰고 새로 생기거나 바뀐 청크만 임베딩,
+더 이상 없는 청크는 삭제한다 => 도시 문서 하나를 추가해도 전체를 다시 임베딩하지 않는다
+'''
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from ragLoader import (DEFAULT_CACHE_DIR, _loader_settings, extract_pages, file_cache_key,
+                       iter_pdf_pages, to_documents, write_manifest)
+from ragPageStore import SpanChunk, iter_span_chunks, open_pdf_store
+
+
+def _load_and_split_range(pdf_path, page_numbers, text_splitter, extraction_mode, cache_dir):
+    '''
+    (프로세스 풀 작업) pdf의 페이지 범위를 추출하고 청킹까지 한다
+    프로세스 간에 넘길 수 있도록 모듈 최상위 함수로 둔다
+    '''
+    doc_metadata, pages, parsed = extract_pages(pdf_path, page_numbers=page_numbers,
+                                                extraction_mode=extraction_mode,
+                                                cache_dir=cache_dir)
+    docs = to_documents(doc_metadata, pages, pdf_path)
+    splits = text_splitter.split_documents(docs) if text_splitter is not None else []
+    # 텍스트는 docs에 이미 있으므로 페이지 정보에서는 빼고 돌려준다 (프로세스 간 복사 줄이기)
+    pages = [(page_number, page_label, page_key, None)
+             for page_number, page_label, page_key, _ in pages]
+    return doc_metadata, pages, parsed, docs, splits
+
+
+def _page_count(pdf_path):
+    import pypdf
+    return len(pypdf.PdfReader(pdf_path).pages)
+
+
+def load_and_split_parallel(pdf_paths, text_splitter=None, max_workers=None,
+                            pages_per_task=16, extraction_mode='plain',
+                            cache_dir=DEFAULT_CACHE_DIR, verbose=True):
+    '''
+    여러 pdf를 프로세스 풀로 병렬 로드 + 청킹하는 함수
+    - pdf_paths: pdf파일 경로 리스트
+    - text_splitter: 청킹에 사용할 splitter (None이면 로드만 한다)
+    - max_workers: 프로세스 수 (None이면 CPU 코어 수)
+    - pages_per_task: 작업 하나가 맡을 페이지 수
+    - 반환값: ({pdf_path: 페이지 Document 리스트}, 전체 청크 리스트)
+      청크 순서는 순차 실행(파일별 split_documents 후 extend)과 같다
+    '''
+    start = time.perf_counter()
+    tasks = []
+    for pdf_path in pdf_paths:
+        n_pages = _page_count(pdf_path)
+        for first in range(0, n_pages, pages_per_task):
+            page_numbers = list(range(first, min(first + pages_per_task, n_pages)))
+            tasks.append((pdf_path, page_numbers))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_load_and_split_range, pdf_path, page_numbers,
+                               text_splitter, extraction_mode, cache_dir)
+                   for pdf_path, page_numbers in tasks]
+        # 끝난 순서가 아니라 제출한 순서대로 결과를 모은다 => 결과 순서가 항상 같다
+        results = [future.result() for future in futures]
+
+    docs_by_file = {pdf_path: [] for pdf_path in pdf_paths}
+    pages_by_file = {pdf_path: [] for pdf_path in pdf_paths}
+    metadata_by_file = {}
+    all_splits = []
+    parsed_total = 0
+    for (pdf_path, _), (doc_metadata, pages, parsed, docs, splits) in zip(tasks, results):
+        metadata_by_file[pdf_path] = doc_metadata
+        pages_by_file[pdf_path].extend(pages)
+        docs_by_file[pdf_path].extend(docs)
+        all_splits.extend(splits)
+        parsed_total += parsed
+
+    # 다음번 load_pdf_cached가 pdf를 열지 않고 끝나도록 파일 목록도 남긴다
+    settings = _loader_settings(extraction_mode)
+    for pdf_path in pdf_paths:
+        if pdf_path in metadata_by_file:
+            write_manifest(cache_dir, file_cache_key(pdf_path, settings),
+                           metadata_by_file[pdf_path], pages_by_file[pdf_path])
+
+    if verbose:
+        n_pages = sum(len(docs) for docs in docs_by_file.values())
+        print(f'Parallel ingest: {len(pdf_paths)} files, {n_pages} pages '
+              f'(parsed {parsed_total}), {len(all_splits)} splits, '
+              f'{len(tasks)} tasks, {time.perf_counter() - start:.2f}s')
+    return docs_by_file, all_splits
+
+
+def iter_documents(pdf_paths, cache_dir=DEFAULT_CACHE_DIR, extraction_mode='plain'):
+    '''여러 pdf의 페이지를 한 페이지씩 내보낸다'''
+    for pdf_path in pdf_paths:
+        yield from iter_pdf_pages(pdf_path, cache_dir=cache_dir, extraction_mode=extraction_mode)
+
+
+def iter_splits(docs, text_splitter):
+    '''페이지를 하나씩 청킹한다 (split_documents는 문서마다 독립적이므로 결과는 같다)'''
+    for doc in docs:
+        yield from text_splitter.split_documents([doc])
+
+
+def append_next_prefix(chunks, n_chars=100):
+    '''
+    ragTest.py의 오버랩 루프(i번째 청크에 i+1번째 청크 앞 100자를 붙이기)의 스트리밍 버전
+    청크 하나만 잡아두었다가 다음 청크가 오면 앞부분을 붙여서 내보낸다 (같은 파일 안에서만)
+    SpanChunk는 문자열을 복사하지 않고 다음 청크 앞부분의 범위(tail)만 기록한다
+    '''
+    prev = None
+    for chunk in chunks:
+        if prev is not None:
+            if isinstance(chunk, SpanChunk):
+                if prev.store is chunk.store:
+                    prev.tail = chunk.head(n_chars)
+            elif prev.metadata.get('source') == chunk.metadata.get('source'):
+                prev.page_content += "\n" + chunk.page_content[:n_chars]
+            yield prev
+        prev = chunk
+    if prev is not None:
+        yield prev
+
+
+def chunk_id(source, page, content, occurrence=0):
+    '''(source, page, 내용 해시)로 만든 고정 청크 ID'''
+    h = hashlib.sha256()
+    for part in (os.path.normpath(source or ''), str(page), content):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    digest = h.hexdigest()
+    # 같은 페이지에 똑같은 내용의 청크가 또 있으면 순번을 붙여서 구분한다
+    return digest if occurrence == 0 else f'{digest}-{occurrence}'
+
+
+def assign_chunk_ids(splits):
+    '''청크의 doc.id에 고정 ID를 채운다 (add_documents가 doc.id를 ID로 사용)'''
+    current_page = None
+    seen = {}
+    for split in splits:
+        page_key = (split.metadata.get('source'), split.metadata.get('page'))
+        if page_key != current_page:
+            current_page = page_key
+            seen = {}
+        base_id = chunk_id(page_key[0], page_key[1], split.page_content)
+        occurrence = seen.get(base_id, 0)
+        seen[base_id] = occurrence + 1
+        split.id = chunk_id(page_key[0], page_key[1], split.page_content, occurrence)
+        yield split
+
+
+def batched(iterable, batch_size):
+    '''iterable을 batch_size개씩 묶은 리스트로 내보낸다'''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_DONE = object()
+
+
+def prefetch(iterable, max_items=2):
+    '''
+    별도 스레드에서 iterable을 미리 max_items개까지만 당겨온다 (backpressure)
+    큐가 가득 차면 생산자(로드+청킹)가 멈추고, 소비자(임베딩+저장)가 꺼내가야 다시 진행한다
+    => 로드/청킹과 임베딩이 겹쳐서 실행되지만 메모리는 max_items개로 제한된다
+    '''
+    q = queue.Queue(maxsize=max_items)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as ex:
+            put(ex)
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # 소비자가 중간에 멈춰도 생산자 스레드가 큐에 막혀 있지 않도록 한다
+        # 생산자가 지금 만들던 항목까지 끝내고 멈출 때까지 기다린다 (생산자가 쓰던 파일을 닫기 전에)
+        stop.set()
+        thread.join()
+
+
+def _iter_chunks(pdf_paths, text_splitter, next_prefix_chars, batch_size, prefetch_batches,
+                 cache_dir, extraction_mode):
+    '''
+    스트리밍 인제스트의 청크 스트림
+    - 생산자 스레드: 페이지 저장소 열기 => 청킹 => SpanChunk(범위만, 텍스트 없음)
+    - 소비자 쪽: 임베딩할 배치를 꺼낼 때 텍스트를 만들고(to_document) 고정 ID를 붙인다
+    페이지 저장소(mmap + 파일)는 그 pdf의 청크가 모두 텍스트로 바뀌면 닫는다
+    '''
+    opened = []
+
+    def produce():
+        for pdf_path in pdf_paths:
+            store = open_pdf_store(pdf_path, cache_dir=cache_dir,
+                                   extraction_mode=extraction_mode, verbose=False)
+            opened.append(store)
+            chunks = iter_span_chunks(store, text_splitter)
+            if next_prefix_chars > 0:
+                chunks = append_next_prefix(chunks, next_prefix_chars)
+            yield from chunks
+
+    def to_documents():
+        span_batches = prefetch(batched(produce(), batch_size), prefetch_batches)
+        current = None
+        try:
+            for batch in span_batches:
+                for chunk in batch:
+                    if chunk.store is not current:
+                        # 청크는 pdf 순서대로 나오므로 앞 pdf의 청크는 더 이상 없다
+                        if current is not None:
+                            current.close()
+                        current = chunk.store
+                    yield chunk.to_document()
+        finally:
+            span_batches.close()  # 생산자 스레드가 멈춘 뒤에 닫는다
+            for store in opened:
+                store.close()
+
+    # 고정 ID는 오버랩까지 붙인 최종 내용(=임베딩되는 내용)으로 만든다
+    return assign_chunk_ids(to_documents())
+
+
+def stream_ingest(pdf_paths, vector_store, text_splitter, batch_size=64,
+                  prefetch_batches=2, next_prefix_chars=0, cache_dir=DEFAULT_CACHE_DIR,
+                  extraction_mode='plain', chunk_store=None, verbose=True):
+    '''
+    pdf 로드 => 청킹 => 배치 임베딩 => 벡터 스토어 저장을 스트리밍으로 실행하는 함수
+    - vector_store: 청크를 저장할 벡터 스토어 (Chroma 등, add_documents 지원)
+      add_documents가 배치마다 embed_documents + upsert를 실행한다
+    - batch_size: 한 번에 임베딩+저장할 청크 수
+    - prefetch_batches: 임베딩하는 동안 미리 준비해둘 배치 수
+    - next_prefix_chars: 0보다 크면 다음 청크 앞부분을 붙인다 (ragTest.py 오버랩 루프)
+    - chunk_store: ragNeighbors.ChunkStore를 주면 청크 순서를 기록한다 (검색할 때 이웃 청크 확장)
+    - 반환값: 처리 통계 dict
+    미리 준비된 청크는 범위(SpanChunk)만 들고 있고, 텍스트는 임베딩 직전 배치 하나만 만든다
+    '''
+    start = time.perf_counter()
+    stats = {'chunks': 0, 'batches': 0}
+    chunks = _iter_chunks(pdf_paths, text_splitter, next_prefix_chars, batch_size,
+                          prefetch_batches, cache_dir, extraction_mode)
+    if chunk_store is not None:
+        chunks = chunk_store.record(chunks)
+    for batch in batched(chunks, batch_size):
+        vector_store.add_documents(batch)
+        stats['chunks'] += len(batch)
+        stats['batches'] += 1
+        if verbose:
+            print(f'Stream ingest: {stats["chunks"]} chunks, {stats["batches"]} batches')
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def _existing_chunks(vector_store, page_size=5000):
+    '''벡터 스토어(Chroma)에 이미 있는 청크 ID => source'''
+    existing = {}
+    offset = 0
+    while True:
+        result = vector_store.get(include=['metadatas'], limit=page_size, offset=offset)
+        for chunk_id_, metadata in zip(result['ids'], result['metadatas']):
+            existing[chunk_id_] = (metadata or {}).get('source')
+        if len(result['ids']) < page_size:
+            return existing
+        offset += page_size
+
+
+def sync_ingest(pdf_paths, vector_store, text_splitter, batch_size=64,
+                prefetch_batches=2, next_prefix_chars=0, prune_other_sources=False,
+                cache_dir=DEFAULT_CACHE_DIR, extraction_mode='plain', chunk_store=None,
+                verbose=True):
+    '''
+    벡터 스토어를 pdf 문서들과 증분 동기화하는 함수
+    - 고정 ID가 이미 있는 청크 => 건너뜀 (임베딩 API 호출 없음)
+    - 새로 생기거나 내용이 바뀐 청크 => 배치 단위로 임베딩 + 저장
+    - pdf_paths에 속한 source인데 이번에 만들어지지 않은 청크 => 삭제
+    - prune_other_sources=True 이면 pdf_paths에 없는 source의 청크도 삭제한다
+      (pdf_paths가 전체 문서 목록일 때만 사용)
+    - chunk_store: 청크 순서 기록 (바뀌지 않은 청크도 포함해서 문서 전체 순서를 다시 쓴다)
+    - 반환값: {'added', 'unchanged', 'deleted', 'seconds'}
+    '''
+    start = time.perf_counter()
+    existing = _existing_chunks(vector_store)
+    sources = {os.path.normpath(pdf_path) for pdf_path in pdf_paths}
+    desired = set()
+    stats = {'added': 0, 'unchanged': 0, 'deleted': 0}
+
+    def new_chunks():
+        chunks = _iter_chunks(pdf_paths, text_splitter, next_prefix_chars, batch_size,
+                              prefetch_batches, cache_dir, extraction_mode)
+        if chunk_store is not None:
+            chunks = chunk_store.record(chunks)
+        for split in chunks:
+            desired.add(split.id)
+            if split.id in existing:
+                stats['unchanged'] += 1
+            else:
+                yield split
+
+    for batch in batched(new_chunks(), batch_size):
+        vector_store.add_documents(batch)
+        stats['added'] += len(batch)
+        if verbose:
+            print(f'Sync ingest: added {stats["added"]} chunks')
+
+    stale = [chunk_id_ for chunk_id_, source in existing.items()
+             if chunk_id_ not in desired
+             and (prune_other_sources or os.path.normpath(source or '') in sources)]
+    for batch in batched(stale, 1000):
+        vector_store.delete(ids=batch)
+    stats['deleted'] = len(stale)
+    stats['seconds'] = time.perf_counter() - start
+    if verbose:
+        print(f'Sync ingest: added {stats["added"]}, unchanged {stats["unchanged"]}, '
+              f'deleted {stats["deleted"]} ({stats["seconds"]:.2f}s)')
+    return stats
+
+
+if __name__ == '__main__':
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    pdf_paths = ['./data/2040_seoul_plan.pdf', './data/OneNYC_2050_Strategic_Plan.pdf']
+    docs_by_file, all_splits = load_and_split_parallel(pdf_paths, text_splitter)
+    print('청크 수: ', len(all_splits))
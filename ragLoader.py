@@ -0,0 +1,326 @@
+# ragLoader.py
+'''
+PDF 로드 + 캐싱 모듈
+ragTest.py의 load_pdf_with_pickle은 ./data/*.pkl 파일이 "있는지"만 보고 캐시를 썼다
+=> pdf가 바뀌어도 예전 페이지를 돌려주고, 같은 pdf를 이름만 바꿔도 처음부터 다시 파싱한다
+
+여기서는 내용 기반(content-addressed) 캐시를 사용한다
+- 파일 키: pdf 바이트 전체의 해시 + 로더 설정(버전, 추출 모드)
+  => 같은 내용이면 파일명/경로가 달라도 캐시 적중
+- 페이지 키: 페이지 content stream 바이트 + 리소스(폰트, Form XObject)의 해시 + 로더 설정
+  => 205페이지 문서에서 몇 페이지만 바뀌면 바뀐 페이지만 다시 텍스트 추출
+pdf 파싱(텍스트 추출)이 콜드 인제스트 시간의 대부분이므로 캐시 적중이 가장 큰 이득이다
+'''
+import hashlib
+import json
+import os
+
+# 캐시 포맷이나 추출 로직이 바뀌면 숫자를 올려서 기존 캐시를 무효화한다
+# 2: 페이지 키에 Form XObject, 폰트 /Encoding, 상속된 /Resources 포함
+LOADER_VERSION = 2
+DEFAULT_CACHE_DIR = './data/cache'
+# 추출 텍스트에 영향을 주는 폰트 항목 (FontFile 같은 큰 글꼴 프로그램은 제외)
+_FONT_KEYS = ('/Subtype', '/BaseFont', '/Encoding', '/ToUnicode', '/FirstChar', '/Widths', '/W',
+              '/CIDSystemInfo')
+MAX_FORM_DEPTH = 8
+
+
+def _loader_settings(extraction_mode='plain'):
+    '''캐시 키에 섞을 로더 설정 (pypdf 버전이 바뀌면 추출 결과도 달라질 수 있음)'''
+    import pypdf
+    return {
+        'loader_version': LOADER_VERSION,
+        'pypdf_version': pypdf.__version__,
+        'extraction_mode': extraction_mode,
+    }
+
+
+def _settings_digest(settings):
+    return json.dumps(settings, sort_keys=True).encode('utf-8')
+
+
+def file_cache_key(pdf_path, settings):
+    '''pdf 바이트 전체 + 설정으로 파일 키를 만든다'''
+    h = hashlib.sha256(_settings_digest(settings))
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _ref_key(obj):
+    '''간접 객체 번호 (직접 객체면 None)'''
+    from pypdf.generic import IndirectObject
+
+    ref = obj if isinstance(obj, IndirectObject) else getattr(obj, 'indirect_reference', None)
+    return (ref.idnum, ref.generation) if ref is not None else None
+
+
+def _hash_object(h, obj, depth=0):
+    '''
+    PDF 객체 값을 해시에 넣는다 (간접 참조는 따라가고, 스트림은 디코딩한 바이트)
+    IndirectObject의 repr에는 reader의 id가 들어가므로 str()을 그대로 쓰지 않는다
+    '''
+    from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject
+
+    if isinstance(obj, IndirectObject):
+        if depth > MAX_FORM_DEPTH:
+            h.update(b'R%d' % obj.idnum)
+            return
+        obj = obj.get_object()
+    if hasattr(obj, 'get_data'):
+        h.update(b'stream')
+        h.update(obj.get_data())
+    elif isinstance(obj, DictionaryObject):
+        for key in sorted(obj):
+            if key != '/Length':
+                h.update(key.encode('utf-8'))
+                _hash_object(h, obj[key], depth + 1)
+    elif isinstance(obj, ArrayObject):
+        h.update(b'[')
+        for item in obj:
+            _hash_object(h, item, depth + 1)
+        h.update(b']')
+    else:
+        h.update(str(obj).encode('utf-8'))
+        h.update(b'\0')
+
+
+def _font_digest(font, memo):
+    '''폰트 해시: 이름, 인코딩(/Differences 포함), ToUnicode, 폭, Type0의 하위 폰트'''
+    ref = _ref_key(font)
+    if ref is not None and ('font', ref) in memo:
+        return memo[('font', ref)]
+    font = font.get_object()
+    h = hashlib.sha256()
+    for key in _FONT_KEYS:
+        if key in font:
+            h.update(key.encode('utf-8'))
+            _hash_object(h, font[key])
+    descendants = font.get('/DescendantFonts')
+    for descendant in (descendants.get_object() if descendants is not None else []):
+        h.update(_font_digest(descendant, memo).encode('ascii'))
+    digest = h.hexdigest()
+    if ref is not None:
+        memo[('font', ref)] = digest
+    return digest
+
+
+def _xobject_digest(xobject, parent_resources, memo, depth):
+    '''
+    Form XObject 해시: 스트림 바이트 + 자기 리소스(재귀)
+    본문이 "/Fm0 Do" 한 줄이고 텍스트는 Form 안에 있는 pdf가 많다
+    이미지는 텍스트 추출에 영향이 없으므로 종류만 넣는다
+    '''
+    obj = xobject.get_object()
+    if obj.get('/Subtype') != '/Form':
+        return str(obj.get('/Subtype'))
+    own_resources = obj.get('/Resources')
+    ref = _ref_key(xobject)
+    # 자기 리소스가 없는 Form은 부모 리소스를 쓰므로 부모에 따라 해시가 달라진다 => 메모하지 않음
+    cacheable = ref is not None and own_resources is not None
+    if cacheable and ('form', ref) in memo:
+        return memo[('form', ref)]
+    h = hashlib.sha256(obj.get_data())
+    _hash_object(h, obj.get('/Matrix'))
+    if depth < MAX_FORM_DEPTH:
+        _hash_resources(h, own_resources if own_resources is not None else parent_resources,
+                        memo, depth + 1)
+    digest = h.hexdigest()
+    if cacheable:
+        memo[('form', ref)] = digest
+    return digest
+
+
+def _hash_resources(h, resources, memo, depth=0):
+    if resources is None:
+        return
+    resources = resources.get_object()
+    # 같은 content stream이라도 폰트(인코딩, ToUnicode 매핑)가 바뀌면 추출 텍스트가 달라진다
+    fonts = resources.get('/Font')
+    if fonts is not None:
+        for name, font in sorted(fonts.get_object().items()):
+            h.update(name.encode('utf-8'))
+            h.update(_font_digest(font, memo).encode('ascii'))
+    xobjects = resources.get('/XObject')
+    if xobjects is not None:
+        for name, xobject in sorted(xobjects.get_object().items()):
+            h.update(name.encode('utf-8'))
+            h.update(_xobject_digest(xobject, resources, memo, depth).encode('utf-8'))
+
+
+def _page_resources(page):
+    '''페이지의 /Resources (없으면 페이지 트리의 부모에서 상속받은 것)'''
+    node = page
+    while node is not None:
+        resources = node.get('/Resources')
+        if resources is not None:
+            return resources
+        parent = node.get('/Parent')
+        node = parent.get_object() if parent is not None else None
+    return None
+
+
+def page_cache_key(page, settings, memo=None):
+    '''
+    페이지 content stream 바이트 + 리소스(폰트, Form XObject 재귀)로 페이지 키를 만든다
+    텍스트 추출보다 훨씬 싸게 "이 페이지가 바뀌었는지"를 판단할 수 있다
+    - memo: 같은 reader 안에서 공유하는 폰트/Form 해시 (페이지마다 같은 폰트를 다시 해시하지 않음)
+    '''
+    memo = memo if memo is not None else {}
+    h = hashlib.sha256(_settings_digest(settings))
+    contents = page.get_contents()
+    if contents is not None:
+        h.update(contents.get_data())
+    _hash_resources(h, _page_resources(page), memo)
+    return h.hexdigest()
+
+
+def _doc_metadata(reader, pdf_path):
+    '''PyPDFLoader와 같은 형태의 문서 메타데이터'''
+    metadata = {'producer': 'PyPDF', 'creator': 'PyPDF', 'creationdate': ''}
+    for k, v in (reader.metadata or {}).items():
+        k = k.lstrip('/').lower()
+        metadata[k] = v if isinstance(v, (str, int)) else str(v)
+    metadata['source'] = pdf_path
+    metadata['total_pages'] = len(reader.pages)
+    return metadata
+
+
+def _read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    # 다른 프로세스가 반쯤 쓴 파일을 읽지 않도록 임시 파일에 쓰고 교체한다
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _iter_extract(reader, page_numbers, settings, cache_dir, stats):
+    '''페이지 캐시를 거쳐 (page, page_label, page_key, text)를 하나씩 내보낸다'''
+    pages_dir = os.path.join(cache_dir, 'pages')
+    os.makedirs(pages_dir, exist_ok=True)
+    page_labels = reader.page_labels
+    memo = {}
+    for page_number in page_numbers:
+        page = reader.pages[page_number]
+        page_key = page_cache_key(page, settings, memo)
+        page_path = os.path.join(pages_dir, f'{page_key}.json')
+        try:
+            text = _read_json(page_path)['text']
+        except (OSError, ValueError, KeyError):
+            #바뀐 페이지만 실제로 텍스트를 추출한다
+            text = page.extract_text(extraction_mode=settings['extraction_mode']).strip()
+            _write_json(page_path, {'text': text})
+            stats['parsed'] += 1
+        yield page_number, page_labels[page_number], page_key, text
+
+
+def extract_pages(pdf_path, page_numbers=None, extraction_mode='plain',
+                  cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    pdf의 지정한 페이지들을 페이지 캐시를 거쳐 추출한다
+    - page_numbers: 추출할 페이지 번호 리스트 (None이면 전체)
+    - 반환값: (문서 메타데이터, [(page, page_label, page_key, text), ...], 파싱한 페이지 수)
+    '''
+    import pypdf
+
+    reader = pypdf.PdfReader(pdf_path)
+    if page_numbers is None:
+        page_numbers = range(len(reader.pages))
+    stats = {'parsed': 0}
+    pages = list(_iter_extract(reader, page_numbers, _loader_settings(extraction_mode),
+                               cache_dir, stats))
+    return _doc_metadata(reader, pdf_path), pages, stats['parsed']
+
+
+def write_manifest(cache_dir, file_key, doc_metadata, pages):
+    '''파일 키 => 페이지 키 목록을 저장해두면 다음 로드는 pdf를 열지 않고 끝난다'''
+    files_dir = os.path.join(cache_dir, 'files')
+    os.makedirs(files_dir, exist_ok=True)
+    _write_json(os.path.join(files_dir, f'{file_key}.json'), {
+        'metadata': doc_metadata,
+        'pages': [[page_label, page_key] for _, page_label, page_key, _ in pages],
+    })
+
+
+def _page_document(doc_metadata, pdf_path, page_number, page_label, text):
+    from langchain_core.documents import Document
+
+    metadata = dict(doc_metadata)
+    # 파일명이 바뀌어도 캐시는 공유하므로 source는 항상 현재 경로로 채운다
+    metadata['source'] = pdf_path
+    metadata['page'] = page_number
+    metadata['page_label'] = page_label
+    return Document(page_content=text, metadata=metadata)
+
+
+def to_documents(doc_metadata, pages, pdf_path):
+    return [_page_document(doc_metadata, pdf_path, page_number, page_label, text)
+            for page_number, page_label, _, text in pages]
+
+
+def iter_pdf_pages(pdf_path, cache_dir=DEFAULT_CACHE_DIR, extraction_mode='plain',
+                   stats=None):
+    '''
+    pdf 페이지를 내용 기반 캐시를 거쳐 한 페이지씩 Document로 내보내는 제너레이터
+    한 번에 한 페이지만 메모리에 있으므로 스트리밍 인제스트에 사용한다
+    - stats: dict를 넘기면 pages, parsed(실제 파싱한 페이지 수), cached(파일 전체 적중)를 채운다
+    '''
+    stats = stats if stats is not None else {}
+    stats.update(pages=0, parsed=0, cached=False)
+    settings = _loader_settings(extraction_mode)
+    file_key = file_cache_key(pdf_path, settings)
+    manifest_path = os.path.join(cache_dir, 'files', f'{file_key}.json')
+
+    # 파일 전체 적중 => pdf를 열지도 않는다
+    # 페이지 파일이 지워졌거나 깨졌으면 거기서부터는 캐시 미스로 보고 pdf를 다시 파싱한다
+    pages = []
+    if os.path.exists(manifest_path):
+        stats['cached'] = True
+        pages_dir = os.path.join(cache_dir, 'pages')
+        try:
+            manifest = _read_json(manifest_path)
+            for page_number, (page_label, page_key) in enumerate(manifest['pages']):
+                text = _read_json(os.path.join(pages_dir, f'{page_key}.json'))['text']
+                pages.append((page_number, page_label, page_key, None))
+                stats['pages'] += 1
+                yield _page_document(manifest['metadata'], pdf_path, page_number, page_label, text)
+            return
+        except (OSError, ValueError, KeyError, TypeError):
+            stats['cached'] = False
+
+    import pypdf
+
+    reader = pypdf.PdfReader(pdf_path)
+    doc_metadata = _doc_metadata(reader, pdf_path)
+    for page_number, page_label, page_key, text in _iter_extract(
+            reader, range(len(pages), len(reader.pages)), settings, cache_dir, stats):
+        # 파일 목록에는 텍스트 없이 페이지 키만 남긴다
+        pages.append((page_number, page_label, page_key, None))
+        stats['pages'] += 1
+        yield _page_document(doc_metadata, pdf_path, page_number, page_label, text)
+    write_manifest(cache_dir, file_key, doc_metadata, pages)
+
+
+def load_pdf_cached(pdf_path, cache_dir=DEFAULT_CACHE_DIR, extraction_mode='plain',
+                    verbose=True):
+    '''
+    pdf파일을 내용 기반 캐시를 이용해 로드하는 함수 (load_pdf_with_pickle 대체)
+    - pdf_path: pdf파일 경로
+    - cache_dir: 캐시 디렉터리 (files/ 에 파일 목록, pages/ 에 페이지별 텍스트)
+    - 반환값: PyPDFLoader.load()와 같은 Document 리스트
+    '''
+    stats = {}
+    docs = list(iter_pdf_pages(pdf_path, cache_dir=cache_dir,
+                               extraction_mode=extraction_mode, stats=stats))
+    if verbose:
+        if stats['cached']:
+            print(f'Loaded from cache: {pdf_path} ({len(docs)} pages)')
+        else:
+            print(f'Loaded from PDF: {pdf_path} (parsed {stats["parsed"]}/{len(docs)} pages)')
+    return docs
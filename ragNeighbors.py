@@ -0,0 +1,122 @@
+# ragNeighbors.py
+'''
+이웃 청크 확장 (검색할 때)
+ragTest.py의 오버랩 루프는 임베딩하기 전에 i번째 청크에 i+1번째 청크 앞 100자를 붙인다
+=> 모든 청크의 임베딩 토큰과 저장 텍스트가 늘어난다 (검색되지 않는 청크까지)
+
+대신 인제스트할 때 청크 순서(문서별 순번)만 로컬 청크 저장소에 기록해두고,
+검색할 때 실제로 검색된 청크의 앞뒤(±window) 청크를 붙여서 돌려준다
+=> 문맥이 이어지는 효과는 검색된 청크에만 생기고, 인제스트 비용은 줄어든다
+(이어진 청크들의 겹친 부분은 ragContext.pack_context가 하나로 합친다)
+'''
+import json
+import os
+import sqlite3
+import threading
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+DEFAULT_CHUNK_STORE = './data/chunks.sqlite3'
+
+
+class ChunkStore:
+    '''
+    문서(source)별 청크 순서 + 텍스트 저장소 (sqlite)
+    - record(chunks): 인제스트 중인 청크 스트림을 그대로 흘려보내면서 순번을 기록한다
+    - neighbours(ids, window): 청크 ID => 앞뒤 window개 청크까지 포함한 Document 리스트
+    '''
+
+    def __init__(self, path=DEFAULT_CHUNK_STORE):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, source TEXT NOT NULL, '
+            'ord INTEGER NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS chunks_order ON chunks (source, ord)')
+        self._conn.commit()
+
+    def record(self, chunks, commit_every=500):
+        '''
+        청크 제너레이터를 감싸서 (source별 순번, 텍스트)를 기록한다 (청크는 그대로 내보냄)
+        source의 첫 청크가 오면 그 source의 예전 기록은 지운다 => 다시 인제스트해도 순서가 맞다
+        '''
+        current_source = None
+        ord_ = 0
+        pending = 0
+        try:
+            for chunk in chunks:
+                source = chunk.metadata.get('source', '')
+                if source != current_source:
+                    current_source, ord_ = source, 0
+                    with self._lock:
+                        self._conn.execute('DELETE FROM chunks WHERE source = ?', (source,))
+                with self._lock:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO chunks (id, source, ord, text, metadata) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (chunk.id, source, ord_, chunk.page_content,
+                         json.dumps(chunk.metadata, ensure_ascii=False)))
+                ord_ += 1
+                pending += 1
+                if pending >= commit_every:
+                    with self._lock:
+                        self._conn.commit()
+                    pending = 0
+                yield chunk
+        finally:
+            with self._lock:
+                self._conn.commit()
+
+    def neighbours(self, ids, window=1):
+        '''청크 ID => [앞 청크들..., 자기 자신, 뒤 청크들...] (문서 순서, 저장소에 없는 ID는 빠짐)'''
+        result = {}
+        with self._lock:
+            for chunk_id in ids:
+                row = self._conn.execute('SELECT source, ord FROM chunks WHERE id = ?',
+                                         (chunk_id,)).fetchone()
+                if row is None:
+                    continue
+                source, ord_ = row
+                rows = self._conn.execute(
+                    'SELECT id, text, metadata FROM chunks WHERE source = ? AND ord BETWEEN ? AND ? '
+                    'ORDER BY ord', (source, ord_ - window, ord_ + window)).fetchall()
+                result[chunk_id] = [Document(id=id_, page_content=text, metadata=json.loads(metadata))
+                                    for id_, text, metadata in rows]
+        return result
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+
+class NeighborRetriever(BaseRetriever):
+    '''
+    검색된 청크마다 앞뒤 window개 이웃 청크를 붙여서 돌려주는 리트리버
+    - retriever: 실제 리트리버 (invoke의 추가 인자는 그대로 넘긴다)
+    - chunk_store: 인제스트할 때 기록한 ChunkStore
+    결과 순서: 검색 순위대로, 각 청크는 [이전, 자기, 다음] 문서 순서 (중복 제거)
+    '''
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retriever: BaseRetriever
+    chunk_store: ChunkStore
+    window: int = 1
+
+    def _get_relevant_documents(self, query, *, run_manager=None, **kwargs):
+        hits = self.retriever.invoke(query, **kwargs)
+        groups = self.chunk_store.neighbours([doc.id for doc in hits if doc.id], self.window)
+        docs = []
+        seen = set()
+        for hit in hits:
+            for doc in groups.get(hit.id, [hit]):
+                key = doc.id or doc.page_content
+                if key not in seen:
+                    seen.add(key)
+                    docs.append(doc)
+        return docs
@@ -0,0 +1,260 @@
+# ragPageStore.py
+'''
+mmap으로 여는 컬럼형 페이지 저장소
+Document 리스트 전체를 pickle로 저장하면 data_seoul[10] 한 페이지만 보려고 해도
+전체 리스트를 역직렬화(unpickle)해야 한다
+
+페이지 저장소 디렉터리 구조
+- text.bin    : 모든 페이지 텍스트(UTF-8)를 이어 붙인 blob
+- offsets.bin : 페이지 i의 텍스트는 text.bin[offsets[i]:offsets[i+1]] (uint64 배열)
+- meta.json   : 메타데이터 컬럼 (컬럼별로 고유값 목록 + 페이지별 코드로 저장)
+
+text.bin/offsets.bin은 mmap으로 열기 때문에 실제로 읽은 페이지만 메모리에 올라오고
+여러 프로세스(Streamlit 워커 등)가 같은 파일을 열면 OS 페이지 캐시를 공유한다
+
+SpanChunk: 청크 텍스트를 복사해서 들고 있지 않고 (페이지, 시작, 끝) 범위만 가리킨다
+텍스트는 임베딩하거나 LLM에 넘길 때 text()/to_document()로 그때 만든다
+다음 청크 앞부분을 붙이는 오버랩도 문자열 이어붙이기가 아니라 범위(tail)로 표현한다
+(복사가 없는 것은 청킹 이후 단계: 청킹할 때는 페이지 텍스트 문자열을 한 번 만들고,
+ split_offsets가 없는 일반 splitter는 청크마다 문자열도 만든다 => iter_span_chunks 참고)
+'''
+import json
+import mmap
+import os
+from array import array
+
+from ragLoader import DEFAULT_CACHE_DIR, _loader_settings, _write_json, file_cache_key, iter_pdf_pages
+
+
+def _encode_columns(metadatas):
+    '''메타데이터 dict 리스트 => 컬럼별 {values: 고유값 목록, codes: 페이지별 인덱스}'''
+    keys = []
+    for metadata in metadatas:
+        for k in metadata:
+            if k not in keys:
+                keys.append(k)
+    columns = {}
+    for k in keys:
+        values, codes, index = [], [], {}
+        for metadata in metadatas:
+            v = metadata.get(k)
+            # 같은 값(source, producer 등)은 한 번만 저장한다
+            key = json.dumps(v, ensure_ascii=False)
+            if key not in index:
+                index[key] = len(values)
+                values.append(v)
+            codes.append(index[key])
+        columns[k] = {'values': values, 'codes': codes}
+    return columns
+
+
+class PageStore:
+    '''
+    text blob + offsets + 메타데이터 컬럼으로 된 페이지 저장소
+    리스트처럼 len(), store[i], for doc in store 를 지원하고
+    store[i]를 호출할 때만 해당 페이지의 Document를 만든다
+    '''
+
+    def __init__(self, path, source=None):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.columns = json.load(f)['columns']
+        # 내용 기반 캐시에서 열었을 때 파일명이 바뀌었을 수 있으므로 source를 덮어쓴다
+        self.source = source
+
+        self._files = []
+        self._text = self._map('text.bin')
+        offsets = self._map('offsets.bin')
+        self._offsets = memoryview(offsets).cast('Q') if len(offsets) else memoryview(array('Q', [0]))
+
+    def _map(self, name):
+        f = open(os.path.join(self.path, name), 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''  # 빈 파일은 mmap할 수 없다
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def write(cls, path, docs):
+        '''Document 리스트(또는 iterable)를 페이지 저장소로 저장한다'''
+        os.makedirs(path, exist_ok=True)
+        offsets = array('Q', [0])
+        metadatas = []
+        tmp_text = os.path.join(path, f'text.bin.{os.getpid()}.tmp')
+        with open(tmp_text, 'wb') as f:
+            for doc in docs:
+                data = doc.page_content.encode('utf-8')
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                metadatas.append(doc.metadata)
+        tmp_offsets = os.path.join(path, f'offsets.bin.{os.getpid()}.tmp')
+        with open(tmp_offsets, 'wb') as f:
+            offsets.tofile(f)
+        os.replace(tmp_text, os.path.join(path, 'text.bin'))
+        os.replace(tmp_offsets, os.path.join(path, 'offsets.bin'))
+        # meta.json을 마지막에 써야 "meta.json이 있으면 완성된 저장소"가 보장된다
+        _write_json(os.path.join(path, 'meta.json'), {'columns': _encode_columns(metadatas)})
+
+    @classmethod
+    def open(cls, path, source=None):
+        return cls(path, source=source)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def page_bytes(self, i, start=0, end=None):
+        '''i번째 페이지의 [start:end] 바이트 범위 (mmap을 가리키는 memoryview, 복사 없음)'''
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('page index out of range')
+        page_start, page_end = self._offsets[i], self._offsets[i + 1]
+        end = page_end - page_start if end is None else end
+        return memoryview(self._text)[page_start + start:page_start + end]
+
+    def text(self, i):
+        '''i번째 페이지 텍스트만 읽는다 (Document를 만들지 않음)'''
+        return str(self.page_bytes(i), 'utf-8')
+
+    def metadata(self, i):
+        if i < 0:
+            i += len(self)
+        metadata = {}
+        for k, column in self.columns.items():
+            v = column['values'][column['codes'][i]]
+            if v is not None:
+                metadata[k] = v
+        if self.source is not None and 'source' in metadata:
+            metadata['source'] = self.source
+        return metadata
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        from langchain_core.documents import Document
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        # memoryview를 먼저 해제해야 mmap을 닫을 수 있다 (SpanChunk.text()가 만든 view는 바로 해제됨)
+        # 여러 번 불러도 된다
+        self._offsets.release()
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpanChunk:
+    '''
+    페이지 저장소의 한 범위를 가리키는 청크
+    - store, page: 페이지 저장소와 페이지 번호
+    - start, end: 페이지 안에서의 UTF-8 바이트 범위
+    - tail: 뒤에 "\n"으로 이어 붙일 다른 범위 (오버랩, 보통 다음 청크의 앞부분)
+    '''
+    __slots__ = ('store', 'page', 'start', 'end', 'tail')
+
+    def __init__(self, store, page, start, end, tail=None):
+        self.store = store
+        self.page = page
+        self.start = start
+        self.end = end
+        self.tail = tail
+
+    def __len__(self):
+        return self.end - self.start + (len(self.tail) + 1 if self.tail is not None else 0)
+
+    def text(self):
+        '''청크 텍스트를 만든다 (이때 처음으로 문자열이 생긴다)'''
+        with self.store.page_bytes(self.page, self.start, self.end) as data:
+            text = str(data, 'utf-8')
+        if self.tail is not None:
+            text += "\n" + self.tail.text()
+        return text
+
+    def head(self, n_chars):
+        '''이 청크의 앞 n_chars 글자만 가리키는 범위'''
+        # UTF-8 한 글자는 최대 4바이트이므로 n_chars * 4 바이트만 읽어서 바이트 길이를 구한다
+        with self.store.page_bytes(self.page, self.start,
+                                   min(self.end, self.start + n_chars * 4)) as data:
+            prefix = str(data, 'utf-8', 'ignore')[:n_chars]
+        return SpanChunk(self.store, self.page, self.start,
+                         self.start + len(prefix.encode('utf-8')))
+
+    def to_document(self):
+        from langchain_core.documents import Document
+        return Document(page_content=self.text(), metadata=self.store.metadata(self.page))
+
+
+def _utf8_offsets(text, positions):
+    '''글자 위치들 => {글자 위치: UTF-8 바이트 위치} (앞에서부터 차이만 인코딩하므로 페이지당 한 번)'''
+    if text.isascii():
+        return {pos: pos for pos in positions}
+    result = {}
+    char_pos = byte_pos = 0
+    for pos in sorted(set(positions)):
+        byte_pos += len(text[char_pos:pos].encode('utf-8'))
+        char_pos = pos
+        result[pos] = byte_pos
+    return result
+
+
+def iter_span_chunks(store, text_splitter):
+    '''
+    페이지 저장소의 페이지를 청킹해서 SpanChunk로 내보낸다
+    - split_offsets가 있는 splitter(ragSplitter.TokenAwareSplitter): 청크 위치만 받으므로
+      청크 문자열을 만들지 않는다 (페이지 텍스트 문자열은 페이지마다 한 번 만든다)
+    - 일반 splitter(RecursiveCharacterTextSplitter): split_text가 청크 문자열을 만들고,
+      페이지 안에서의 위치를 찾은 뒤 바로 버린다 (청크는 항상 페이지 텍스트의 연속된 부분 문자열)
+    '''
+    overlap = getattr(text_splitter, '_chunk_overlap', 0)
+    for page in range(len(store)):
+        text = store.text(page)
+        if hasattr(text_splitter, 'split_offsets'):
+            spans = text_splitter.split_offsets(text)
+        else:
+            spans = []
+            offset = 0
+            for chunk in text_splitter.split_text(text):
+                # add_start_index와 같은 방식: 앞 청크 끝 - 오버랩 위치부터 찾는다
+                index = text.find(chunk, max(0, offset))
+                if index < 0:
+                    index = text.find(chunk)
+                if index < 0:
+                    raise ValueError('chunk is not a substring of its page; '
+                                     'SpanChunk needs a splitter that keeps text contiguous')
+                offset = index + len(chunk) - overlap
+                spans.append((index, index + len(chunk)))
+        offsets = _utf8_offsets(text, [pos for span in spans for pos in span])
+        for s, e in spans:
+            yield SpanChunk(store, page, offsets[s], offsets[e])
+
+
+def open_pdf_store(pdf_path, cache_dir=DEFAULT_CACHE_DIR, extraction_mode='plain',
+                   verbose=True):
+    '''
+    pdf를 페이지 저장소로 열기
+    - pdf 바이트 해시로 만든 저장소가 있으면 바로 mmap으로 연다 (pdf 파싱, unpickle 없음)
+    - 없으면 iter_pdf_pages로 한 페이지씩 받아서(바뀐 페이지만 파싱) 저장소를 만든다
+    '''
+    file_key = file_cache_key(pdf_path, _loader_settings(extraction_mode))
+    store_path = os.path.join(cache_dir, 'stores', file_key)
+    if not os.path.exists(os.path.join(store_path, 'meta.json')):
+        stats = {}
+        PageStore.write(store_path, iter_pdf_pages(pdf_path, cache_dir=cache_dir,
+                                                   extraction_mode=extraction_mode,
+                                                   stats=stats))
+        if verbose:
+            print(f'Built page store: {pdf_path} (parsed {stats["parsed"]}/{stats["pages"]} pages)')
+    elif verbose:
+        print(f'Opened page store: {pdf_path} -> {store_path}')
+    return PageStore.open(store_path, source=pdf_path)
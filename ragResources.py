@@ -0,0 +1,337 @@
+# ragResources.py
+'''
+프로세스 전체에서 공유하는 RAG 리소스
+Streamlit은 사용자가 메시지를 보낼 때마다 ragChat.py를 처음부터 다시 실행한다
+=> OpenAIEmbeddings, Chroma(persist_directory=...), ChatOpenAI, 문서 체인, 보정 체인을
+   메시지마다 새로 만들고, 크로마/인덱스 파일도 매번 다시 연다
+
+ResourceRegistry: 이름 => 리소스를 처음 쓸 때 한 번만 만들고 모든 세션이 공유한다
+(모듈은 프로세스에 한 번만 import되므로 스크립트를 다시 실행해도 레지스트리는 그대로 남는다)
+- check: 주기적으로(check_interval초) 상태를 확인하고 실패하면 다시 만든다
+- version: 값이 바뀌면(예: ragTest.py가 다시 인제스트해서 ./index_version이 바뀜) 다시 만든다
+- 리소스를 만들 때 다른 리소스를 get하면 의존 관계가 기록되어,
+  의존하는 리소스가 다시 만들어지면 이 리소스도 같이 다시 만든다
+'''
+import logging
+import os
+import threading
+import time
+
+from ragCache import index_version
+from ragIndexDir import index_exists
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceRegistry:
+    '''
+    이름 => 공유 리소스 (스레드 안전, 지연 생성)
+    - register(name, factory, check=None, version=None)
+      factory(registry) => 리소스, check(리소스) => True/False, version() => 비교할 값
+    - get(name): 리소스 (없거나, 상태 확인에 실패했거나, 버전이 바뀌었으면 새로 만든다)
+    - health(): 모든 리소스 상태 확인 결과 dict
+    - close(): 만든 리소스를 모두 버리고 닫는다
+    잠금은 리소스마다 따로 잡는다 => 크로마를 다시 여는 동안에도 llm 등 다른 리소스 get은 기다리지 않는다
+    다시 만들어서 버린 예전 인스턴스는 close()가 있으면 close_delay초 뒤에 닫는다
+    (그 사이 진행 중인 질문은 예전 인스턴스로 끝낼 수 있도록)
+    '''
+
+    def __init__(self, check_interval=30.0, close_delay=60.0):
+        self.check_interval = check_interval
+        self.close_delay = close_delay
+        self._lock = threading.Lock()  # 아래 dict만 보호한다 (리소스를 만드는 동안에는 잡지 않음)
+        self._locks = {}  # 이름 => 그 리소스를 확인하고 만들 때 잡는 잠금
+        self._specs = {}
+        self._items = {}
+        self._versions = {}
+        self._checked = {}
+        self._dependents = {}  # 이름 => 이 리소스를 써서 만들어진 리소스 이름들
+        self._local = threading.local()  # 스레드별로 지금 만들고 있는 리소스 이름 스택
+
+    def register(self, name, factory, check=None, version=None):
+        with self._lock:
+            if name not in self._specs:
+                self._specs[name] = (factory, check, version)
+                self._locks[name] = threading.RLock()
+
+    def _stale(self, name):
+        _, _, version = self._specs[name]
+        return version is not None and version() != self._versions[name]
+
+    def _check(self, name, item, force=False):
+        '''리소스가 아직 쓸 만하면 True (check는 check_interval마다 한 번만 실행)'''
+        _, check, _ = self._specs[name]
+        if self._stale(name):
+            logger.info('resource %s is stale (version changed)', name)
+            return False
+        now = time.monotonic()
+        if check is None or (not force and now - self._checked[name] < self.check_interval):
+            return True
+        self._checked[name] = now
+        try:
+            return bool(check(item))
+        except Exception:
+            logger.exception('resource %s failed its health check', name)
+            return False
+
+    def _discard(self, name):
+        '''리소스와 그 리소스에 의존하는 리소스들을 레지스트리에서 빼고 => 뺀 인스턴스 목록'''
+        removed = []
+        with self._lock:
+            pending = [name]
+            while pending:
+                name = pending.pop()
+                if name in self._items:
+                    removed.append((name, self._items.pop(name)))
+                pending.extend(self._dependents.pop(name, ()))
+        return removed
+
+    def invalidate(self, name):
+        '''리소스와 그 리소스에 의존하는 리소스들을 버린다 (다음 get에서 다시 만든다)'''
+        removed = self._discard(name)
+        if removed and self.close_delay > 0:
+            timer = threading.Timer(self.close_delay, _close_all, (removed,))
+            timer.daemon = True
+            timer.start()
+        else:
+            _close_all(removed)
+
+    def get(self, name):
+        building = getattr(self._local, 'building', None)
+        if building is None:
+            building = self._local.building = []
+        with self._lock:
+            spec = self._specs[name]
+            lock = self._locks[name]
+            if building:
+                self._dependents.setdefault(name, set()).add(building[-1])
+        with lock:
+            with self._lock:
+                item = self._items.get(name, _MISSING)
+            if item is not _MISSING:
+                if self._check(name, item):
+                    return item
+                self.invalidate(name)
+
+            factory, _, version = spec
+            start = time.perf_counter()
+            building.append(name)
+            try:
+                item = factory(self)
+            finally:
+                building.pop()
+            current = version() if version is not None else None
+            with self._lock:
+                self._items[name] = item
+                self._versions[name] = current
+                self._checked[name] = time.monotonic()
+            logger.info('resource %s created (%.2fs)', name, time.perf_counter() - start)
+            return item
+
+    def health(self):
+        '''
+        {이름: 'ok' | 'stale' | 'failed' | 'not_created'}
+        stale = 버전이 바뀌어서 다음 get에서 다시 만들 리소스 (상태 확인 실패가 아님)
+        '''
+        with self._lock:
+            names = list(self._specs)
+        result = {}
+        for name in names:
+            with self._locks[name]:
+                with self._lock:
+                    item = self._items.get(name, _MISSING)
+                result[name] = ('not_created' if item is _MISSING
+                                else 'stale' if self._stale(name)
+                                else 'ok' if self._check(name, item, force=True) else 'failed')
+        return result
+
+    def close(self):
+        with self._lock:
+            names = list(self._items)
+        for name in names:
+            _close_all(self._discard(name))
+
+
+_MISSING = object()
+
+
+def _close_all(removed):
+    '''버린 리소스 인스턴스를 닫는다 (close()가 있는 것만, 실패는 로그만 남긴다)'''
+    for name, item in removed:
+        close = getattr(item, 'close', None)
+        if not callable(close):
+            continue
+        try:
+            close()
+            logger.info('resource %s closed', name)
+        except Exception:
+            logger.exception('failed to close resource %s', name)
+
+
+# api_key => 레지스트리 (키가 다르면 임베딩/llm 클라이언트도 따로 만든다)
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def _vector_store(resources):
+    from langchain_chroma import Chroma
+
+    embedding = resources.get('embedding')
+    persist_directory = './chroma_store'
+    #처음 만들 때는 Chroma.from_documents(...,embedding,....)
+    #기존 만들어진 크로마 로딩시에는 Chroma(...,embedding_function,...)
+    if os.getenv('RAG_VECTOR_BACKEND') == 'numpy' and index_exists('./vector_index'):
+        # ragTest.py가 만든 numpy 인덱스: 정규화된 벡터 행렬을 mmap으로 열고
+        # 행렬-벡터 곱 한 번으로 top-k를 구한다 (몇 천 청크 규모에서는 크로마보다 빠름)
+        from ragVectorIndex import NumpyVectorStore
+        vector_store = NumpyVectorStore('./vector_index', embedding)
+    else:
+        vector_store = Chroma(
+            persist_directory = persist_directory,
+            embedding_function = embedding
+        )
+        if os.getenv('RAG_VECTOR_BACKEND') == 'ann' and index_exists('./ann_index'):
+            # IVF 근사 검색: 질의와 가까운 nprobe개 묶음만 비교 (청크가 수십만 개여도 빠름)
+            # 청크 내용은 크로마에서 ID로 가져온다
+            from ragAnnIndex import AnnIndex, AnnVectorStore
+            vector_store = AnnVectorStore(AnnIndex('./ann_index', nprobe = int(os.getenv('RAG_ANN_NPROBE', 8))),
+                                          vector_store, embedding)
+    print('# 벡터 스토아 로딩 성공###')
+    return vector_store
+
+
+def _check_vector_store(vector_store):
+    # 크로마는 컬렉션을 실제로 조회해본다 (sqlite 파일이 지워졌거나 잠겼으면 실패)
+    store = getattr(vector_store, 'docstore', vector_store)
+    if hasattr(store, '_collection'):
+        store._collection.count()
+    return True
+
+
+def _query_augument_chain(resources):
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.prompts.chat import SystemMessagePromptTemplate, HumanMessagePromptTemplate
+
+    query_augumentation_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template("""
+            너는 질문 보정 전문 AI야.
+            이전 대화를 참고해 모호한 질문을 명확히 바꾸는 게 목적이야.
+            대명사나 이, 저, 그와 같은 표현을 명확한 명사로 표현해
+            이전 대화 맥락과 상관없이, 새로운 질문에 대한 대상 도시나 주제를 명확하게 파악하고 보정해.
+            보정된 질문이 원래 질문의 의도와 다르게 해석되지 않도록 주의해
+
+            **절대로 질문에 대한 답변을 하지 말고, 보정된 질문 문장 하나만 출력해.**
+            예시: 서울의 녹지 공간 확대 계획은 무엇인가요?
+            """),
+        #MessagesPlaceholder(variable_name="messages"),
+        # 과거 대화 삽입 (이전 대화가 messages변수에 들어가서 대화의 맥락을 구성)
+
+        HumanMessagePromptTemplate.from_template("{query}")
+        # 새로운 질문 (마지막으로 {query}에 새로운 질문으로 들어감)
+    ])
+    return query_augumentation_prompt | resources.get('llm')
+    #llm이 모호한 질문을 명확하게 바꿔준다
+
+
+def _document_chain(resources):
+    from langchain_classic.chains.combine_documents import create_stuff_documents_chain
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.prompts.chat import SystemMessagePromptTemplate
+
+    template="사용자 질문에 대해 context에 기반해서 답변하세요\n\n{context}"
+    qna_prompt = ChatPromptTemplate([
+        SystemMessagePromptTemplate.from_template(template),
+        MessagesPlaceholder(variable_name = "messages") #대화 히스토리 포함
+    ])
+    return create_stuff_documents_chain(resources.get('llm'), qna_prompt)
+    #문서 조각을 하나로 합쳐서 llm의 context에 집어넣고(채우고) 결과를 생성=>문서체인을 만든다
+
+
+def _retriever(resources):
+    vector_store = resources.get('vector_store')
+    #리트리버 (검색)
+    retriever = vector_store.as_retriever(k=3)
+    #k=3: 코사인 유사도를 이용해서 유사한 문서 조각 3개를 가져오도록 설정
+    if index_exists('./bm25_index'):
+        # ragTest.py가 만든 BM25 역색인이 있으면 키워드 검색 결과도 같이 쓴다 (RRF로 순위 합치기)
+        # 정확한 용어가 있는 질문에서 k=3만으로도 맞는 청크가 올라온다
+        from ragHybrid import BM25Index, HybridRetriever
+        retriever = HybridRetriever(vector_store = vector_store,
+                                    keyword_index = BM25Index('./bm25_index'), k = 3)
+
+    # 검색된 청크의 앞뒤 청크를 붙인다 (ragTest.py가 인제스트할 때 청크 순서를 기록해둔 경우)
+    if os.path.exists('./data/chunks.sqlite3'):
+        from ragNeighbors import ChunkStore, NeighborRetriever
+        retriever = NeighborRetriever(retriever = retriever, chunk_store = ChunkStore(), window = 1)
+
+    # 보정된 질문에 나온 도시 문서(source)만 검색한다 (도시가 없거나 결과가 없으면 전체 검색)
+    # 도시별 키워드는 ragRouter.DEFAULT_PARTITIONS
+    from ragRouter import RoutedRetriever
+    retriever = RoutedRetriever(retriever = retriever)
+
+    # 같은 질문이 반복되면 임베딩/검색 없이 메모리 캐시에서 바로 가져온다 (LRU, 10분 TTL)
+    # ragTest.py로 다시 인제스트하면 인덱스 파일이 바뀌므로 캐시가 자동으로 비워진다
+    from ragCache import CachedRetriever, LRUCache
+    return CachedRetriever(retriever = retriever,
+                           cache = LRUCache(max_items = 256, ttl = 600))
+
+
+def rag_resources(api_key):
+    '''
+    ragChat.py의 리소스를 등록한 레지스트리 (api_key마다 하나, 같은 키로 다시 부르면 같은 레지스트리)
+    처음 등록한 키가 조용히 쓰이지 않도록 키마다 따로 만든다
+    '''
+    with _registries_lock:
+        if api_key not in _registries:
+            _registries[api_key] = _register(ResourceRegistry(), api_key)
+        return _registries[api_key]
+
+
+def _register(registry, api_key):
+    from ragHistory import make_summarizer
+
+    def embedding(resources):
+        from langchain_openai import OpenAIEmbeddings
+        from ragEmbeddings import CachedEmbeddings, MicroBatchEmbeddings
+        embeddings = OpenAIEmbeddings(api_key=api_key, model='text-embedding-3-large')
+        #여러 세션에서 동시에 들어온 질문은 몇 ms 동안 모아서 한 번의 요청으로 임베딩한다
+        #(RAG_EMBED_BATCH_MS=0 이면 끄기, 기다리는 시간은 최대 RAG_EMBED_BATCH_MS)
+        window_ms = float(os.getenv('RAG_EMBED_BATCH_MS', 5))
+        if window_ms > 0:
+            embeddings = MicroBatchEmbeddings(embeddings, window = window_ms / 1000)
+        #자주 묻는 질문은 임베딩 캐시(./data/cache/embeddings.sqlite3)에서 바로 가져온다
+        return CachedEmbeddings(embeddings)
+
+    def llm(resources):
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(model = "gpt-4o-mini", api_key = api_key)
+
+    def augmenter(resources):
+        #도시가 들어간 완전한 질문은 보정(LLM 호출)을 건너뛴다 (규칙 기반 로컬 판단)
+        #판단 결과/절약 추정치는 ragAugment 로거로 남는다 (RAG_AUGMENT_ALWAYS=1 이면 항상 보정)
+        from ragAugment import AdaptiveAugmenter
+        return AdaptiveAugmenter(resources.get('query_augument_chain'),
+                                 enabled = os.getenv('RAG_AUGMENT_ALWAYS') != '1')
+
+    def answer_cache(resources):
+        # 의미 기반 답변 캐시: 보정된 질문이 이전 질문과 충분히 비슷하면(코사인 유사도 >= threshold)
+        # 검색/LLM 답변 생성 없이 이전 답변을 그대로 스트리밍한다
+        # threshold는 RAG_ANSWER_CACHE_THRESHOLD로 조정 (answer_cache.hit_rate_at(0.9) 등으로 적중률 비교)
+        from ragCache import SemanticAnswerCache
+        return SemanticAnswerCache(resources.get('embedding'),
+                                   threshold = float(os.getenv('RAG_ANSWER_CACHE_THRESHOLD', 0.92)))
+
+    # 인덱스 파일을 메모리로 읽어두는 리소스는 다시 인제스트하면 새로 연다
+    # version은 ragTest.py가 인제스트/인덱스 빌드 뒤에 기록하는 ./index_version
+    # (크로마 파일 수정 시각은 스토어를 열거나 질의만 해도 바뀌므로 쓰지 않는다)
+    registry.register('embedding', embedding)
+    registry.register('llm', llm)
+    registry.register('vector_store', _vector_store, check=_check_vector_store, version=index_version)
+    registry.register('retriever', _retriever, version=index_version)
+    registry.register('query_augument_chain', _query_augument_chain)
+    registry.register('document_chain', _document_chain)
+    registry.register('augmenter', augmenter)
+    registry.register('answer_cache', answer_cache)
+    registry.register('history_summarizer',
+                      lambda resources: make_summarizer(resources.get('llm')))
+    return registry
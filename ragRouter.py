@@ -0,0 +1,68 @@
+# ragRouter.py
+'''
+출처(source) 파티션 검색
+서울/뉴욕 청크가 한 컬렉션에 섞여 있어서 모든 질문이 두 도시를 다 검색한다
+query_augument_chain이 이미 대상 도시를 질문에 적어주므로 ("서울의 녹지 공간 확대 계획은?")
+보정된 질문에 나온 도시의 문서(source)만 검색하면 검색량이 절반으로 줄고,
+도시를 더 추가해도 질문 하나가 검색하는 양은 늘지 않는다
+
+- 파티션 = 청크 메타데이터의 source (크로마 메타데이터 필터, 자체 인덱스는 source 코드 배열)
+- route_sources: 보정된 질문에서 도시 키워드를 찾아 검색할 source 목록을 고른다
+- RoutedRetriever: 고른 파티션만 검색하고, 못 고르거나 결과가 없으면 전체를 검색한다
+'''
+from langchain_core.retrievers import BaseRetriever
+
+# source 경로 => 질문에서 찾을 키워드 (소문자로 비교)
+# 새 도시 문서를 ragTest.py에 추가하면 여기에도 한 줄 추가한다
+DEFAULT_PARTITIONS = {
+    './data/2040_seoul_plan.pdf': ['서울', 'seoul'],
+    './data/OneNYC_2050_Strategic_Plan.pdf': ['뉴욕', 'new york', 'nyc', 'onenyc'],
+}
+
+
+def route_sources(text, partitions=None):
+    '''text에 키워드가 나오는 source 목록 (하나도 없으면 None => 전체 검색)'''
+    partitions = partitions or DEFAULT_PARTITIONS
+    text = text.lower()
+    sources = [source for source, keywords in partitions.items()
+               if any(keyword in text for keyword in keywords)]
+    return sources or None
+
+
+def source_filter(sources):
+    '''source 목록 => 크로마 메타데이터 필터 (None이면 필터 없음)'''
+    if not sources:
+        return None
+    if len(sources) == 1:
+        return {'source': sources[0]}
+    return {'source': {'$in': list(sources)}}
+
+
+def filter_sources(filter):
+    '''source_filter가 만든 필터 => source 집합 (source 조건이 없으면 None)'''
+    if not filter or 'source' not in filter:
+        return None
+    condition = filter['source']
+    if isinstance(condition, dict):
+        return set(condition.get('$in', []))
+    return {condition}
+
+
+class RoutedRetriever(BaseRetriever):
+    '''
+    보정된 질문으로 파티션을 골라 검색하는 리트리버
+    - retriever: filter 인자를 받는 리트리버 (as_retriever(), HybridRetriever)
+    - partitions: source => 키워드 (None이면 DEFAULT_PARTITIONS)
+    invoke(query, route_text=보정된 질문)으로 부르면 route_text로 파티션을 고른다
+    '''
+
+    retriever: BaseRetriever
+    partitions: dict = None
+
+    def _get_relevant_documents(self, query, *, run_manager=None, route_text=None):
+        sources = route_sources(route_text or query, self.partitions)
+        if sources:
+            docs = self.retriever.invoke(query, filter=source_filter(sources))
+            if docs:
+                return docs
+        return self.retriever.invoke(query)
@@ -0,0 +1,456 @@
+# ragServer.py
+'''
+RAG 파이프라인 비동기 HTTP 서비스 (SSE 토큰 스트리밍)
+ragChat.py는 Streamlit 스크립트라서 세션마다 파이프라인 하나가 블로킹으로 돌고, API 클라이언트는 쓸 수 없다
+
+같은 파이프라인(질문 보정 => 검색 => document_chain 스트리밍)을 asyncio HTTP 서버로 연다
+- 리소스(프롬프트, chroma_store, 리트리버, 캐시)는 ragResources의 팩토리를 그대로 쓴다
+- 토큰은 server-sent events로 나오는 대로 보낸다 (document_chain.astream)
+- 동시 처리 개수 제한: 최대 max_concurrency개 처리, max_queue개까지 대기, 나머지는 바로 503
+- 취소: 클라이언트가 연결을 끊으면 파이프라인 task를 취소한다 => LLM 스트리밍 요청도 닫혀서
+  더 이상 토큰(비용)이 나오지 않는다 (이미 스레드에서 돌고 있는 보정/검색은 끝까지 돈다)
+- 종료: SIGINT/SIGTERM => 새 연결을 받지 않고, 처리 중인 요청은 drain_timeout초까지 기다린 뒤 취소
+의존성을 늘리지 않도록 표준 라이브러리 asyncio 스트림으로 HTTP/1.1을 직접 처리한다 (요청마다 연결을 닫음)
+
+API
+- POST /v1/chat  {"messages": [{"role": "user", "content": "..."}], "stream": true}
+  stream=true  => text/event-stream: query, (cache), docs, token..., done (실패하면 error)
+  stream=false => {"answer", "query", "sources", "cached"}
+  대화 히스토리는 클라이언트가 보낸다 (토큰 예산 안으로 잘라서 쓴다)
+- GET /health => 리소스 상태 + 처리/대기 중인 요청 수 + 통계
+
+실행: python ragServer.py --port 8000 --max-concurrency 8
+부하 테스트 (API 키 없이, 로컬 스텁 LLM/임베딩 서버):
+  python ragStubServer.py --port 8100 --latency 0.2 --token-delay 0.02
+  OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=stub python ragServer.py --port 8000
+  python ragServer.py --load-test http://127.0.0.1:8000 --requests 200 --concurrency 32
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from ragAugment import depends_on_history
+from ragCache import stream_text
+from ragContext import pack_context
+from ragHistory import HistoryManager
+from ragHybrid import fuse_documents
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = "너는 문서에 기반하여 답변하는 도시정책 전문가야"
+MAX_HEADER_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+_ROLES = {'system': SystemMessage, 'user': HumanMessage, 'human': HumanMessage,
+          'assistant': AIMessage, 'ai': AIMessage}
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class BadRequest(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    '''HTTP 요청 하나 => (method, path, headers, body)'''
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise BadRequest('header too large', 413)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise BadRequest('malformed request line')
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > MAX_BODY_BYTES:
+        raise BadRequest('body too large', 413)
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+
+def _head(status, content_type, extra=None):
+    lines = [f'HTTP/1.1 {status} {_REASONS.get(status, "")}', f'Content-Type: {content_type}',
+             'Connection: close', *(extra or [])]
+    return ('\r\n'.join(lines) + '\r\n').encode('latin-1')
+
+
+async def send_json(writer, status, body, extra=None):
+    data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    writer.write(_head(status, 'application/json; charset=utf-8',
+                       [f'Content-Length: {len(data)}', *(extra or [])]) + b'\r\n' + data)
+    await writer.drain()
+
+
+def sse(event, data):
+    '''server-sent event 한 개 (data는 JSON)'''
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8')
+
+
+def to_messages(items):
+    '''[{"role", "content"}] => langchain 메시지 (시스템 메시지가 없으면 ragChat과 같은 것을 앞에 넣는다)'''
+    if not isinstance(items, list) or not items:
+        raise BadRequest('messages must be a non-empty list')
+    messages = []
+    for item in items:
+        try:
+            messages.append(_ROLES[item['role']](str(item['content'])))
+        except (KeyError, TypeError):
+            raise BadRequest(f'invalid message: {item!r}')
+    if not isinstance(messages[-1], HumanMessage):
+        raise BadRequest('last message must be from the user')
+    if not any(isinstance(m, SystemMessage) for m in messages):
+        messages.insert(0, SystemMessage(SYSTEM_PROMPT))
+    return messages
+
+
+class RagServer:
+    '''
+    RAG 파이프라인 HTTP 서버
+    - resources: ragResources.rag_resources(api_key) (ragChat.py와 같은 레지스트리)
+    - max_concurrency: 동시에 처리하는 요청 수 (LLM/임베딩 API 동시 호출 수를 제한)
+    - max_queue, queue_timeout: 대기 가능한 요청 수와 대기 시간 (넘으면 503 + Retry-After)
+    - history_tokens, context_tokens: 대화 히스토리 / 검색 context 토큰 예산
+    - pipeline_mode: 보정을 기다리는 동안 원래 질문으로 먼저 검색 (ragChat.py의 RAG_PIPELINE)
+    '''
+
+    def __init__(self, resources, max_concurrency=8, max_queue=32, queue_timeout=10.0,
+                 history_tokens=1500, context_tokens=2000, pipeline_mode=True, drain_timeout=30.0):
+        self.resources = resources
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.history_tokens = history_tokens
+        self.context_tokens = context_tokens
+        self.pipeline_mode = pipeline_mode
+        self.drain_timeout = drain_timeout
+        self._slots = None    # 이벤트 루프 안에서 만든다 (serve)
+        self._waiting = 0
+        self._running = 0
+        self._connections = set()
+        self.stats = {'requests': 0, 'completed': 0, 'rejected': 0, 'cancelled': 0,
+                      'failed': 0, 'cached': 0}
+
+    def _parts(self):
+        # 레지스트리 get은 상태 확인/다시 만들기가 있을 수 있으므로 스레드에서 부른다
+        get = self.resources.get
+        return get('augmenter'), get('retriever'), get('answer_cache'), get('document_chain')
+
+    async def answer_events(self, messages):
+        '''질문 보정 => 검색 => 답변 스트리밍, (event, data)를 차례로 내보낸다'''
+        prompt = messages[-1].content
+        augmenter, retriever, answer_cache, document_chain = await asyncio.to_thread(self._parts)
+
+        #보정을 기다리는 동안 원래 질문으로 검색을 시작한다
+        raw_docs = (asyncio.ensure_future(asyncio.to_thread(retriever.invoke, prompt))
+                    if self.pipeline_mode else None)
+        try:
+            augmented_query = await asyncio.to_thread(augmenter.invoke, prompt)
+            query = augmented_query.content
+            yield 'query', {'query': query}
+
+            #앞 대화에 따라 답이 달라지는 질문은 답변 캐시를 쓰지 않는다 (키에 대화가 없음)
+            use_answer_cache = not depends_on_history(prompt, messages)
+            if use_answer_cache and (cached := await asyncio.to_thread(answer_cache.lookup, query)):
+                answer, score = cached
+                self.stats['cached'] += 1
+                yield 'cache', {'score': round(score, 4)}
+                for piece in stream_text(answer):
+                    yield 'token', {'text': piece}
+                return
+
+            if query == prompt and raw_docs is not None:
+                docs = await raw_docs
+                raw_docs = None
+            else:
+                #보정을 건너뛰었으면 같은 질문을 두 번 붙이지 않는다
+                docs = await asyncio.to_thread(retriever.invoke,
+                                               prompt if query == prompt else f"{prompt}\n{query}",
+                                               route_text = query)
+            if raw_docs is not None:
+                docs = fuse_documents([docs, await raw_docs], weights = [1.0, 0.5])
+                raw_docs = None
+
+            context_docs = await asyncio.to_thread(pack_context, docs, self.context_tokens)
+            yield 'docs', [{'source': doc.metadata.get('source'), 'page': doc.metadata.get('page')}
+                           for doc in context_docs]
+
+            history = HistoryManager(max_tokens = self.history_tokens)
+            chunks = []
+            async for chunk in document_chain.astream({
+                "messages": history.messages_for(messages),
+                "context": context_docs
+            }):
+                chunks.append(chunk)
+                yield 'token', {'text': chunk}
+            #취소되지 않고 끝까지 받은 답변만 캐시에 넣는다
+            if use_answer_cache:
+                await asyncio.to_thread(answer_cache.store, query, ''.join(chunks))
+        finally:
+            if raw_docs is not None:
+                raw_docs.cancel()
+
+    async def _stream(self, writer, messages):
+        writer.write(_head(200, 'text/event-stream; charset=utf-8',
+                           ['Cache-Control: no-cache', 'X-Accel-Buffering: no']) + b'\r\n')
+        start = time.perf_counter()
+        try:
+            async for event, data in self.answer_events(messages):
+                writer.write(sse(event, data))
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            raise
+        except Exception as e:
+            logger.exception('pipeline failed')
+            self.stats['failed'] += 1
+            writer.write(sse('error', {'message': str(e)}))
+            await writer.drain()
+            return
+        writer.write(sse('done', {'seconds': round(time.perf_counter() - start, 3)}))
+        await writer.drain()
+        self.stats['completed'] += 1
+
+    async def _collect(self, writer, messages):
+        result = {'answer': '', 'query': None, 'sources': [], 'cached': False}
+        try:
+            async for event, data in self.answer_events(messages):
+                if event == 'token':
+                    result['answer'] += data['text']
+                elif event == 'query':
+                    result['query'] = data['query']
+                elif event == 'docs':
+                    result['sources'] = data
+                elif event == 'cache':
+                    result['cached'] = True
+        except (asyncio.CancelledError, ConnectionError):
+            raise
+        except Exception as e:
+            logger.exception('pipeline failed')
+            self.stats['failed'] += 1
+            return await send_json(writer, 500, {'error': str(e)})
+        await send_json(writer, 200, result)
+        self.stats['completed'] += 1
+
+    async def _until_disconnect(self, reader, coro):
+        '''coro를 실행하다가 클라이언트가 연결을 끊으면(EOF) 취소한다'''
+        work = asyncio.ensure_future(coro)
+        gone = asyncio.ensure_future(reader.read(1))
+        try:
+            await asyncio.wait({work, gone}, return_when = asyncio.FIRST_COMPLETED)
+            if not work.done() and (gone.exception() is not None or not gone.result()):
+                self.stats['cancelled'] += 1
+                logger.info('client disconnected, cancelling request')
+                work.cancel()
+            with suppress(asyncio.CancelledError, ConnectionError):
+                await work
+        finally:
+            for task in (work, gone):
+                task.cancel()
+
+    async def _chat(self, reader, writer, body):
+        try:
+            payload = json.loads(body or b'{}')
+            messages = to_messages(payload.get('messages'))
+        except (json.JSONDecodeError, AttributeError):
+            raise BadRequest('body must be a JSON object')
+
+        #처리 슬롯이 없으면 잠깐 기다리고, 대기열이 차 있거나 오래 걸리면 바로 503
+        if self._waiting >= self.max_queue:
+            self.stats['rejected'] += 1
+            return await send_json(writer, 503, {'error': 'server busy'}, ['Retry-After: 1'])
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats['rejected'] += 1
+            return await send_json(writer, 503, {'error': 'server busy'}, ['Retry-After: 1'])
+        finally:
+            self._waiting -= 1
+
+        self._running += 1
+        try:
+            respond = self._stream if payload.get('stream', True) else self._collect
+            await self._until_disconnect(reader, respond(writer, messages))
+        finally:
+            self._running -= 1
+            self._slots.release()
+
+    async def handle(self, reader, writer):
+        '''연결 하나 = 요청 하나'''
+        self._connections.add(asyncio.current_task())
+        try:
+            try:
+                method, path, _, body = await asyncio.wait_for(read_request(reader), 30)
+                self.stats['requests'] += 1
+                if path == '/v1/chat':
+                    if method != 'POST':
+                        raise BadRequest('use POST', 405)
+                    await self._chat(reader, writer, body)
+                elif path == '/health':
+                    health = await asyncio.to_thread(self.resources.health)
+                    await send_json(writer, 200, {
+                        'resources': health, 'running': self._running, 'waiting': self._waiting,
+                        'max_concurrency': self.max_concurrency, **self.stats})
+                else:
+                    raise BadRequest(f'unknown path {path}', 404)
+            except BadRequest as e:
+                await send_json(writer, e.status, {'error': str(e)})
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, UnicodeDecodeError, ValueError):
+                await send_json(writer, 400, {'error': 'malformed request'})
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def serve(self, host='127.0.0.1', port=8000, ready=None):
+        '''서버 실행 (SIGINT/SIGTERM 또는 ready로 받은 stop 이벤트가 set되면 종료)'''
+        loop = asyncio.get_running_loop()
+        # 요청마다 보정/검색이 동시에 스레드를 하나씩 쓴다
+        loop.set_default_executor(ThreadPoolExecutor(max_workers = self.max_concurrency * 2 + 4))
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        # 첫 요청이 리소스 생성(크로마 열기 등)을 기다리지 않도록 미리 만든다
+        await asyncio.to_thread(self._parts)
+
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError, RuntimeError, ValueError):
+                loop.add_signal_handler(sig, stop.set)
+        server = await asyncio.start_server(self.handle, host, port, limit = MAX_HEADER_BYTES)
+        logger.info('RAG server listening on http://%s:%d', *server.sockets[0].getsockname()[:2])
+        if ready is not None:
+            ready(server, stop)
+        await stop.wait()
+
+        # 새 연결은 받지 않고, 처리 중인 요청은 drain_timeout초까지 기다린다
+        server.close()
+        pending = set(self._connections)
+        logger.info('shutting down, waiting for %d request(s)', len(pending))
+        if pending:
+            _, pending = await asyncio.wait(pending, timeout = self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions = True)
+        await server.wait_closed()
+        logger.info('stopped: %s', self.stats)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+DEFAULT_LOAD_QUERIES = [
+    "서울의 녹지 공간 확대 계획은 무엇인가요?",
+    "뉴욕의 기후 변화 대응 정책은 무엇인가요?",
+    "서울의 대중교통 개선 방향을 알려줘",
+    "OneNYC의 주거 정책 목표는?",
+]
+
+
+async def load_test(url, queries=None, requests=100, concurrency=16, timeout=120.0):
+    '''
+    /v1/chat 부하 테스트 => 처리량, 첫 토큰 시간(ttft)과 전체 지연 시간 백분위
+    - url: 서버 주소 (예: http://127.0.0.1:8000)
+    - concurrency: 동시에 보내는 요청 수
+    '''
+    import httpx
+
+    queries = queries or DEFAULT_LOAD_QUERIES
+    slots = asyncio.Semaphore(concurrency)
+    ttft, latency, statuses = [], [], {}
+    tokens = 0
+
+    async def one(client, i):
+        nonlocal tokens
+        async with slots:
+            start = time.perf_counter()
+            first = None
+            status = 'ok'
+            try:
+                body = {'messages': [{'role': 'user', 'content': queries[i % len(queries)]}]}
+                async with client.stream('POST', f'{url.rstrip("/")}/v1/chat', json = body) as response:
+                    if response.status_code != 200:
+                        await response.aread()
+                        status = str(response.status_code)
+                    else:
+                        async for line in response.aiter_lines():
+                            if line == 'event: token':
+                                tokens += 1
+                                first = first or time.perf_counter()
+                            elif line == 'event: error':
+                                status = 'error'
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 'ok':
+                latency.append(time.perf_counter() - start)
+                if first is not None:
+                    ttft.append(first - start)
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout = timeout,
+                                 limits = httpx.Limits(max_connections = concurrency)) as client:
+        await asyncio.gather(*(one(client, i) for i in range(requests)))
+    seconds = time.perf_counter() - start
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    return {
+        'requests': requests, 'concurrency': concurrency, 'statuses': statuses,
+        'seconds': round(seconds, 3), 'requests_per_s': round(len(latency) / seconds, 2),
+        'tokens_per_s': round(tokens / seconds, 1),
+        'ttft_ms_p50': ms(_percentile(ttft, 0.5)), 'ttft_ms_p95': ms(_percentile(ttft, 0.95)),
+        'latency_ms_p50': ms(_percentile(latency, 0.5)), 'latency_ms_p95': ms(_percentile(latency, 0.95)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RAG 파이프라인 HTTP 서버 (SSE)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-concurrency', type=int, default=int(os.getenv('RAG_MAX_CONCURRENCY', 8)))
+    parser.add_argument('--max-queue', type=int, default=32, help='대기 가능한 요청 수')
+    parser.add_argument('--queue-timeout', type=float, default=10.0, help='처리 슬롯 대기 시간(초)')
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help='종료할 때 요청 대기 시간(초)')
+    parser.add_argument('--load-test', metavar='URL', help='서버 대신 부하 테스트 클라이언트 실행')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    if args.load_test:
+        print(json.dumps(asyncio.run(load_test(args.load_test, requests = args.requests,
+                                               concurrency = args.concurrency)),
+                         ensure_ascii = False, indent = 2))
+    else:
+        from dotenv import load_dotenv
+        from ragResources import rag_resources
+
+        load_dotenv()
+        api_key = os.getenv('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError('api key 없음')
+        server = RagServer(rag_resources(api_key),
+                           max_concurrency = args.max_concurrency,
+                           max_queue = args.max_queue,
+                           queue_timeout = args.queue_timeout,
+                           history_tokens = int(os.getenv('RAG_HISTORY_TOKENS', 1500)),
+                           context_tokens = int(os.getenv('RAG_CONTEXT_TOKENS', 2000)),
+                           pipeline_mode = os.getenv('RAG_PIPELINE', '1') == '1',
+                           drain_timeout = args.drain_timeout)
+        asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,160 @@
+# ragSplitter.py
+'''
+토큰 기준 청킹
+RecursiveCharacterTextSplitter(chunk_size=1000)는 "글자 수"로 자르기 때문에
+한글/영어가 섞인 문서에서는 청크마다 토큰 수가 크게 달라진다
+(한글 1000자 ≈ 1000~2000 토큰, 영어 1000자 ≈ 250 토큰)
+=> create_stuff_documents_chain에 k개 청크를 넣을 때 context 크기를 예측할 수 없다
+
+TokenAwareSplitter: 청크 크기/오버랩을 토큰 수로 지정하고,
+토큰 예산 안에서 문단 => 줄 => 문장 => 공백 순으로 자연스러운 경계를 찾는다
+청크는 항상 페이지 텍스트의 연속된 부분 문자열이므로 SpanChunk와 함께 쓸 수 있다
+
+TokenCache: 페이지 텍스트 => 토큰 시작 위치 배열을 캐시한다
+청크 크기를 바꿔서 다시 청킹해도 각 페이지는 한 번만 토큰화된다
+'''
+import hashlib
+import os
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from langchain_text_splitters import TextSplitter
+
+DEFAULT_TOKEN_CACHE_DIR = './data/cache/tokens'
+
+
+class TokenCache:
+    '''
+    텍스트 => 각 토큰의 시작 글자 위치(array) 캐시
+    메모리(LRU) => 디스크(cache_dir/인코딩명/텍스트해시.bin) => 토큰화 순서로 찾는다
+    - cache_dir: None이면 메모리 캐시만 사용
+    '''
+
+    def __init__(self, encoding_name='cl100k_base', cache_dir=DEFAULT_TOKEN_CACHE_DIR,
+                 max_items=4096):
+        self.encoding_name = encoding_name
+        self.cache_dir = os.path.join(cache_dir, encoding_name) if cache_dir else None
+        self.max_items = max_items
+        self._memory = OrderedDict()
+        self._encoding = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def _tokenize(self, text):
+        tokens = self.encoding.encode(text, disallowed_special=())
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        return array('I', offsets)
+
+    def offsets(self, text):
+        '''text의 토큰별 시작 글자 위치 (len(결과) == 토큰 수)'''
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        path = os.path.join(self.cache_dir, f'{key}.bin') if self.cache_dir else None
+        if path and os.path.exists(path):
+            offsets = array('I')
+            with open(path, 'rb') as f:
+                offsets.frombytes(f.read())
+            self.hits += 1
+        else:
+            offsets = self._tokenize(text)
+            self.misses += 1
+            if path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    offsets.tofile(f)
+                os.replace(tmp_path, path)
+
+        self._memory[key] = offsets
+        if len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+        return offsets
+
+    def count(self, text):
+        return len(self.offsets(text))
+
+
+class TokenAwareSplitter(TextSplitter):
+    '''
+    토큰 예산으로 자르는 splitter (split_documents 등 TextSplitter 인터페이스 그대로 사용)
+    - chunk_tokens: 청크 하나의 최대 토큰 수
+    - overlap_tokens: 이웃 청크끼리 겹치는 토큰 수
+    - separators: 경계로 선호하는 구분자 (앞쪽일수록 우선)
+    - token_cache: 여러 splitter가 같은 캐시를 공유하면 파라미터를 바꿔도 다시 토큰화하지 않는다
+    '''
+
+    DEFAULT_SEPARATORS = ['\n\n', '\n', '다. ', '. ', '? ', '! ', ' ']
+
+    def __init__(self, chunk_tokens=400, overlap_tokens=40, encoding_name='cl100k_base',
+                 separators=None, token_cache=None, **kwargs):
+        super().__init__(chunk_size=chunk_tokens, chunk_overlap=overlap_tokens, **kwargs)
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.separators = separators if separators is not None else self.DEFAULT_SEPARATORS
+        self.token_cache = token_cache if token_cache is not None else TokenCache(encoding_name)
+
+    def __getstate__(self):
+        # 프로세스 풀로 넘길 때 tiktoken 인코딩/메모리 캐시는 빼고 넘긴다 (디스크 캐시는 공유)
+        state = dict(self.__dict__)
+        cache = state['token_cache']
+        state['token_cache'] = TokenCache(cache.encoding_name,
+                                          os.path.dirname(cache.cache_dir) if cache.cache_dir else None,
+                                          cache.max_items)
+        return state
+
+    def count_tokens(self, text):
+        return self.token_cache.count(text)
+
+    def _find_boundary(self, text, lo, hi):
+        '''text[lo:hi] 안에서 가장 뒤에 있는 (우선순위 높은) 구분자 위치 => 청크 끝 글자 위치'''
+        for separator in self.separators:
+            index = text.rfind(separator, lo, hi)
+            if index > lo:
+                # "다. " 처럼 문장 부호가 있으면 부호까지는 이번 청크에 넣는다
+                return index + len(separator.rstrip())
+        return hi
+
+    def split_offsets(self, text):
+        '''청크들의 (시작, 끝) 글자 위치 리스트 (text[시작:끝]이 청크)'''
+        starts = self.token_cache.offsets(text)
+        n_tokens = len(starts)
+        spans = []
+        first = 0
+        while first < n_tokens:
+            last = min(first + self.chunk_tokens, n_tokens)
+            start = starts[first]
+            if last < n_tokens:
+                # 토큰 예산의 뒤쪽 절반 안에서 자연스러운 경계를 찾는다
+                end = self._find_boundary(text, starts[first + self.chunk_tokens // 2], starts[last])
+                last = max(first + 1, bisect_left(starts, end))
+            else:
+                end = len(text)
+
+            # 앞뒤 공백은 청크에 넣지 않는다
+            s, e = start, end
+            while s < e and text[s].isspace():
+                s += 1
+            while e > s and text[e - 1].isspace():
+                e -= 1
+            if s < e:
+                spans.append((s, e))
+
+            if last >= n_tokens:
+                break
+            first = max(last - self.overlap_tokens, first + 1)
+        return spans
+
+    def split_text(self, text):
+        return [text[s:e] for s, e in self.split_offsets(text)]
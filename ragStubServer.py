@@ -0,0 +1,266 @@
+# ragStubServer.py
+'''
+OpenAI API를 흉내내는 로컬 스텁 서버 (오프라인 테스트/부하 테스트용)
+- POST /v1/embeddings : 텍스트 해시로 만든 고정(deterministic) 벡터를 돌려준다
+- POST /v1/chat/completions : 정해진 길이의 가짜 답변 (stream=true면 SSE로 토큰을 하나씩 보낸다)
+  stream이 아닌 요청(질문 보정 체인)은 마지막 메시지를 그대로 돌려준다
+
+실제 API처럼 지연 시간, 분당 요청 제한(429), 무작위 서버 오류(500)를 흉내낼 수 있어서
+AsyncBatchEmbeddings의 배치/동시성/재시도를 API 키 없이 확인할 수 있다
+
+실행: python ragStubServer.py --port 8100 --latency 0.2 --rpm 600 --fail-rate 0.05
+확인: python ragStubServer.py --check  (AsyncBatchEmbeddings 배치/재시도/실패 시 취소 자동 확인)
+사용: AsyncBatchEmbeddings(base_url='http://127.0.0.1:8100/v1', api_key='stub')
+      OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=stub python ragServer.py (부하 테스트)
+'''
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_embedding(text, dim):
+    '''텍스트 해시를 시드로 만든 단위 벡터 (같은 텍스트 => 항상 같은 벡터)'''
+    rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class StubState:
+    '''서버 설정 + 분당 요청 제한 + 통계'''
+
+    def __init__(self, dim=3072, latency=0.0, rpm=0, fail_rate=0.0, answer_tokens=40, token_delay=0.0):
+        self.dim = dim
+        self.answer_tokens = answer_tokens
+        self.token_delay = token_delay
+        self.latency = latency
+        self.rpm = rpm
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.window = []  # 최근 60초 요청 시각
+        self.stats = {'requests': 0, 'rate_limited': 0, 'failed': 0, 'inputs': 0,
+                      'completions': 0, 'streamed_tokens': 0, 'disconnected': 0}
+
+    def admit(self):
+        '''분당 요청 제한을 넘으면 False (=> 429)'''
+        with self.lock:
+            self.stats['requests'] += 1
+            if not self.rpm:
+                return True
+            now = time.monotonic()
+            self.window = [t for t in self.window if now - t < 60]
+            if len(self.window) >= self.rpm:
+                self.stats['rate_limited'] += 1
+                return False
+            self.window.append(now)
+            return True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None  # make_server에서 채운다
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # 부하 테스트할 때 콘솔이 넘치지 않도록 요청 로그는 끈다
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_POST(self):
+        body = self._read_json()
+        if not self.state.admit():
+            return self._send_json(429, {'error': {'message': 'Rate limit reached (stub)',
+                                                   'type': 'requests', 'code': 'rate_limit_exceeded'}})
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if self.state.fail_rate and random.random() < self.state.fail_rate:
+            with self.state.lock:
+                self.state.stats['failed'] += 1
+            return self._send_json(500, {'error': {'message': 'Internal error (stub)',
+                                                   'type': 'server_error'}})
+        if self.path.rstrip('/').endswith('/embeddings'):
+            return self._embeddings(body)
+        if self.path.rstrip('/').endswith('/chat/completions'):
+            return self._chat_completions(body)
+        return self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+
+    def _embeddings(self, body):
+        inputs = body.get('input', [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dim = body.get('dimensions') or self.state.dim
+        with self.state.lock:
+            self.state.stats['inputs'] += len(inputs)
+        data = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(str(text), dim)
+            if body.get('encoding_format') == 'base64':
+                # openai 클라이언트 기본값은 base64(float32 little-endian)
+                vector = base64.b64encode(array('f', vector).tobytes()).decode('ascii')
+            data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+        tokens = sum(len(str(text)) for text in inputs)
+        self._send_json(200, {
+            'object': 'list', 'data': data, 'model': body.get('model', 'stub'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+
+    def _chat_completions(self, body):
+        messages = body.get('messages') or [{}]
+        last = str(messages[-1].get('content', ''))
+        model = body.get('model', 'stub')
+        created = int(time.time())
+        with self.state.lock:
+            self.state.stats['completions'] += 1
+        if not body.get('stream'):
+            return self._send_json(200, {
+                'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': last},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(last), 'completion_tokens': len(last),
+                          'total_tokens': 2 * len(last)},
+            })
+
+        # 스트리밍: 길이를 모르므로 Content-Length 없이 보내고 연결을 닫는다
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta, finish_reason=None):
+            chunk = {'id': 'chatcmpl-stub', 'object': 'chat.completion.chunk', 'created': created,
+                     'model': model,
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            self.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+
+        try:
+            event({'role': 'assistant', 'content': ''})
+            for i in range(self.state.answer_tokens):
+                if self.state.token_delay:
+                    time.sleep(self.state.token_delay)
+                event({'content': f'stub{i} '})
+                with self.state.lock:
+                    self.state.stats['streamed_tokens'] += 1
+            event({}, 'stop')
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 클라이언트(ragServer)가 요청을 취소하면 연결이 끊긴다 => 더 보내지 않는다
+            with self.state.lock:
+                self.state.stats['disconnected'] += 1
+
+
+def make_server(host='127.0.0.1', port=8100, **kwargs):
+    '''스텁 서버 생성 (port=0이면 빈 포트 사용, server.state.stats로 통계 확인)'''
+    state = StubState(**kwargs)
+    handler = type('BoundStubHandler', (StubHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def start_in_thread(**kwargs):
+    '''테스트/벤치마크용: 백그라운드 스레드에서 서버를 띄우고 (server, base_url)을 돌려준다'''
+    server = make_server(port=0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'http://{host}:{port}/v1'
+
+
+def self_check():
+    '''
+    스텁 서버를 띄워 AsyncBatchEmbeddings를 확인한다 (실패하면 AssertionError)
+    1) 배치: 결과 순서와 값, 요청 수 = 배치 수
+    2) 재시도: 500 오류가 섞여도 모든 배치가 결국 성공
+    3) 실패: 배치 하나가 재시도를 다 쓰면 예외가 나고, 나머지 배치는 더 이상 요청을 보내지 않는다
+    '''
+    import asyncio
+
+    import openai
+
+    from ragEmbeddings import AsyncBatchEmbeddings
+
+    server, base_url = start_in_thread(dim=32)
+    stats = server.state.stats
+    texts = [f'문장 {i}' for i in range(100)]
+    expected = [fake_embedding(text, 32) for text in texts]
+    embeddings = AsyncBatchEmbeddings(model='stub', dimensions=32, api_key='stub', base_url=base_url,
+                                      max_batch_size=16, max_concurrency=4,
+                                      requests_per_minute=None, tokens_per_minute=None)
+    try:
+        assert embeddings.embed_documents(texts) == expected, 'batched vectors out of order'
+        assert stats['requests'] == len(embeddings.make_batches(texts)) == 7, stats
+
+        random.seed(0)
+        server.state.fail_rate = 0.3
+        embeddings.max_retries = 10
+        assert embeddings.embed_documents(texts) == expected, 'vectors differ after retries'
+        assert embeddings.stats['retries'] > 0 and stats['failed'] == embeddings.stats['retries'], \
+            (stats, embeddings.stats)
+
+        # embed_documents는 asyncio.run이 끝나면서 남은 task를 취소하므로
+        # 이벤트 루프가 계속 도는 aembed_documents(서버 등)로 확인한다
+        async def fail_then_wait():
+            try:
+                await embeddings.aembed_documents(texts)
+            except openai.InternalServerError:
+                pass
+            else:
+                raise AssertionError('expected the failing batch to raise')
+            # 취소되지 않은 배치가 있으면 백오프 뒤에 (이미 닫힌 클라이언트로) 다시 요청한다
+            attempts = embeddings.stats['requests']
+            await asyncio.sleep(2.0)
+            assert embeddings.stats['requests'] == attempts, 'batches kept retrying after failure'
+
+        server.state.fail_rate = 1.0
+        embeddings.max_retries = 1
+        asyncio.run(fail_then_wait())
+    finally:
+        server.shutdown()
+    print('ok', stats, embeddings.stats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenAI API 스텁 서버')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--dim', type=int, default=3072, help='기본 임베딩 차원')
+    parser.add_argument('--latency', type=float, default=0.0, help='요청당 지연 시간(초)')
+    parser.add_argument('--rpm', type=int, default=0, help='분당 요청 제한 (0이면 제한 없음)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='500 오류 비율')
+    parser.add_argument('--answer-tokens', type=int, default=40, help='채팅 답변 토큰 수')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='스트리밍 토큰 간격(초)')
+    parser.add_argument('--check', action='store_true', help='AsyncBatchEmbeddings 자동 확인만 하고 끝낸다')
+    args = parser.parse_args()
+    if args.check:
+        self_check()
+        raise SystemExit(0)
+
+    server = make_server(args.host, args.port, dim=args.dim, latency=args.latency,
+                         rpm=args.rpm, fail_rate=args.fail_rate,
+                         answer_tokens=args.answer_tokens, token_delay=args.token_delay)
+    print(f'Stub OpenAI server: http://{args.host}:{args.port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.state.stats)
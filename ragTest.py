@@ -11,60 +11,25 @@ from langchain_community.document_loaders import PyPDFLoader
 #    print(doc.page_content[:500]) #각 페이지의 500자만 출력
 #    print('='*100)
 '''
-매번 실행할 때마다 로드할 수 없으므로 pickle을 이용해서 저장
-(데이터를 파일로 직렬화해서 저장) pickle은 객체를 그대로 파일로 직렬화해서 
-저장하고 다시 객체로 복원(역직렬화)하는 도구
-pickle을 이용하면 한 번 로드한 데이터를 저장했다가 다음 실행할 때
-바로 불러올 수 있어서 빠르다
+매번 실행할 때마다 로드할 수 없으므로 캐시에 저장해두고 다시 쓰자
+예전에는 pickle 파일이 "있는지"만 보고 캐시를 썼기 때문에
+pdf가 바뀌어도 예전 내용이 나오고, 파일 이름만 바꿔도 처음부터 다시 파싱했다
+=> ragLoader.load_pdf_cached: pdf 내용(바이트)의 해시로 캐시를 찾고
+   페이지 단위로 저장하므로 바뀐 페이지만 다시 파싱한다
+=> ragPageStore.open_pdf_store: 페이지들을 text blob + offsets + 메타데이터 컬럼으로
+   저장하고 mmap으로 연다. Document 리스트 전체를 unpickle하지 않고
+   data_seoul[10]처럼 필요한 페이지만 그때그때 읽는다
 '''
-import pickle
 import os
+from ragPageStore import open_pdf_store
 
-if os.path.exists('./data/data_seoul.pkl'):
-    #해당 파일이 있으면 로드하기 => 빠름
-    with open('./data/data_seoul.pkl','rb') as f: #읽기 모드/바이너리 모드
-        data_seoul = pickle.load(f)
-else:
-    #pkl파일 없으면 pdf를 로드하고 pkl파일로 저장
-    loader = PyPDFLoader('./data/2040_seoul_plan.pdf')
-    data_seoul = loader.load()
-    with open('./data/data_seoul.pkl','wb') as f: #쓰기 모드/바이너리 모드
-        pickle.dump(data_seoul, f)
+data_seoul = open_pdf_store('./data/2040_seoul_plan.pdf')
 
 # 페이지 일부만 확인해보자
-if os.path.exists('./data/data_seoul.pkl'):
-    print(data_seoul[10].page_content[:500])
-else:
-    print('./data/data_seoul.pkl 파일이 없어요!! 종료합니다')
-    exit(0)
-
-# 여러 문서를 읽어야 하므로 함수로 모듈화하여 재사용하자
-def load_pdf_with_pickle(pdf_path, pickle_path = None):
-    '''
-    pdf파일 로드하고 pickle로 캐싱하는 함수
-    - pdf_path: pdf파일 경로
-    - pickle_path : pickle파일 경로 (지정하지 않으면 pdf이름 기반)
-    '''
-    if pickle_path is None:
-        pickle_path = pdf_path.replace('.pdf','.pkl')
-        #pkl파일이 없으면 pdf파일명에서 .pdf를 .pkl로 대체해서 피클 경로 만들자
-
-    if os.path.exists(pickle_path):
-        with open(pickle_path,'rb') as f:
-            data=pickle.load(f)
-        print(f'Loaded from pickle: {pickle_path}')
-    else:
-        #피클 파일이 없다면 pdf 로드후 피클로 저장
-        loader= PyPDFLoader(pdf_path)
-        data = loader.load()
-        with open(pickle_path,'wb') as f:
-            pickle.dump(data, f)
-        print(f'Loaded from PDF and Saved pickle: {pickle_path}')
-    return data
+print(data_seoul[10].page_content[:500])
 
 # 뉴욕문서 읽어보자
-data_nyc = load_pdf_with_pickle('./data/OneNYC_2050_Strategic_Plan.pdf')
-#data_seoul=load_pdf_with_pickle('./data/2040_seoul_plan.pdf')
+data_nyc = open_pdf_store('./data/OneNYC_2050_Strategic_Plan.pdf')
 print("*"*70)
 data_nyc[3].page_content[:500]
 
@@ -86,6 +51,16 @@ text_splitter = RecursiveCharacterTextSplitter(chunk_size = 1000,
 # 오버랩을 적절히 사용하면 맥락이 이어지고 중요한 정보가 잘려서 사라지지 않도록
 # 할 수 있음
 
+# 글자 수 기준 청킹은 한글/영어가 섞이면 청크마다 토큰 수가 크게 달라진다
+# RAG_TOKEN_SPLITTER=1 이면 토큰 수 기준으로 청킹한다 (청크당 400토큰, 오버랩 40토큰)
+# 페이지별 토큰화 결과는 ./data/cache/tokens에 캐시되므로 크기를 바꿔 다시 청킹해도 빠르다
+if os.getenv('RAG_TOKEN_SPLITTER') == '1':
+    from ragSplitter import TokenAwareSplitter
+    text_splitter = TokenAwareSplitter(chunk_tokens = 400, overlap_tokens = 40)
+
+# 파일이 많을 때는 ragIngest.load_and_split_parallel로 로드+청킹을
+# 프로세스 풀에서 병렬로 실행할 수 있다 (결과 순서는 순차 실행과 같음)
+
 # 청크 출력하기-------------
 all_splits = text_splitter.split_documents(data_seoul)
 
@@ -103,6 +78,11 @@ print(all_splits[51].page_content)
 for i in range(len(all_splits)-1):
     all_splits[i].page_content +="\n"+all_splits[i+1].page_content[:100]
     # i번째 내용에 i+1번째 내용의 100자를 누적시키기
+# => 청크마다 새 문자열이 만들어진다 (청크 수만큼 복사)
+# 실제 인제스트(ragIngest.stream_ingest)는 청크를 페이지 저장소의 (페이지, 시작, 끝)
+# 범위(SpanChunk)로 들고 있다가 임베딩할 때만 텍스트를 만들고,
+# 오버랩도 "다음 청크 앞 100자" 범위만 기록하므로 복사가 없다
+# 지금은 인제스트에서 붙이지 않고, 검색된 청크에만 앞뒤 청크를 붙인다 (ragNeighbors)
 print('#'*100)
 print(all_splits[50].page_content)
 print('#'*100)
@@ -131,9 +111,19 @@ from langchain_chroma import Chroma
 
 load_dotenv()
 api_key = os.getenv('OPENAI_API_KEY')
-embedding = OpenAIEmbeddings(
-    model='text-embedding-3-large',api_key=api_key
-)
+#embedding = OpenAIEmbeddings(
+#    model='text-embedding-3-large',api_key=api_key
+#)
+# 같은 텍스트를 다시 임베딩하지 않도록 디스크 캐시로 감싸자
+# (모델, 차원, 텍스트 해시)가 같으면 API 호출 없이 로컬에서 벡터를 가져온다
+# 캐시에 없는 청크는 AsyncBatchEmbeddings로 임베딩한다
+# 토큰 수 기준으로 배치를 만들고, 분당 요청/토큰 한도 안에서 여러 배치를 동시에 요청한다
+# (실패한 배치만 재시도) => 순차 호출보다 인제스트가 훨씬 빠르다
+from ragEmbeddings import CachedEmbeddings, AsyncBatchEmbeddings
+embedding = CachedEmbeddings(AsyncBatchEmbeddings(
+    model='text-embedding-3-large',api_key=api_key,
+    requests_per_minute = 3000, tokens_per_minute = 1000000
+))
 #문서를 임베딩처리하고 embedding 을 벡터DB에 전달하면 =>벡터DB에 임베딩 데이터 저장
 #테스트 차원에서 질의문을 임베딩해보자
 vector = embedding.embed_query("뉴욕의 온실가스 저장 정책에 대해 알려줘")
@@ -142,14 +132,29 @@ print(vector[:10])
 
 # 벡터DB에 all_splits를 임베딩하여 저장하자########
 persist_directory = './chroma_store'
+pdf_paths = ['./data/2040_seoul_plan.pdf',
+            './data/OneNYC_2050_Strategic_Plan.pdf']
+# 문서별 청크 순서 저장소 (./data/chunks.sqlite3)
+from ragNeighbors import ChunkStore
+chunk_store = ChunkStore()
 
 if not os.path.exists(persist_directory):
     print('Creating new Chroma store')
     #처음 생성시 =Chroma.from_documents() 함수 사용
-    vector_store = Chroma.from_documents(documents = all_splits,
-                    embedding = embedding,
-                    persist_directory = persist_directory)
-                    # 문서-> 임베딩 생성+저장 
+    #vector_store = Chroma.from_documents(documents = all_splits,
+    #                embedding = embedding,
+    #                persist_directory = persist_directory)
+    #                # 문서-> 임베딩 생성+저장 
+    # from_documents는 전체 청크 리스트를 한 번에 받는다 => 문서가 많으면 메모리 부족
+    # 스트리밍: 페이지 로드 -> 청킹 -> 512개씩 임베딩 -> 저장 (메모리 = 배치 크기)
+    # 다음 청크 100자를 붙이지 않고(next_prefix_chars = 0) 청크 순서만 chunk_store에 기록한다
+    # => 검색된 청크의 앞뒤 청크는 ragChat.py에서 검색할 때 붙인다 (ragNeighbors)
+    from ragIngest import stream_ingest
+    vector_store = Chroma(persist_directory = persist_directory,
+                        embedding_function = embedding)
+    stream_ingest(pdf_paths, vector_store, text_splitter,
+                    batch_size = 512, next_prefix_chars = 0, chunk_store = chunk_store)
+    chunks_changed = True
 else:
     print('Loading existing Chroma store')
     #크로마 스토어가 있을 경우 Chroma()생성자 호출
@@ -157,6 +162,43 @@ else:
     vector_store = Chroma(persist_directory = persist_directory,
                         embedding_function = embedding)
                         #검색용
+    # 문서가 추가/변경되었으면 스토어를 지우지 말고 증분 동기화하자
+    # 청크 ID = (source, page, 내용 해시) => 이미 있는 청크는 다시 임베딩하지 않고
+    # 새로 생기거나 바뀐 청크만 임베딩, 없어진 청크는 삭제한다
+    from ragIngest import sync_ingest
+    sync_stats = sync_ingest(pdf_paths, vector_store, text_splitter,
+                            batch_size = 512, next_prefix_chars = 0, chunk_store = chunk_store)
+    chunks_changed = bool(sync_stats['added'] or sync_stats['deleted'])
+
+# 검색 전용 numpy 인덱스도 크로마 벡터로 다시 만들어두자 (임베딩 호출 없음)
+# ragChat.py에서 RAG_VECTOR_BACKEND=numpy 로 실행하면 크로마 대신 이 인덱스로 검색한다
+# 추가/삭제된 청크가 없으면 전체 벡터를 다시 읽지 않고 기존 인덱스를 그대로 쓴다
+# (지난 실행이 인덱스를 만들기 전에 끊겼으면 행 수가 크로마와 달라지므로 다시 만든다)
+from ragVectorIndex import build_from_chroma, index_meta
+vector_meta = index_meta('./vector_index')
+if (chunks_changed or vector_meta is None or vector_meta.get('mode') != 'float32'
+        or vector_meta.get('count') != vector_store._collection.count()):
+    build_from_chroma(vector_store, './vector_index', mode = 'float32')
+else:
+    print('No chunk changes, keeping ./vector_index')
+
+# 청크가 아주 많아지면 근사 검색(IVF) 인덱스를 chroma_store 옆에 둔다
+# 처음에는 크로마 벡터로 만들고, 이후에는 추가/삭제된 청크만 반영한다
+# ragChat.py에서 RAG_VECTOR_BACKEND=ann 으로 실행하면 이 인덱스로 검색한다
+from ragAnnIndex import open_or_build_ann
+open_or_build_ann('./ann_index', vector_store)
+
+# 키워드 검색용 BM25 역색인 (한글 2글자 n-gram) - ragChat.py의 하이브리드 검색에서 사용
+from ragHybrid import build_bm25_from_chroma
+build_bm25_from_chroma(vector_store, './bm25_index')
+
+# 인덱스 버전 기록 (청크 ID 집합 + 각 인덱스 버전) => ragChat.py/ragServer.py의 캐시와 리소스가
+# 이 값이 바뀔 때만 비워지고 다시 열린다 (바뀐 것이 없으면 파일을 그대로 둔다)
+from ragCache import prune_answer_cache, write_index_version
+index_version = write_index_version(vector_store)
+print('index version:', index_version)
+# 예전 버전 인덱스로 만든 답변은 이제 쓰이지 않으므로 여기서만 지운다 (ragChat.py는 지우지 않음)
+print('pruned cached answers:', prune_answer_cache(index_version))
 
 # 문서-> 임베딩 모델(벡터 생성)->크로마DB 저장(벡터 저장)
 # 질문-> 임베딩 모델(벡터 생성)->크로마DB(KNN 검색-코사인 유사도 사용)
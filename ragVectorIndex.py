@@ -0,0 +1,385 @@
+# ragVectorIndex.py
+'''
+양자화(int8/float16) + 차원 축소 벡터 인덱스
+text-embedding-3-large 벡터는 3072차원 float(청크당 12KB)이라 chroma_store가 크고 검색이 느리다
+
+인덱스 디렉터리 구조 (path/CURRENT가 가리키는 버전 디렉터리 안, ragIndexDir 참고)
+- meta.json   : 모드(int8/float16/float32), 검색 차원, 원래 차원, 개수
+- ids.json    : 청크 ID 목록 (행 번호 순서)
+- quant.npy   : 검색용 벡터 (int8 또는 float16, 앞쪽 dims 차원만 사용 = Matryoshka 축소)
+- scales.npy  : int8 모드의 차원별 스케일
+- full.npy    : 재정렬(rerank)용 원본 정밀도 벡터 (float32, 정규화, 디스크에서 mmap)
+- chunks/     : 청크 텍스트/메타데이터 (ragPageStore.PageStore 형식)
+
+검색: 작은 quant 행렬로 후보를 넉넉히 뽑고 => 후보만 full 벡터로 다시 점수를 매긴다
+=> 메모리에 올라오는 것은 quant 행렬뿐 (int8 = 4배, int8 + 1536차원 = 8배 감소)
+measure_recall로 정확 검색(float32) 대비 recall이 얼마나 떨어지는지 확인할 수 있다
+
+NumpyVectorStore: 이 인덱스를 LangChain VectorStore로 감싼 검색 백엔드 (Chroma 대체)
+- 기본 float32 모드: 정규화된 벡터 행렬(full.npy) 하나를 mmap으로 열고
+  top-k를 행렬-벡터 곱 한 번으로 구한다 => 몇 천 청크 규모에서는 Chroma보다 빠르다
+- 여는 데 몇 ms (파일을 mmap할 뿐), 여러 Streamlit 워커가 OS 페이지 캐시를 공유한다
+- as_retriever() 등 VectorStore 인터페이스를 그대로 쓸 수 있다
+'''
+import json
+import os
+import threading
+
+import numpy as np
+from langchain_core.vectorstores import VectorStore
+
+from ragIndexDir import CURRENT_FILE, abort_version, begin_version, current_dir, publish_version
+from ragPageStore import PageStore
+from ragLoader import _write_json
+from ragRouter import filter_sources
+
+INDEX_VERSION = 1
+# CURRENT 포인터 이전 형식에서 path에 바로 쓰던 파일들 (새 버전을 만들면 지운다)
+LEGACY_FILES = ('meta.json', 'ids.json', 'full.npy', 'quant.npy', 'scales.npy', 'chunks')
+_BLOCK_ROWS = 16384  # int8 행렬을 float32로 바꿀 때 한 번에 바꿀 행 수 (임시 메모리 제한)
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _quantize(full, mode, dims):
+    '''정규화된 float32 벡터 => (검색용 행렬, int8 스케일)'''
+    # Matryoshka 축소: 앞쪽 dims 차원만 잘라서 다시 정규화한다
+    reduced = _normalize(full[:, :dims]) if dims < full.shape[1] else full
+    if mode == 'float32':
+        return reduced, None
+    if mode == 'float16':
+        return reduced.astype(np.float16), None
+    if mode == 'int8':
+        # 차원별 대칭 스케일: 그 차원의 최대 절댓값이 127이 되도록
+        scales = np.abs(reduced).max(axis=0) / 127.0 if len(reduced) else np.ones(dims)
+        scales[scales == 0] = 1.0
+        quant = np.clip(np.rint(reduced / scales), -127, 127).astype(np.int8)
+        return quant, scales.astype(np.float32)
+    raise ValueError(f'unknown index mode: {mode}')
+
+
+class VectorIndex:
+    '''
+    양자화 벡터 인덱스
+    - VectorIndex.build(path, vectors, docs, mode='int8', dims=None)로 만들고
+    - VectorIndex(path)로 연다 (행렬은 mmap)
+    - build는 새 버전 디렉터리에 전부 쓴 다음 CURRENT를 바꾼다
+      => 이미 열린 VectorIndex는 예전 버전을 계속 읽고, 새로 열면 새 버전을 읽는다
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = current_dir(path)
+        if self.directory is None:
+            raise FileNotFoundError(f'no vector index in {path}')
+        directory = self.directory
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, 'ids.json'), 'r', encoding='utf-8') as f:
+            self.ids = json.load(f)
+        self.mode = self.meta['mode']
+        self.dims = self.meta['dims']
+        self.full = np.load(os.path.join(directory, 'full.npy'), mmap_mode='r')
+        if self.mode == 'float32' and self.dims == self.meta['full_dim']:
+            self.quant = self.full  # 축소/양자화가 없으면 같은 행렬을 그대로 쓴다
+        else:
+            self.quant = np.load(os.path.join(directory, 'quant.npy'), mmap_mode='r')
+        scales_path = os.path.join(directory, 'scales.npy')
+        self.scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        self.chunks = PageStore.open(os.path.join(directory, 'chunks'))
+        self._partitions = {}  # source 집합 => 행 번호 배열
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, path, vectors, docs, ids=None, mode='int8', dims=None):
+        '''
+        인덱스를 만든다
+        - vectors: (n, d) 임베딩, docs: 같은 순서의 Document 리스트
+        - mode: 'int8' | 'float16' | 'float32'
+        - dims: 검색에 쓸 앞쪽 차원 수 (None이면 전체, text-embedding-3은 1536/1024/256 등 가능)
+        '''
+        full = _normalize(vectors)
+        dims = dims or full.shape[1]
+        quant, scales = _quantize(full, mode, dims)
+        ids = list(ids) if ids is not None else [doc.id or str(i) for i, doc in enumerate(docs)]
+
+        # 다른 프로세스가 지금 버전의 .npy를 mmap으로 읽고 있을 수 있으므로 제자리에서 다시 쓰지 않는다
+        # => 임시 디렉터리에 전부 쓰고 CURRENT만 원자적으로 바꾼다
+        tmp_dir = begin_version(path)
+        try:
+            np.save(os.path.join(tmp_dir, 'full.npy'), full)
+            if not (mode == 'float32' and dims == full.shape[1]):
+                np.save(os.path.join(tmp_dir, 'quant.npy'), quant)
+            if scales is not None:
+                np.save(os.path.join(tmp_dir, 'scales.npy'), scales)
+            PageStore.write(os.path.join(tmp_dir, 'chunks'), docs)
+            _write_json(os.path.join(tmp_dir, 'ids.json'), ids)
+            _write_json(os.path.join(tmp_dir, 'meta.json'), {
+                'version': INDEX_VERSION, 'mode': mode, 'dims': dims,
+                'full_dim': int(full.shape[1]), 'count': len(ids),
+            })
+        except BaseException:
+            abort_version(tmp_dir)
+            raise
+        publish_version(path, tmp_dir, legacy=LEGACY_FILES)
+        return cls(path)
+
+    def _query(self, query_vector):
+        query = _normalize(query_vector).reshape(-1)
+        reduced = _normalize(query[:self.dims]) if self.dims < len(query) else query
+        if self.scales is not None:
+            reduced = reduced * self.scales  # q·(x*scale) = (q*scale)·x 로 스케일을 질의에 합친다
+        return query, reduced.astype(np.float32)
+
+    def approx_scores(self, reduced_query):
+        '''검색용 행렬로 모든 행의 (근사) 점수 계산'''
+        if self.quant.dtype == np.float32:
+            return self.quant @ reduced_query
+        scores = np.empty(len(self.quant), dtype=np.float32)
+        for i in range(0, len(self.quant), _BLOCK_ROWS):
+            block = np.asarray(self.quant[i:i + _BLOCK_ROWS], dtype=np.float32)
+            scores[i:i + _BLOCK_ROWS] = block @ reduced_query
+        return scores
+
+    def source_rows(self, sources):
+        '''source가 sources 중 하나인 행 번호 배열 (청크 저장소의 source 코드로 찾는다)'''
+        key = frozenset(sources)
+        if key not in self._partitions:
+            column = self.chunks.columns.get('source', {'values': [], 'codes': []})
+            codes = [code for code, value in enumerate(column['values']) if value in key]
+            self._partitions[key] = np.nonzero(np.isin(np.asarray(column['codes']), codes))[0]
+        return self._partitions[key]
+
+    def search(self, query_vector, k=4, candidates=None, rerank=True, rows=None):
+        '''
+        질의 벡터와 가장 가까운 k개 => [(행 번호, 코사인 유사도), ...]
+        - candidates: 재정렬할 후보 수 (기본 max(k * 8, 50))
+        - rerank: False면 근사 점수만으로 결과를 낸다
+        - rows: 이 행들 안에서만 검색 (source_rows로 구한 파티션)
+        '''
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return []
+        query, reduced = self._query(query_vector)
+        if rows is None:
+            scores = self.approx_scores(reduced)
+        else:
+            scores = np.asarray(self.quant[rows], dtype=np.float32) @ reduced
+        if rerank:
+            n_candidates = min(len(scores), max(k, candidates or max(k * 8, 50)))
+        else:
+            n_candidates = min(len(scores), k)
+        top = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        if rerank:
+            # 후보 행만 디스크의 원본 벡터로 다시 점수를 매긴다
+            top_rows = np.sort(top if rows is None else rows[top])
+            exact = np.asarray(self.full[top_rows], dtype=np.float32) @ query
+            order = np.argsort(-exact)[:k]
+            return [(int(top_rows[i]), float(exact[i])) for i in order]
+        order = top[np.argsort(-scores[top])][:k]
+        return [(int(i if rows is None else rows[i]), float(scores[i])) for i in order]
+
+    def exact_search(self, query_vector, k=4):
+        '''원본 float32 벡터로 전체 정확 검색 (recall 측정 기준)'''
+        query = _normalize(query_vector).reshape(-1)
+        scores = np.empty(len(self.full), dtype=np.float32)
+        for i in range(0, len(self.full), _BLOCK_ROWS):
+            scores[i:i + _BLOCK_ROWS] = np.asarray(self.full[i:i + _BLOCK_ROWS]) @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(int(i), float(scores[i])) for i in top[np.argsort(-scores[top])]]
+
+    def document(self, row):
+        doc = self.chunks[row]
+        doc.id = self.ids[row]
+        return doc
+
+    def close(self):
+        '''청크 저장소를 닫는다 (행렬 mmap은 참조가 없어지면 풀린다)'''
+        self.chunks.close()
+        self._partitions.clear()
+
+    def memory_per_vector(self):
+        '''벡터 하나당 바이트 (검색 행렬 / 원본)'''
+        return {'search_bytes': int(self.quant.dtype.itemsize * self.quant.shape[1]),
+                'full_bytes': int(self.full.dtype.itemsize * self.full.shape[1])}
+
+
+def measure_recall(index, query_vectors, k=10, candidates=None):
+    '''
+    정확 검색(float32 전체 차원) 대비 recall@k
+    - recall_approx: 양자화/축소 점수만 사용했을 때
+    - recall_rerank: 후보를 원본 벡터로 재정렬했을 때
+    '''
+    approx_hits = rerank_hits = total = 0
+    for query in query_vectors:
+        truth = {row for row, _ in index.exact_search(query, k)}
+        approx_hits += len(truth & {row for row, _ in index.search(query, k, rerank=False)})
+        rerank_hits += len(truth & {row for row, _ in index.search(query, k, candidates)})
+        total += len(truth)
+    memory = index.memory_per_vector()
+    return {
+        'k': k, 'queries': len(query_vectors), 'mode': index.mode, 'dims': index.dims,
+        'recall_approx': approx_hits / total if total else None,
+        'recall_rerank': rerank_hits / total if total else None,
+        'search_bytes_per_vector': memory['search_bytes'],
+        'compression': memory['full_bytes'] / memory['search_bytes'],
+    }
+
+
+class NumpyVectorStore(VectorStore):
+    '''
+    VectorIndex 기반 읽기 전용 VectorStore
+    - path: 인덱스 디렉터리 (build_from_chroma / from_texts로 만든다)
+    - embedding_function: 질의 임베딩 모델 (인덱스를 만들 때와 같은 모델)
+    - candidates: 양자화 인덱스일 때 재정렬할 후보 수
+    ragTest.py가 인덱스를 다시 만들면(CURRENT가 바뀌면) 다음 검색부터 새 버전을 연다
+    예전 VectorIndex는 검색 중인 스레드가 있을 수 있으므로 닫지 않고 참조가 없어지면 풀리게 둔다
+    '''
+
+    def __init__(self, path, embedding_function, candidates=None):
+        self.path = path
+        self._pointer = os.path.join(path, CURRENT_FILE)
+        self._stamp = self._pointer_stamp()
+        self._index = VectorIndex(path)
+        self._lock = threading.Lock()
+        self.embedding_function = embedding_function
+        self.candidates = candidates
+
+    def _pointer_stamp(self):
+        # os.replace로 바뀌면 inode가 달라진다 (파일을 읽지 않고 stat 한 번으로 확인)
+        try:
+            stat = os.stat(self._pointer)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    @property
+    def index(self):
+        stamp = self._pointer_stamp()
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    self._index = VectorIndex(self.path)
+                    self._stamp = stamp
+        return self._index
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _select_relevance_score_fn(self):
+        # 점수가 코사인 유사도(-1~1)이므로 0~1로 옮긴다
+        return lambda score: (score + 1.0) / 2.0
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        index = self.index  # 검색 하나는 같은 버전에서 끝낸다
+        exact = index.mode == 'float32' and index.dims == index.meta['full_dim']
+        sources = filter_sources(filter)
+        rows = index.source_rows(sources) if sources is not None else None
+        hits = index.search(embedding, k, candidates=self.candidates, rerank=not exact, rows=rows)
+        return [(index.document(row), score) for row, score in hits]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(
+            self.embedding_function.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        relevance = self._select_relevance_score_fn()
+        return [(doc, relevance(score))
+                for doc, score in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def get_by_ids(self, ids):
+        index = self.index
+        rows = {chunk_id_: row for row, chunk_id_ in enumerate(index.ids)}
+        return [index.document(rows[chunk_id_]) for chunk_id_ in ids if chunk_id_ in rows]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, path='./vector_index',
+                   mode='float32', dims=None, **kwargs):
+        from langchain_core.documents import Document
+
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        docs = [Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(texts, metadatas)]
+        VectorIndex.build(path, embedding.embed_documents(texts), docs, ids=ids,
+                          mode=mode, dims=dims)
+        return cls(path, embedding)
+
+    @classmethod
+    def from_chroma(cls, vector_store, path='./vector_index', mode='float32', dims=None):
+        '''chroma_store의 벡터를 그대로 가져와 인덱스를 만들고 연다 (임베딩 호출 없음)'''
+        build_from_chroma(vector_store, path, mode=mode, dims=dims)
+        return cls(path, vector_store.embeddings)
+
+
+def _iter_chroma(vector_store, page_size=5000):
+    offset = 0
+    while True:
+        result = vector_store.get(include=['embeddings', 'documents', 'metadatas'],
+                                  limit=page_size, offset=offset)
+        yield result
+        if len(result['ids']) < page_size:
+            return
+        offset += page_size
+
+
+def index_meta(path):
+    '''지금 버전 인덱스의 meta.json (인덱스가 없으면 None)'''
+    directory = current_dir(path)
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def build_from_chroma(vector_store, path, mode='int8', dims=None):
+    '''기존 chroma_store의 벡터/청크를 그대로 가져와 인덱스를 만든다 (다시 임베딩하지 않음)'''
+    from langchain_core.documents import Document
+
+    ids, vectors, docs = [], [], []
+    for result in _iter_chroma(vector_store):
+        ids.extend(result['ids'])
+        vectors.extend(result['embeddings'])
+        for chunk_id_, text, metadata in zip(result['ids'], result['documents'],
+                                             result['metadatas']):
+            docs.append(Document(id=chunk_id_, page_content=text, metadata=metadata or {}))
+    return VectorIndex.build(path, np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+                             if ids else np.zeros((0, 1), dtype=np.float32),
+                             docs, ids=ids, mode=mode, dims=dims)
+
+
+if __name__ == '__main__':
+    # chroma_store => 양자화 인덱스 변환 + recall 측정
+    from dotenv import load_dotenv
+    from langchain_chroma import Chroma
+    from ragEmbeddings import CachedEmbeddings
+    from langchain_openai import OpenAIEmbeddings
+
+    load_dotenv()
+    embedding = CachedEmbeddings(OpenAIEmbeddings(model='text-embedding-3-large',
+                                                  api_key=os.getenv('OPENAI_API_KEY')))
+    vector_store = Chroma(persist_directory='./chroma_store', embedding_function=embedding)
+    questions = ['서울시의 온실가스 저감 정책에 대해 알려줘', '뉴욕의 온실가스 저감 정책',
+                 '서울의 녹지 공간 확대 계획은 무엇인가요?', '뉴욕의 주거 정책']
+    query_vectors = embedding.embed_documents(questions)
+    for mode, dims in [('float16', None), ('int8', None), ('int8', 1536), ('int8', 1024)]:
+        index = build_from_chroma(vector_store, f'./vector_index_{mode}_{dims or "full"}',
+                                  mode=mode, dims=dims)
+        print(measure_recall(index, query_vectors, k=10))